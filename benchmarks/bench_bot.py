@@ -0,0 +1,351 @@
+"""Бенчмарк бота на локальной заглушке Bot API.
+
+Запуск из корня проекта:
+
+    python benchmarks/bench_bot.py --messages 2000 --chats 50
+    python benchmarks/bench_bot.py --flood-rate 0.05 --retry-after 1   # под Flood control
+
+Апдейты подаются напрямую в dp.feed_update (без поллинга), бот ходит в
+заглушку benchmarks/fake_api.py через BOT_API_URL. Отчёт:
+- сообщений/с через handle_message в ручном и авто-режиме (до конца обработки очередями чатов);
+- p50/p99 времени обработчиков кнопок create/close/reopen;
+- задержка обновления закрепа после последнего изменения задач в чате;
+- запросы к API на задачу: полный цикл в ручном режиме (сообщение → создать →
+  закрыть → переоткрыть) и создание в авто-режиме.
+
+Лимиты планировщика исходящих запросов по умолчанию сняты, чтобы измерять
+сам бот; с --real-limits действуют обычные TG_* (или заданные в окружении).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager, closing
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_api import FakeBotAPI  # noqa: E402
+
+BOT_ID = 123456
+BOT_TOKEN = f"{BOT_ID}:BENCHMARK-0000000000000000000000000000"
+# Методы, которыми бот обновляет закреп
+PIN_METHODS = ("editmessagetext", "pinchatmessage")
+
+
+def add_common_args(parser: argparse.ArgumentParser):
+    """Параметры заглушки API и окружения бота, общие для bench_bot.py и replay.py"""
+    parser.add_argument("--concurrency", type=int, default=32, help="сколько апдейтов обрабатывается одновременно")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа заглушки API (с)")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля запросов, получающих 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429 (с)")
+    parser.add_argument("--real-limits", action="store_true", help="не снимать лимиты планировщика запросов")
+    parser.add_argument("--settle-timeout", type=float, default=60, help="сколько ждать завершения фоновой работы (с)")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк TaskPinBot на заглушке Bot API")
+    parser.add_argument("--messages", type=int, default=1000, help="сообщений на каждый режим (manual и auto)")
+    parser.add_argument("--chats", type=int, default=20, help="число чатов в каждом режиме")
+    add_common_args(parser)
+    return parser.parse_args()
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(q / 100 * (len(ordered) - 1)))]
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        # Каждое сообщение и нажатие — от нового пользователя: антиспам не вмешивается в замер
+        self._user_ids = itertools.count(10_000)
+
+    def message(self, chat_id: int, text: str) -> dict:
+        user_id = next(self._user_ids)
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "user", "username": f"user{user_id}"},
+                "text": text,
+            },
+        }
+
+    def callback(self, chat_id: int, data: str, message_id: int) -> dict:
+        user_id = next(self._user_ids)
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "chat_instance": "bench",
+                "data": data,
+                "from": {"id": user_id, "is_bot": False, "first_name": "user", "username": f"user{user_id}"},
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                    "from": {"id": BOT_ID, "is_bot": True, "first_name": "bench"},
+                    "text": "task",
+                },
+            },
+        }
+
+
+class Bench:
+    def __init__(self, args, api: FakeBotAPI):
+        import bot as B
+        from aiogram.types import Update
+        from db_async import outbox_size
+
+        self.args = args
+        self.api = api
+        self.B = B
+        self._update_model = Update
+        self._outbox_size = outbox_size
+        self.updates = UpdateFactory()
+        # Апдейты, обработка которых завершилась исключением (например, 429 сверх TG_MAX_RETRIES)
+        self.failed = 0
+
+    async def feed(self, raw: dict):
+        B = self.B
+        update = self._update_model.model_validate(raw, context={"bot": B.bot})
+        await B.dp.feed_update(B.bot, update)
+
+    async def feed_counted(self, raw: dict) -> bool:
+        """feed() без прерывания замера: ошибка апдейта только учитывается в отчёте"""
+        try:
+            await self.feed(raw)
+            return True
+        except Exception:
+            self.failed += 1
+            return False
+
+    async def wait_until(self, predicate, timeout: float):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if await predicate():
+                return True
+            await asyncio.sleep(0.05)
+        return False
+
+    async def settle(self, quiet: float = 0.3):
+        """Дождаться, пока очереди, закрепы, outbox и удаление сообщений отработают"""
+        B = self.B
+
+        async def idle():
+            ingest = B.ingest_queues.stats()
+            busy = (
+                ingest["queued"] or ingest["busy"]
+                or B.message_deleter.stats()["pending"]
+                or B.pin_scheduler.stats()["pending"]
+                or B.outbox.stats()["in_flight"]
+                or B.outbound.stats()["waiting"]
+                or await self._outbox_size()
+            )
+            last_call = self.api.calls[-1][0] if self.api.calls else 0
+            return not busy and time.monotonic() - last_call >= quiet
+
+        if not await self.wait_until(idle, self.args.settle_timeout):
+            logging.getLogger(__name__).error("⚠️ Фоновая работа не завершилась за отведённое время")
+
+    async def messages(self, chats: List[int], mode: str) -> float:
+        """Сообщений в секунду через handle_message до конца обработки очередями чатов"""
+        B = self.B
+        for chat_id in chats:
+            await B.set_chat_mode(chat_id, mode)
+        accepted = B.ingest_queues.accepted
+        processed = B.ingest_queues.processed
+        started = time.perf_counter()
+        for i in range(self.args.messages):
+            await self.feed_counted(self.updates.message(chats[i % len(chats)], f"{mode} task {i}"))
+        expected = B.ingest_queues.accepted - accepted
+
+        async def done():
+            return B.ingest_queues.processed - processed >= expected
+
+        await self.wait_until(done, self.args.settle_timeout)
+        return expected / (time.perf_counter() - started)
+
+    async def tasks_of(self, chats: List[int]) -> List[tuple]:
+        # Отдельное соединение только на чтение: пул бота не трогаем (WAL)
+        placeholders = ",".join("?" * len(chats))
+        with closing(sqlite3.connect(self.B.DB_NAME)) as db:
+            return db.execute(
+                f"SELECT id, chat_id, message_id FROM tasks WHERE chat_id IN ({placeholders}) AND message_id IS NOT NULL",
+                chats,
+            ).fetchall()
+
+    async def clicks(self, action: str, tasks: List[tuple]) -> Dict[str, List[float]]:
+        """Нажать кнопку action у всех задач; время обработчиков и задержка закрепа"""
+        slots = asyncio.Semaphore(self.args.concurrency)
+        latencies: List[float] = []
+        last_event: Dict[int, float] = {}
+
+        async def click(task_id: int, chat_id: int, message_id: int):
+            async with slots:
+                started = time.perf_counter()
+                if not await self.feed_counted(self.updates.callback(chat_id, f"{action}_{task_id}", message_id)):
+                    return
+                latencies.append(time.perf_counter() - started)
+                last_event[chat_id] = time.monotonic()
+
+        await asyncio.gather(*(click(*task) for task in tasks))
+        await self.settle()
+        return {"latency": latencies, "pin_lag": self.pin_lag(last_event)}
+
+    def pin_lag(self, last_event: Dict[int, float]) -> List[float]:
+        """Для каждого чата: от последнего изменения задач до первого обновления закрепа после него"""
+        lags = []
+        for chat_id, event_at in last_event.items():
+            for at, method, call_chat in self.api.calls:
+                if call_chat == chat_id and method in PIN_METHODS and at >= event_at:
+                    lags.append(at - event_at)
+                    break
+        return lags
+
+    async def run(self) -> dict:
+        args = self.args
+        B = self.B
+        manual_chats = [-1_000_000 - i for i in range(args.chats)]
+        auto_chats = [-2_000_000 - i for i in range(args.chats)]
+        report: dict = {}
+
+        lifecycle_started = time.monotonic()
+        report["manual_msgs_per_sec"] = await self.messages(manual_chats, "manual")
+        await self.settle()
+        tasks = await self.tasks_of(manual_chats)
+        pin_lags: List[float] = []
+        for action in ("create", "close", "reopen"):
+            result = await self.clicks(action, tasks)
+            report[f"{action}_p50_ms"] = percentile(result["latency"], 50) * 1000
+            report[f"{action}_p99_ms"] = percentile(result["latency"], 99) * 1000
+            pin_lags += result["pin_lag"]
+        lifecycle_calls = self.api.calls_since(lifecycle_started)
+        report["manual_tasks"] = len(tasks)
+        report["calls_per_lifecycle"] = {
+            method: round(count / max(1, len(tasks)), 3) for method, count in lifecycle_calls.most_common()
+        }
+
+        auto_started = time.monotonic()
+        report["auto_msgs_per_sec"] = await self.messages(auto_chats, "auto")
+        await self.settle()
+        auto_tasks = await self.tasks_of(auto_chats)
+        report["calls_per_auto_task"] = {
+            method: round(count / max(1, len(auto_tasks)), 3)
+            for method, count in self.api.calls_since(auto_started).most_common()
+        }
+
+        report["pin_lag_p50_s"] = percentile(pin_lags, 50)
+        report["pin_lag_p99_s"] = percentile(pin_lags, 99)
+        report["failed_updates"] = self.failed
+        report["flood_responses"] = sum(self.api.floods.values())
+        report["scheduler_flood_hits"] = B.outbound.stats()["flood_hits"]
+        report["outbox"] = B.outbox.stats()
+        return report
+
+    async def start(self):
+        B = self.B
+        B.init_db()
+        await B.init_pool(B.DB_NAME)
+        B.chat_user_buffer.start()
+        B.ingest_queues.start()
+        B.outbox.start()
+        B.pin_scheduler.start()
+
+    async def stop(self):
+        # Тот же порядок остановки, что и в main()
+        B = self.B
+        await B.ingest_queues.stop()
+        await B.message_deleter.stop()
+        await B.outbox.stop()
+        await B.pin_scheduler.stop()
+        await B.outbound.close()
+        await B.bot.session.close()
+        await B.chat_user_buffer.stop()
+        await B.close_pool()
+
+
+def print_report(report: dict):
+    print("=" * 50)
+    print(f"handle_message, ручной режим: {report['manual_msgs_per_sec']:.0f} сообщений/с")
+    print(f"handle_message, авто-режим:   {report['auto_msgs_per_sec']:.0f} сообщений/с")
+    for action in ("create", "close", "reopen"):
+        print(f"{action:>7}: p50 {report[f'{action}_p50_ms']:.1f} мс, p99 {report[f'{action}_p99_ms']:.1f} мс")
+    print(f"Задержка закрепа: p50 {report['pin_lag_p50_s']:.2f} с, p99 {report['pin_lag_p99_s']:.2f} с")
+    print(f"Запросов к API на цикл задачи ({report['manual_tasks']} задач): "
+          f"{sum(report['calls_per_lifecycle'].values()):.2f}")
+    for method, count in report["calls_per_lifecycle"].items():
+        print(f"  {method}: {count}")
+    print(f"Запросов к API на задачу в авто-режиме: {sum(report['calls_per_auto_task'].values()):.2f}")
+    for method, count in report["calls_per_auto_task"].items():
+        print(f"  {method}: {count}")
+    print(f"Ответов 429: {report['flood_responses']}, Flood control в планировщике: {report['scheduler_flood_hits']}")
+    print(f"Апдейтов с ошибкой обработки: {report['failed_updates']}")
+    print("=" * 50)
+
+
+def prepare_environment(args):
+    """Окружение бота; модули бота читают его при импорте, поэтому — до их импорта"""
+    os.environ.update(METRICS_PORT="0")
+    os.environ.pop("RECORD_UPDATES", None)
+    if not args.real_limits:
+        for name in ("TG_GLOBAL_RATE", "TG_GROUP_PER_MINUTE", "TG_PRIVATE_RATE"):
+            os.environ.setdefault(name, "1000000")
+
+
+@asynccontextmanager
+async def running_bot(args, database: Optional[str] = None):
+    """Бот на заглушке API во временном каталоге; database — копия базы, с которой начать"""
+    prepare_environment(args)
+    api = FakeBotAPI(BOT_ID, latency=args.latency, flood_rate=args.flood_rate, retry_after=args.retry_after)
+    os.environ.update(BOT_TOKEN=BOT_TOKEN, BOT_API_URL=await api.start())
+    workdir = tempfile.mkdtemp(prefix="taskpin-bench-")
+    cwd = os.getcwd()
+    if database:
+        # backup(), а не копирование файла: база бота в WAL может быть открыта
+        with closing(sqlite3.connect(database)) as source, closing(sqlite3.connect(os.path.join(workdir, "tasks.db"))) as target:
+            source.backup(target)
+    os.chdir(workdir)
+    try:
+        bench = Bench(args, api)
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.ERROR)
+        await bench.start()
+        try:
+            yield bench
+        finally:
+            await bench.stop()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        await api.stop()
+
+
+async def main():
+    args = parse_args()
+    async with running_bot(args) as bench:
+        report = await bench.run()
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
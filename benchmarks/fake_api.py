@@ -0,0 +1,129 @@
+"""Локальная заглушка Telegram Bot API для бенчмарков.
+
+Отвечает на методы, которые использует бот, правдоподобными результатами,
+записывает каждый вызов (время, метод, чат) и умеет:
+- добавлять задержку ответа (latency), как у настоящего API;
+- отвечать 429 Flood control с заданным retry_after на долю запросов (flood_rate).
+"""
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+from typing import List, Optional, Tuple
+
+from aiohttp import web
+
+# Методы, которые не ограничиваются и не получают 429
+NEVER_FLOODED = {"getme", "getupdates", "setmycommands", "deletewebhook"}
+
+
+class FakeBotAPI:
+    def __init__(self, bot_id: int, latency: float = 0.0, flood_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = 0):
+        self.bot_id = bot_id
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1_000_000)
+        # (monotonic время, метод, chat_id)
+        self.calls: List[Tuple[float, str, Optional[int]]] = []
+        self.counter: Counter = Counter()
+        self.floods: Counter = Counter()
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def reset(self):
+        self.calls.clear()
+        self.counter.clear()
+        self.floods.clear()
+
+    def calls_since(self, started: float) -> Counter:
+        return Counter(method for at, method, _ in self.calls if at >= started)
+
+    # --- ответы ---
+    def _chat(self, chat_id: int) -> dict:
+        return {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private", "title": "bench"}
+
+    def _message(self, chat_id: int, message_id: Optional[int] = None, text: str = "") -> dict:
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": self._chat(chat_id),
+            "from": {"id": self.bot_id, "is_bot": True, "first_name": "bench"},
+            "text": text or "bench",
+        }
+
+    def _admin(self, user_id: int, is_bot: bool) -> dict:
+        return {
+            "status": "administrator",
+            "user": {"id": user_id, "is_bot": is_bot, "first_name": "bench"},
+            "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True,
+            "can_delete_messages": True, "can_manage_video_chats": True, "can_restrict_members": True,
+            "can_promote_members": False, "can_change_info": True, "can_invite_users": True,
+            "can_post_stories": False, "can_edit_stories": False, "can_delete_stories": False,
+            "can_pin_messages": True, "can_manage_topics": True,
+        }
+
+    def _result(self, method: str, data: dict):
+        chat_id = int(data.get("chat_id") or 0)
+        if method == "getme":
+            return {"id": self.bot_id, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method in ("sendmessage", "sendphoto", "sendvideo", "senddocument", "sendanimation", "sendaudio", "sendvoice"):
+            return self._message(chat_id, text=data.get("text", ""))
+        if method == "copymessage":
+            return {"message_id": next(self._message_ids)}
+        if method in ("editmessagetext", "editmessagereplymarkup"):
+            return self._message(chat_id, int(data.get("message_id") or 0), data.get("text", ""))
+        if method == "getchat":
+            return self._chat(chat_id)
+        if method == "getchatadministrators":
+            return [self._admin(self.bot_id, True), self._admin(1, False)]
+        if method == "getchatmember":
+            user_id = int(data.get("user_id") or 0)
+            if user_id == self.bot_id:
+                return self._admin(user_id, True)
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "user"}}
+        if method == "createforumtopic":
+            return {"message_thread_id": next(self._message_ids), "name": data.get("name", ""), "icon_color": 7322096}
+        if method == "getupdates":
+            return []
+        return True
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        data = dict(await request.post()) if request.can_read_body else {}
+        chat_id = data.get("chat_id")
+        self.calls.append((time.monotonic(), method, int(chat_id) if chat_id else None))
+        self.counter[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_rate and method not in NEVER_FLOODED and self._random.random() < self.flood_rate:
+            self.floods[method] += 1
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                },
+                status=429,
+            )
+        return web.json_response({"ok": True, "result": self._result(method, data)})
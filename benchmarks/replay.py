@@ -0,0 +1,172 @@
+"""Воспроизведение записанных апдейтов (RECORD_UPDATES) на заглушке Bot API.
+
+Запуск из корня проекта:
+
+    python benchmarks/replay.py updates.jsonl.gz                     # как можно быстрее
+    python benchmarks/replay.py updates.jsonl --speed 1              # в исходном темпе
+    python benchmarks/replay.py updates.shard*.jsonl --db tasks.db   # журналы шардов, с копии базы
+
+Апдейты подаются в dp.feed_update тем же способом, что и в bench_bot.py:
+по --concurrency одновременно, как при поллинге. Журналы нескольких шардов
+сливаются по времени получения. Кнопки ссылаются на задачи из рабочей
+базы, поэтому для воспроизведения нажатий нужна её копия (--db) на момент
+начала записи; без неё нажатия отвечают «задача не найдена».
+
+Отчёт — те же показатели, что у bench_bot.py: сообщений/с через
+handle_message, p50/p99 обработчиков по типу апдейта (кнопки — по действию),
+задержка закрепа и запросы к API на апдейт по методам.
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_bot import add_common_args, percentile, prepare_environment, running_bot  # noqa: E402
+
+# Нажатия кнопок в отчёте — по действию из callback_data
+CALLBACK_ACTIONS = ("create", "close", "reopen")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Воспроизведение журнала апдейтов TaskPinBot")
+    parser.add_argument("journals", nargs="+", help="журналы RECORD_UPDATES (.jsonl или .jsonl.gz)")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="темп относительно записи: 1 — исходный, 2 — вдвое быстрее, 0 — как можно быстрее")
+    parser.add_argument("--db", help="копия базы бота на момент начала записи")
+    parser.add_argument("--limit", type=int, default=0, help="воспроизвести только первые N апдейтов")
+    add_common_args(parser)
+    return parser.parse_args()
+
+
+def load_records(paths: List[str], limit: int = 0) -> List[dict]:
+    from recorder import read_journal
+
+    # Внутри журнала записи уже идут по времени; журналы шардов сливаем
+    records = list(heapq.merge(*(read_journal(path) for path in paths), key=lambda record: record["t"]))
+    return records[:limit] if limit else records
+
+
+def update_label(update: dict) -> str:
+    kind = next((key for key in update if key != "update_id"), "unknown")
+    if kind == "callback_query":
+        action = (update[kind].get("data") or "").split("_", 1)[0]
+        if action in CALLBACK_ACTIONS:
+            return action
+    return kind
+
+
+async def replay(bench, records: List[dict], speed: float) -> dict:
+    from sharding import update_chat_id
+
+    B = bench.B
+    slots = asyncio.Semaphore(bench.args.concurrency)
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    last_event: Dict[int, float] = {}
+    running = set()
+
+    async def feed(update: dict):
+        label = update_label(update)
+        chat_id = update_chat_id(update)
+        try:
+            started = time.perf_counter()
+            if await bench.feed_counted(update):
+                latencies[label].append(time.perf_counter() - started)
+        finally:
+            slots.release()
+        if chat_id is not None and (label == "message" or label in CALLBACK_ACTIONS):
+            last_event[chat_id] = time.monotonic()
+
+    accepted = B.ingest_queues.accepted
+    processed = B.ingest_queues.processed
+    calls_started = time.monotonic()
+    started = time.perf_counter()
+    origin = records[0]["t"]
+    for record in records:
+        if speed:
+            delay = (record["t"] - origin) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await slots.acquire()
+        task = asyncio.create_task(feed(record["update"]))
+        running.add(task)
+        task.add_done_callback(running.discard)
+    if running:
+        await asyncio.gather(*running)
+    fed = time.perf_counter() - started
+    expected = B.ingest_queues.accepted - accepted
+
+    async def drained():
+        return B.ingest_queues.processed - processed >= expected
+
+    await bench.wait_until(drained, bench.args.settle_timeout)
+    messages_elapsed = time.perf_counter() - started
+    await bench.settle()
+    calls = bench.api.calls_since(calls_started)
+    pin_lags = bench.pin_lag(last_event)
+
+    return {
+        "updates": len(records),
+        "failed": bench.failed,
+        "recorded_seconds": records[-1]["t"] - origin,
+        "fed_seconds": fed,
+        "updates_per_sec": len(records) / fed if fed else 0.0,
+        "msgs_per_sec": expected / messages_elapsed if expected else 0.0,
+        "handlers": {
+            label: {
+                "count": len(values),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+            }
+            for label, values in sorted(latencies.items())
+        },
+        "pin_lag_p50_s": percentile(pin_lags, 50),
+        "pin_lag_p99_s": percentile(pin_lags, 99),
+        "api_calls": sum(calls.values()),
+        "calls_per_update": {
+            method: round(count / len(records), 3) for method, count in calls.most_common()
+        },
+        "flood_responses": sum(bench.api.floods.values()),
+        "scheduler_flood_hits": B.outbound.stats()["flood_hits"],
+    }
+
+
+def print_report(report: dict):
+    print("=" * 50)
+    print(f"Апдейтов: {report['updates']} (ошибок {report['failed']}), записано за {report['recorded_seconds']:.1f} с, "
+          f"подано за {report['fed_seconds']:.1f} с ({report['updates_per_sec']:.0f}/с)")
+    print(f"handle_message: {report['msgs_per_sec']:.0f} сообщений/с")
+    for label, figures in report["handlers"].items():
+        print(f"{label:>20}: {figures['count']} шт., p50 {figures['p50_ms']:.1f} мс, p99 {figures['p99_ms']:.1f} мс")
+    print(f"Задержка закрепа: p50 {report['pin_lag_p50_s']:.2f} с, p99 {report['pin_lag_p99_s']:.2f} с")
+    print(f"Запросов к API: {report['api_calls']}, на апдейт по методам:")
+    for method, count in report["calls_per_update"].items():
+        print(f"  {method}: {count}")
+    print(f"Ответов 429: {report['flood_responses']}, Flood control в планировщике: {report['scheduler_flood_hits']}")
+    print("=" * 50)
+
+
+async def main():
+    args = parse_args()
+    # Модули бота (recorder, sharding) импортируются только после настройки окружения
+    prepare_environment(args)
+    records = load_records(args.journals, args.limit)
+    if not records:
+        sys.exit("Журнал пуст")
+    database = os.path.abspath(args.db) if args.db else None
+    async with running_bot(args, database) as bench:
+        report = await replay(bench, records, args.speed)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,32 +1,55 @@
 import asyncio
 import logging
-import aiosqlite
-import sqlite3  # Только для init_db
 from datetime import datetime, timedelta
 import os
-import re
+import random
+import sys
 from dotenv import load_dotenv
 import html
 from typing import Optional
 
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import CommandStart, Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from broadcast import BroadcastEngine
+from db_migrations import run_migrations
+from ingest import ChatIngestQueues
+from keyed_locks import KeyedLock
+from member_cache import ChatMemberCache, ADMIN_STATUSES
+from message_deleter import MessageDeleter
+from metrics import (
+    PIN_UPDATES, HandlerMetricsMiddleware, TelegramCallMetrics, observe_handler, register_stats, start_metrics_server,
+)
+from outbox import Outbox
+from pin_renderer import PinRenderer, text_hash
+from pin_scheduler import PinUpdateScheduler
+from recorder import RECORD_UPDATES, UpdateRecorder, journal_path
+from sharding import current_shard, owns_chat, run_front, shards_from_argv
+from webhook import serve_webhook
+from tg_scheduler import (
+    OutboundScheduler, PRIORITY_PIN, PRIORITY_BACKGROUND, with_priority
+)
+
 # Импортируем асинхронные функции БД
 from db_async import (
-    add_task, update_task_message_id, get_task_message_id,
-    update_task_topic_id, get_task_topic_id, close_task,
-    reopen_task,
-    set_task_status, get_task_status, get_stats,
-    get_pin_message_id, save_pin_message_id,
-    get_chat_mode, set_chat_mode,
+    create_task, update_task_message_id, get_task_message_id,
+    update_task_topic_id, get_task_topic_id,
+    transition_task, get_task_status, get_stats,
+    get_pin_message_id, save_pin_message_id, save_pin_hash,
+    set_chat_mode, get_chat_settings,
     get_topic_enabled, set_topic_enabled,
-    upsert_chat_user, get_chat_users, get_all_chat_ids,
+    queue_chat_user, chat_user_buffer, get_chat_users, get_all_chat_ids,
     get_chat_info_text, set_chat_info_text,
     get_chat_current_info_text, set_chat_current_info_text,
-    get_period_stats
+    get_period_stats, get_task_author_and_text,
+    get_stale_markup_tasks, mark_task_markup_synced, get_chat_ids_with_open_tasks,
+    reset_chat_data, init_pool, close_pool, pool_stats, get_chats_with_pins,
+    BroadcastJob, create_broadcast_job
 )
 
 # Загрузка токена из .env
@@ -42,20 +65,40 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=API_TOKEN)
+# Свой адрес Bot API: локальный telegram-bot-api или заглушка для бенчмарков (benchmarks/)
+BOT_API_URL = os.getenv("BOT_API_URL")
+if BOT_API_URL:
+    bot = Bot(token=API_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)))
+else:
+    bot = Bot(token=API_TOKEN)
 dp = Dispatcher()
+# Все исходящие запросы к API идут через планировщик с лимитами и приоритетами
+outbound = OutboundScheduler()
+bot.session.middleware(outbound)
+# Метрики запросов к API — внутри планировщика: считаются фактические запросы, включая повторы
+bot.session.middleware(TelegramCallMetrics())
+# Время обработчиков апдейтов в метрики
+for _observer in (dp.message, dp.callback_query, dp.chat_member, dp.my_chat_member):
+    _observer.middleware(HandlerMetricsMiddleware())
+# Журнал входящих апдейтов для воспроизведения нагрузки (benchmarks/replay.py)
+update_recorder = UpdateRecorder(journal_path(RECORD_UPDATES)) if RECORD_UPDATES else None
+if update_recorder is not None:
+    dp.update.outer_middleware(update_recorder)
+# Права участников и самого бота (get_chat_administrators + TTL)
+member_cache = ChatMemberCache(bot)
 
 # Anti-spam throttling state
-LAST_MSG_TS = {}
 LAST_CB_TS = {}
 
-PIN_UPDATE_TASKS = {}
-PIN_RETRY_TASKS = {}
-REPLYMARKUP_RETRY_TASKS = {}
-REPLYMARKUP_RETRY_PAYLOAD = {}
-TASK_LOCKS = {}
-CHAT_LOCKS = {}
-USER_MESSAGE_LOCKS = {}  # Lock для последовательной обработки сообщений от одного пользователя
+# Lock'и по ключу живут, пока их держат или ждут, затем удаляются
+CHAT_LOCKS = KeyedLock("chat")
+# Фактический закреп в чате: chat_id -> (message_id, отправлено ботом).
+# Обновляется по служебным сообщениям pinned_message, своим закрепам и редкой сверке через get_chat.
+PINNED_STATE = {}
+PIN_RECONCILE_INTERVAL = float(os.getenv("PIN_RECONCILE_INTERVAL", "1800"))
+PIN_INIT_CONCURRENCY = int(os.getenv("PIN_INIT_CONCURRENCY", "4"))
+PIN_INIT_JITTER = float(os.getenv("PIN_INIT_JITTER", "0.5"))
+BACKGROUND_TASKS = set()
 
 
 def _throttled(store, key, min_interval: float) -> bool:
@@ -67,49 +110,39 @@ def _throttled(store, key, min_interval: float) -> bool:
     return False
 
 
-async def _throttle_wait(store, key, min_interval: float) -> None:
-    loop = asyncio.get_event_loop()
-    now = loop.time()
-    last = store.get(key, 0.0)
-    wait_s = min_interval - (now - last)
-    if wait_s > 0:
-        await asyncio.sleep(wait_s)
-    store[key] = loop.time()
+def start_background(coro):
+    """Фоновая задача на всё время работы бота (отменяется при остановке)"""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
 
 
-def _parse_retry_after_seconds(error_text: str) -> Optional[int]:
-    try:
-        m = re.search(r"retry after\s+(\d+)", (error_text or "").lower())
-        if not m:
-            return None
-        return int(m.group(1))
-    except Exception:
-        return None
-
-
-def get_task_lock(task_id):
-    """Получить lock для задачи (защита от параллельных операций)"""
-    if task_id not in TASK_LOCKS:
-        TASK_LOCKS[task_id] = asyncio.Lock()
-    return TASK_LOCKS[task_id]
+async def stop_background():
+    tasks = list(BACKGROUND_TASKS)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 
 def get_chat_lock(chat_id):
     """Получить lock для чата (защита обновления закрепа)"""
-    if chat_id not in CHAT_LOCKS:
-        CHAT_LOCKS[chat_id] = asyncio.Lock()
-    return CHAT_LOCKS[chat_id]
+    return CHAT_LOCKS(chat_id)
 
 
-def get_user_message_lock(user_id):
-    """Получить lock для пользователя (последовательная обработка сообщений)"""
-    if user_id not in USER_MESSAGE_LOCKS:
-        USER_MESSAGE_LOCKS[user_id] = asyncio.Lock()
-    return USER_MESSAGE_LOCKS[user_id]
+def lock_stats() -> dict:
+    """Сколько lock'ов сейчас живо и насколько они конкурентны"""
+    return {CHAT_LOCKS.name: CHAT_LOCKS.stats()}
 
 DB_NAME = "tasks.db"
 
 
+# Версия раскладки клавиатуры задач: увеличить при изменении build_task_kb,
+# тогда restore_task_buttons обновит кнопки на всех сообщениях задач
+KEYBOARD_VERSION = 1
+RESTORE_CONCURRENCY = int(os.getenv("RESTORE_CONCURRENCY", "4"))
+
+
 def build_task_kb(task_id: int, status: str) -> InlineKeyboardMarkup:
     if status == 'open':
         main_btn = InlineKeyboardButton(text="✅ Закрыть задачу", callback_data=f"close_{task_id}")
@@ -124,16 +157,15 @@ def build_task_kb(task_id: int, status: str) -> InlineKeyboardMarkup:
 
 async def track_user(chat_id: int, user: types.User):
     try:
-        await upsert_chat_user(chat_id, user.id, user.username, user.full_name)
+        # Запись в БД отложенная: буфер сбрасывается пачкой в фоне
+        queue_chat_user(chat_id, user.id, user.username, user.full_name)
     except Exception as e:
         logger.debug(f"User tracking failed: {e}")
 
 
 async def is_user_admin(chat_id: int, user_id: int) -> bool:
     try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        status = getattr(member, "status", "")
-        return status in ("administrator", "creator")
+        return await member_cache.is_admin(chat_id, user_id)
     except Exception:
         return False
 
@@ -141,9 +173,9 @@ async def is_user_admin(chat_id: int, user_id: int) -> bool:
 async def check_bot_permissions(chat_id: int, require_delete: bool = True, require_pin: bool = True) -> bool:
     """Проверка прав бота в чате."""
     try:
-        member = await bot.get_chat_member(chat_id, bot.id)
-        status = getattr(member, "status", "")
-        if status in ("administrator", "creator"):
+        member = await member_cache.get_member(chat_id, bot.id)
+        status = getattr(member, "status", "member")
+        if status in ADMIN_STATUSES:
             can_delete = getattr(member, "can_delete_messages", False)
             can_pin = getattr(member, "can_pin_messages", False)
 
@@ -161,15 +193,6 @@ async def check_bot_permissions(chat_id: int, require_delete: bool = True, requi
         return False
 
 
-async def delete_message_safe(chat_id: int, message_id: int):
-    """Безопасное удаление сообщения с обработкой ошибок"""
-    try:
-        await bot.delete_message(chat_id=chat_id, message_id=message_id)
-        logger.debug(f"🗑️ Удалено сообщение {message_id}")
-    except Exception as e:
-        logger.warning(f"⚠️ Не удалось удалить сообщение {message_id}: {e}")
-
-
 async def send_text_same_place(callback: types.CallbackQuery, text: str):
     thread_id = getattr(callback.message, "message_thread_id", None)
     await bot.send_message(
@@ -181,6 +204,25 @@ async def send_text_same_place(callback: types.CallbackQuery, text: str):
     )
 
 
+async def mark_markup_synced(task_id: int, message_id: int, status: str):
+    """Клавиатура сообщения задачи соответствует статусу — запоминаем это в БД"""
+    try:
+        await mark_task_markup_synced(task_id, message_id, status, KEYBOARD_VERSION)
+    except Exception as e:
+        logger.debug(f"Не удалось сохранить состояние кнопок задачи #{task_id}: {e}")
+
+
+async def fix_stale_markup(callback: types.CallbackQuery, task_id: int, status: str):
+    """Ленивое исправление: кнопка на сообщении не совпадает со статусом задачи"""
+    try:
+        await callback.message.edit_reply_markup(reply_markup=build_task_kb(task_id, status))
+    except Exception as e:
+        if "message is not modified" not in str(e).lower():
+            logger.debug(f"Не удалось исправить кнопки задачи #{task_id}: {e}")
+            return
+    await mark_markup_synced(task_id, callback.message.message_id, status)
+
+
 def fmt_user_mention(user_id: int, username: Optional[str], full_name: Optional[str]) -> str:
     if username:
         return f"@{html.escape(username)}"
@@ -198,70 +240,8 @@ async def build_mentions_text(chat_id: int) -> str:
 
 # --- ИНИЦИАЛИЗАЦИЯ БАЗЫ ---
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # Таблица задач
-    c.execute('''CREATE TABLE IF NOT EXISTS tasks (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        chat_id INTEGER,
-        user_id INTEGER,
-        username TEXT,
-        text TEXT,
-        status TEXT DEFAULT 'open',
-        created_at TEXT,
-        message_id INTEGER,
-        topic_id INTEGER,
-        closed_at TEXT
-    )''')
-    
-    # Таблица для хранения pin_message_id для каждого чата
-    c.execute('''CREATE TABLE IF NOT EXISTS chats (
-        chat_id INTEGER PRIMARY KEY,
-        pin_message_id INTEGER,
-        mode TEXT DEFAULT 'manual',
-        topic_enabled INTEGER DEFAULT 0,
-        info_text TEXT,
-        current_info_text TEXT
-    )''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS chat_users (
-        chat_id INTEGER,
-        user_id INTEGER,
-        username TEXT,
-        full_name TEXT,
-        last_seen TEXT,
-        PRIMARY KEY (chat_id, user_id)
-    )''')
-    # Добавляем колонку режима при необходимости
-    try:
-        c.execute("PRAGMA table_info(chats)")
-        columns = [col[1] for col in c.fetchall()]
-        if 'mode' not in columns:
-            c.execute("ALTER TABLE chats ADD COLUMN mode TEXT DEFAULT 'manual'")
-        if 'topic_enabled' not in columns:
-            c.execute("ALTER TABLE chats ADD COLUMN topic_enabled INTEGER DEFAULT 0")
-        if 'info_text' not in columns:
-            c.execute("ALTER TABLE chats ADD COLUMN info_text TEXT")
-        if 'current_info_text' not in columns:
-            c.execute("ALTER TABLE chats ADD COLUMN current_info_text TEXT")
-    except Exception as e:
-        logger.warning(f"⚠️ Не удалось добавить колонку mode: {e}")
-    
-    # Добавляем колонку topic_id для задач при необходимости
-    try:
-        c.execute("PRAGMA table_info(tasks)")
-        task_columns = [col[1] for col in c.fetchall()]
-        if 'topic_id' not in task_columns:
-            c.execute("ALTER TABLE tasks ADD COLUMN topic_id INTEGER")
-        if 'closed_at' not in task_columns:
-            c.execute("ALTER TABLE tasks ADD COLUMN closed_at TEXT")
-    except Exception as e:
-        logger.warning(f"⚠️ Не удалось добавить колонку topic_id: {e}")
-    
-    conn.commit()
-    conn.close()
-    logger.info("✅ База данных инициализирована")
+    version = run_migrations(DB_NAME)
+    logger.info(f"✅ База данных инициализирована (версия схемы {version})")
 
 
 # --- СОЗДАНИЕ ССЫЛКИ НА СООБЩЕНИЕ ---
@@ -274,27 +254,37 @@ def create_message_link(chat_id, message_id):
     return f"https://t.me/c/{chat_id_clean}/{message_id}"
 
 
+# Текст закрепа: кэш строк задач и обрезка по лимиту Telegram
+pin_renderer = PinRenderer(create_message_link)
+
+
 # --- СОЗДАНИЕ ТЕМЫ ДЛЯ ЗАДАЧИ И ПУБЛИКАЦИЯ СООБЩЕНИЯ ---
 async def create_task_topic_and_post(chat_id: int, task_id: int, source_message_id: int):
+    # Ошибка создания темы уходит вызывающему (outbox повторит действие)
+    topic_name = f"Задача #{task_id}"
+    topic = await bot.create_forum_topic(chat_id=chat_id, name=topic_name)
+    topic_id = getattr(topic, "message_thread_id", None)
+    if not topic_id:
+        logger.warning(f"⚠️ Не удалось получить message_thread_id для темы задачи #{task_id}")
+        return
     try:
-        topic_name = f"Задача #{task_id}"
-        topic = await bot.create_forum_topic(chat_id=chat_id, name=topic_name)
-        topic_id = getattr(topic, "message_thread_id", None)
-        if not topic_id:
-            logger.warning(f"⚠️ Не удалось получить message_thread_id для темы задачи #{task_id}")
-            return
         await update_task_topic_id(task_id, topic_id)
+    except Exception:
+        # Тема не записана в БД — повтор создал бы вторую; удаляем эту, повтор создаст заново
+        try:
+            await bot.delete_forum_topic(chat_id, message_thread_id=topic_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось удалить несохранённую тему задачи #{task_id}: {e}")
+        raise
+    try:
 
         # Копируем исходное сообщение в тему (клавиатура копируется вместе)
         kb = build_task_kb(task_id, 'open')
         # Получаем автора и текст для подписи
         try:
-            import aiosqlite
-            async with aiosqlite.connect(DB_NAME) as db:
-                async with db.execute("SELECT username, text FROM tasks WHERE id=?", (task_id,)) as cursor:
-                    row = await cursor.fetchone()
-            username = row[0] if row and row[0] else None
-            full_text = row[1] if row and row[1] else ""
+            username, full_text = await get_task_author_and_text(task_id)
+            username = username or None
+            full_text = full_text or ""
         except Exception as e:
             logger.warning(f"⚠️ Не удалось получить данные задачи #{task_id} для подписи: {e}")
             username, full_text = None, ""
@@ -324,7 +314,7 @@ async def create_task_topic_and_post(chat_id: int, task_id: int, source_message_
             )
         logger.info(f"🧵 Создана тема (thread_id={topic_id}) и опубликовано сообщение для задачи #{task_id}")
     except Exception as e:
-        logger.error(f"❌ Ошибка при создании темы для задачи #{task_id}: {e}")
+        logger.error(f"❌ Ошибка при публикации сообщения в тему задачи #{task_id}: {e}")
 
 
 # --- РЕГИСТРАЦИЯ КОМАНД БОТА ---
@@ -353,63 +343,44 @@ async def setup_bot_commands():
 
 
 # --- ОБНОВЛЕНИЕ ЗАКРЕПЛЕННОГО СООБЩЕНИЯ ---
-async def update_pinned_message(chat_id):
+@with_priority(PRIORITY_PIN)
+async def update_pinned_message(chat_id, force: bool = False):
+    """Обновить закреп; без force не делает запросов, если текст не изменился"""
     # Проверяем права бота перед обновлением закрепа
     if not await check_bot_permissions(chat_id, require_delete=False, require_pin=True):
         logger.warning(f"⛔ Не могу обновить закреп в чате {chat_id} - недостаточно прав")
         return
     
     pin_message_id = await get_pin_message_id(chat_id)
-    # Синхронизация с реальным закрепом в Telegram: в БД мог остаться старый message_id
-    # или закреп могли поменять вручную.
-    try:
-        chat = await bot.get_chat(chat_id)
-        pinned = getattr(chat, "pinned_message", None)
-        if pinned:
-            actual_pinned_id = getattr(pinned, "message_id", None)
-            pinned_from_id = getattr(getattr(pinned, "from_user", None), "id", None)
-            if actual_pinned_id and pinned_from_id == bot.id:
-                if pin_message_id != actual_pinned_id:
-                    logger.info(
-                        f"📌 Синхронизация закрепа в чате {chat_id}: БД={pin_message_id}, факт={actual_pinned_id}"
-                    )
-                    pin_message_id = actual_pinned_id
-                    await save_pin_message_id(chat_id, actual_pinned_id)
-            elif actual_pinned_id and pin_message_id and actual_pinned_id != pin_message_id:
-                logger.warning(
-                    f"⚠️ Закреп в чате {chat_id} заменён другим сообщением (id={actual_pinned_id}). Создам новый закреп от бота."
+    # Сверка с реальным закрепом по локально известному состоянию (без get_chat):
+    # в БД мог остаться старый message_id или закреп могли поменять вручную.
+    known = PINNED_STATE.get(chat_id)
+    if known:
+        actual_pinned_id, pinned_by_bot = known
+        if actual_pinned_id and pinned_by_bot:
+            if pin_message_id != actual_pinned_id:
+                logger.info(
+                    f"📌 Синхронизация закрепа в чате {chat_id}: БД={pin_message_id}, факт={actual_pinned_id}"
                 )
-                pin_message_id = None
-    except Exception as e:
-        logger.debug(f"Не удалось получить текущий закреп в чате {chat_id} через get_chat: {e}")
+                pin_message_id = actual_pinned_id
+                await save_pin_message_id(chat_id, actual_pinned_id)
+        elif actual_pinned_id and pin_message_id and actual_pinned_id != pin_message_id:
+            logger.warning(
+                f"⚠️ Закреп в чате {chat_id} заменён другим сообщением (id={actual_pinned_id}). Создам новый закреп от бота."
+            )
+            pin_message_id = None
     open_tasks, closed_tasks, open_list = await get_stats(chat_id)
 
-    # Формирование текста в HTML с экранированием пользовательских данных
-    text_lines = [
-        "<b>📋 Статистика задач</b>",
-        "",
-        f"🔴 Открыто: {html.escape(str(open_tasks))} | ✅ Закрыто: {html.escape(str(closed_tasks))}",
-        "",
-    ]
-
-    if open_tasks:
-        text_lines.append("<b>🧾 Открытые задачи:</b>")
-        text_lines.append("")
-        for idx, t in enumerate(open_list, 1):
-            task_id = t[0]
-            username = html.escape(t[1] if t[1] else "Аноним")
-            text_preview = html.escape((t[2] or "(пусто)")[:60])
-            message_id = t[3]
-
-            if message_id:
-                link = create_message_link(chat_id, message_id)
-                text_lines.append(f"• {idx}. <a href=\"{link}\"><i>{text_preview}</i></a> — @{username}")
-            else:
-                text_lines.append(f"• {idx}. <i>{text_preview}</i> — @{username}")
-
-    new_text = "\n".join(text_lines)
+    # Формирование текста в HTML с экранированием пользовательских данных (строки задач кэшируются)
+    new_text = pin_renderer.render(chat_id, open_tasks, closed_tasks, open_list)
+    new_hash = text_hash(new_text)
     logger.debug(f"Generated pin text (HTML):\n{new_text}")
 
+    if pin_message_id and not force and (await get_chat_settings(chat_id)).pin_hash == new_hash:
+        logger.debug(f"ℹ️ Закреп в чате {chat_id} не изменился — запрос к API не нужен")
+        PIN_UPDATES.labels("unchanged").inc()
+        return
+
     try:
         if pin_message_id:
             # Пытаемся отредактировать существующее закрепленное сообщение
@@ -422,19 +393,18 @@ async def update_pinned_message(chat_id):
                     disable_web_page_preview=True
                 )
                 # Важно: не дергаем pinChatMessage на каждый апдейт — это быстро приводит к Flood control.
+                await save_pin_hash(chat_id, new_hash)
+                PIN_UPDATES.labels("edited").inc()
                 logger.info(f"✅ Обновлено закрепленное сообщение {pin_message_id}")
                 return
+            except TelegramRetryAfter:
+                raise
             except Exception as e:
                 error_msg = str(e).lower()
-                retry_after = _parse_retry_after_seconds(error_msg)
-                if retry_after:
-                    logger.warning(
-                        f"⚠️ Flood control на editMessageText в чате {chat_id}. Retry after {retry_after}s"
-                    )
-                    await schedule_retry_update_pinned_message(chat_id, retry_after)
-                    return
                 # Сообщение не изменилось — редактирование не требуется, ничего не создаем
                 if "message is not modified" in error_msg:
+                    await save_pin_hash(chat_id, new_hash)
+                    PIN_UPDATES.labels("not_modified").inc()
                     logger.info("ℹ️ Текст закрепленного сообщения не изменился — редактирование не требуется")
                     return
                 # Сообщение отсутствует/нельзя редактировать — создадим новое
@@ -452,6 +422,7 @@ async def update_pinned_message(chat_id):
                     logger.warning(
                         f"⚠️ Не удалось отредактировать закреп {pin_message_id}: {e}. Новое сообщение НЕ будет создано"
                     )
+                    PIN_UPDATES.labels("failed").inc()
                     return
 
         if not pin_message_id:
@@ -460,87 +431,200 @@ async def update_pinned_message(chat_id):
                 chat_id, new_text, parse_mode="HTML", disable_web_page_preview=True
             )
             await bot.pin_chat_message(chat_id, msg.message_id, disable_notification=True)
-            await save_pin_message_id(chat_id, msg.message_id)
+            PINNED_STATE[chat_id] = (msg.message_id, True)
+            await save_pin_message_id(chat_id, msg.message_id, new_hash)
+            PIN_UPDATES.labels("created").inc()
             logger.info(f"📌 Создано и закреплено новое сообщение {msg.message_id}")
 
+    except TelegramRetryAfter as e:
+        # Планировщик запросов уже не стал ждать: повторит тот же воркер закрепов после паузы
+        logger.warning(f"⚠️ Flood control при обновлении закрепа в чате {chat_id}. Retry after {e.retry_after}s")
+        pin_scheduler.mark_dirty(chat_id, delay=e.retry_after + 1)
+        PIN_UPDATES.labels("deferred").inc()
     except Exception as e:
+        PIN_UPDATES.labels("failed").inc()
         logger.error(f"❌ Ошибка при обновлении закрепа: {e}")
 
 
-async def schedule_update_pinned_message(chat_id: int, delay: float = 3.0):
-    """Debounce обновления закрепа: отменяет предыдущую задачу и планирует новую"""
-    # Отменяем предыдущую задачу обновления для этого чата
-    existing = PIN_UPDATE_TASKS.get(chat_id)
-    if existing and not existing.done():
-        existing.cancel()
-    
-    async def _delayed_pin():
+def remember_pinned_message(chat_id: int, pinned) -> bool:
+    """Запомнить фактический закреп; True — если состояние изменилось"""
+    if pinned is None:
+        state = None
+    else:
+        pinned_from_id = getattr(getattr(pinned, "from_user", None), "id", None)
+        state = (getattr(pinned, "message_id", None), pinned_from_id == bot.id)
+    if PINNED_STATE.get(chat_id) == state:
+        return False
+    if state is None:
+        PINNED_STATE.pop(chat_id, None)
+    else:
+        PINNED_STATE[chat_id] = state
+    return True
+
+
+@with_priority(PRIORITY_BACKGROUND)
+async def reconcile_pins():
+    """Редкая сверка локального состояния закрепов с Telegram (get_chat).
+
+    Темп задаёт планировщик запросов: фоновые get_chat уступают ответам
+    пользователям и не забирают последние токены глобального лимита.
+    """
+    changed = 0
+    for chat_id, pin_message_id in await get_chats_with_pins():
+        if not owns_chat(chat_id):
+            continue
         try:
-            await asyncio.sleep(delay)
-            # Обновляем закреп с защитой через chat_lock
-            async with get_chat_lock(chat_id):
-                await update_pinned_message(chat_id)
-        except asyncio.CancelledError:
-            pass  # Задача отменена — это нормально
+            chat = await bot.get_chat(chat_id)
         except Exception as e:
-            logger.warning(f"⚠️ Ошибка отложенного обновления закрепа для чата {chat_id}: {e}")
-    
-    PIN_UPDATE_TASKS[chat_id] = asyncio.create_task(_delayed_pin())
-
+            logger.debug(f"Не удалось получить текущий закреп в чате {chat_id} через get_chat: {e}")
+            continue
+        pinned = getattr(chat, "pinned_message", None)
+        if remember_pinned_message(chat_id, pinned):
+            changed += 1
+            actual_pinned_id = getattr(pinned, "message_id", None)
+            if actual_pinned_id != pin_message_id:
+                # Закреп сняли или заменили: сохранённый хэш больше не описывает видимый закреп
+                await save_pin_hash(chat_id, None)
+                await schedule_update_pinned_message(chat_id)
+    if changed:
+        logger.info(f"📌 Сверка закрепов: обновлено состояние в {changed} чатах")
 
-async def schedule_retry_update_pinned_message(chat_id: int, retry_after: int):
-    existing = PIN_RETRY_TASKS.get(chat_id)
-    if existing and not existing.done():
-        return
 
-    async def _retry_pin():
+async def run_pin_reconciliation(interval: float = PIN_RECONCILE_INTERVAL):
+    while True:
         try:
-            await asyncio.sleep(max(1, int(retry_after) + 1))
-            async with get_chat_lock(chat_id):
-                await update_pinned_message(chat_id)
-        except asyncio.CancelledError:
-            pass
+            await reconcile_pins()
         except Exception as e:
-            logger.warning(f"⚠️ Ошибка retry-обновления закрепа для чата {chat_id}: {e}")
+            logger.warning(f"⚠️ Ошибка сверки закрепов: {e}")
+        await asyncio.sleep(interval)
+
+
+async def _update_pinned_message_locked(chat_id: int):
+    # Обновляем закреп с защитой через chat_lock
+    async with get_chat_lock(chat_id):
+        await update_pinned_message(chat_id)
+
+
+# Один планировщик на все чаты: пауза PIN_QUIET_PERIOD, но не дольше PIN_MAX_STALENESS
+pin_scheduler = PinUpdateScheduler(_update_pinned_message_locked, ready_at=outbound.chat_ready_at)
 
-    PIN_RETRY_TASKS[chat_id] = asyncio.create_task(_retry_pin())
 
+async def schedule_update_pinned_message(chat_id: int):
+    """Debounce обновления закрепа: помечает чат, обновление выполнит общий воркер"""
+    pin_scheduler.mark_dirty(chat_id)
 
-async def schedule_retry_edit_reply_markup(chat_id: int, message_id: int, reply_markup, retry_after: int):
-    key = (chat_id, message_id)
-    REPLYMARKUP_RETRY_PAYLOAD[key] = reply_markup
 
-    existing = REPLYMARKUP_RETRY_TASKS.get(key)
-    if existing and not existing.done():
+# --- OUTBOX: НАДЁЖНЫЕ ОТЛОЖЕННЫЕ ДЕЙСТВИЯ В TELEGRAM ---
+# Действие хранится в БД до успешного выполнения; действия с одним ключом
+# схлопываются до последнего, исполнители сверяются с текущим состоянием задачи.
+outbox = Outbox(shard=current_shard())
+
+
+@outbox.handler("delete")
+async def _outbox_delete_message(chat_id: int, payload: dict):
+    await bot.delete_message(chat_id=chat_id, message_id=payload["message_id"])
+    logger.debug(f"🗑️ Удалено сообщение {payload['message_id']}")
+
+
+@outbox.handler("markup")
+async def _outbox_sync_markup(chat_id: int, payload: dict):
+    """Кнопки сообщения задачи по её текущему статусу (а не по статусу на момент постановки)"""
+    task_id, message_id = payload["task_id"], payload["message_id"]
+    status = await get_task_status(task_id)
+    if status is None:
+        return
+    try:
+        await bot.edit_message_reply_markup(
+            chat_id=chat_id, message_id=message_id, reply_markup=build_task_kb(task_id, status)
+        )
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            raise
+    await mark_markup_synced(task_id, message_id, status)
+
+
+@outbox.handler("topic")
+async def _outbox_sync_topic(chat_id: int, payload: dict):
+    """Тема задачи по её текущему статусу: у открытой есть, у закрытой — удалена"""
+    task_id = payload["task_id"]
+    status = await get_task_status(task_id)
+    topic_id = await get_task_topic_id(task_id)
+    if status != 'open':
+        if topic_id:
+            try:
+                await bot.delete_forum_topic(chat_id, message_thread_id=topic_id)
+                logger.info(f"🧹 Удалена тема задачи #{task_id} (thread_id={topic_id})")
+            except TelegramBadRequest as e:
+                # Тему уже удалили вручную — просто забываем её
+                logger.warning(f"⚠️ Не удалось удалить тему задачи #{task_id}: {e}")
+            await update_task_topic_id(task_id, None)
+        return
+    if topic_id or not await get_topic_enabled(chat_id):
+        return
+    source_message_id = payload.get("source_message_id") or await get_task_message_id(task_id)
+    if not source_message_id:
         return
+    try:
+        await create_task_topic_and_post(chat_id, task_id, source_message_id)
+    except Exception:
+        # Тему могла успеть создать и записать другая попытка — тогда повтор дал бы дубль
+        if await get_task_topic_id(task_id):
+            logger.info(f"ℹ️ Тема задачи #{task_id} уже создана, повтор не нужен")
+            return
+        raise
+
+
+async def delete_message_later(chat_id: int, message_id: int):
+    await outbox.enqueue("delete", f"delete:{chat_id}:{message_id}", chat_id, {"message_id": message_id})
+
+
+async def _delete_messages_batch(chat_id: int, message_ids: list):
+    await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
 
-    async def _retry_markup():
-        wait = max(1, int(retry_after) + 1)
-        try:
-            while True:
-                await asyncio.sleep(wait)
-                payload = REPLYMARKUP_RETRY_PAYLOAD.get(key)
-                if payload is None:
-                    return
-                try:
-                    await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=payload)
-                    return
-                except Exception as e:
-                    ra = _parse_retry_after_seconds(str(e))
-                    if ra:
-                        logger.warning(
-                            f"⚠️ Flood control на editReplyMarkup (chat={chat_id}, msg={message_id}). Retry after {ra}s"
-                        )
-                        wait = max(1, int(ra) + 1)
-                        continue
-                    logger.warning(f"⚠️ Не удалось обновить кнопки (chat={chat_id}, msg={message_id}): {e}")
-                    return
-        except asyncio.CancelledError:
-            pass
-        except Exception as e:
-            logger.warning(f"⚠️ Ошибка retry-обновления кнопок (chat={chat_id}, msg={message_id}): {e}")
 
-    REPLYMARKUP_RETRY_TASKS[key] = asyncio.create_task(_retry_markup())
+# Пачка не удалилась — каждое сообщение удаляется отдельно через outbox
+message_deleter = MessageDeleter(_delete_messages_batch, delete_message_later)
+
+
+async def schedule_markup_sync(chat_id: int, message_id: int, task_id: int, delay: float = 0):
+    await outbox.enqueue(
+        "markup", f"markup:{chat_id}:{message_id}", chat_id,
+        {"task_id": task_id, "message_id": message_id}, delay=delay
+    )
+
+
+async def schedule_topic_sync(chat_id: int, task_id: int, source_message_id: Optional[int] = None):
+    await outbox.enqueue(
+        "topic", f"topic:{task_id}", chat_id, {"task_id": task_id, "source_message_id": source_message_id}
+    )
+
+
+# --- ИЗМЕНЕНИЕ ПРАВ В ЧАТЕ ---
+@dp.my_chat_member()
+async def my_chat_member_update(event: types.ChatMemberUpdated):
+    """Права бота поменялись — кэш прав этого чата больше не актуален"""
+    member_cache.invalidate(event.chat.id)
+    logger.info(
+        f"🔑 Статус бота в чате {event.chat.id}: {event.old_chat_member.status} → {event.new_chat_member.status}"
+    )
+
+
+@dp.chat_member()
+async def chat_member_update(event: types.ChatMemberUpdated):
+    member_cache.invalidate(event.chat.id)
+
+
+# --- СЛУЖЕБНОЕ СООБЩЕНИЕ О ЗАКРЕПЕ ---
+@dp.message(F.pinned_message)
+async def pinned_message_service(message: types.Message):
+    """Кто-то закрепил сообщение — запоминаем, что сейчас в закрепе"""
+    chat_id = message.chat.id
+    if not remember_pinned_message(chat_id, message.pinned_message):
+        return
+    pinned_by_bot = PINNED_STATE.get(chat_id, (None, False))[1]
+    if not pinned_by_bot and await get_pin_message_id(chat_id):
+        # Наш закреп вытеснен чужим сообщением — пересоздадим его
+        await schedule_update_pinned_message(chat_id)
 
 
 # --- КОМАНДА /start ---
@@ -560,13 +644,10 @@ async def refresh_cmd(message: types.Message):
         logger.info(f"🔄 Получена команда /refresh от @{message.from_user.username} в чате {chat_id}")
         
         # Обновляем закреп (сначала попытка редактирования существующего; при неудаче — создание нового)
-        await update_pinned_message(chat_id)
+        await update_pinned_message(chat_id, force=True)
         
         # Удаляем команду пользователя
-        try:
-            await bot.delete_message(chat_id, message.message_id)
-        except:
-            pass
+        message_deleter.add(chat_id, message.message_id)
         
         logger.info(f"✅ Закрепленное сообщение обновлено в чате {chat_id}")
         
@@ -582,10 +663,7 @@ async def mode_manual_cmd(message: types.Message):
     await track_user(chat_id, message.from_user)
     await set_chat_mode(chat_id, 'manual')
     await message.answer("🛠️ Режим установлен: ручной. Задачи открываются по кнопке \"Создать задачу\".")
-    try:
-        await bot.delete_message(chat_id, message.message_id)
-    except:
-        pass
+    message_deleter.add(chat_id, message.message_id)
 
 
 # --- ПЕРЕКЛЮЧЕНИЕ РЕЖИМА: ТЕМЫ ---
@@ -595,10 +673,7 @@ async def mode_topic_cmd(message: types.Message):
     await track_user(chat_id, message.from_user)
     await set_topic_enabled(chat_id, True)
     await message.answer("🧵 Режим тем включен. Для каждой задачи создаётся отдельная тема с копией сообщения.")
-    try:
-        await bot.delete_message(chat_id, message.message_id)
-    except:
-        pass
+    message_deleter.add(chat_id, message.message_id)
 
 
 # --- ПЕРЕКЛЮЧЕНИЕ РЕЖИМА: АВТО ---
@@ -608,10 +683,7 @@ async def mode_auto_cmd(message: types.Message):
     await track_user(chat_id, message.from_user)
     await set_chat_mode(chat_id, 'auto')
     await message.answer("⚡ Режим установлен: авто. Новые сообщения сразу создают открытую задачу с кнопкой \"Закрыть задачу\".")
-    try:
-        await bot.delete_message(chat_id, message.message_id)
-    except:
-        pass
+    message_deleter.add(chat_id, message.message_id)
 
 
 # --- ВКЛ/ВЫКЛ РЕЖИМА ТЕМ ---
@@ -621,10 +693,7 @@ async def topic_on_cmd(message: types.Message):
     await track_user(chat_id, message.from_user)
     await set_topic_enabled(chat_id, True)
     await message.answer("🧵 Режим тем: включен")
-    try:
-        await bot.delete_message(chat_id, message.message_id)
-    except:
-        pass
+    message_deleter.add(chat_id, message.message_id)
 
 
 @dp.message(Command("topic_off"))
@@ -633,10 +702,7 @@ async def topic_off_cmd(message: types.Message):
     await track_user(chat_id, message.from_user)
     await set_topic_enabled(chat_id, False)
     await message.answer("🧵 Режим тем: выключен")
-    try:
-        await bot.delete_message(chat_id, message.message_id)
-    except:
-        pass
+    message_deleter.add(chat_id, message.message_id)
 
 
 @dp.message(Command("set_info"))
@@ -652,10 +718,7 @@ async def set_info_cmd(message: types.Message):
         return
     await set_chat_info_text(chat_id, parts[1].strip())
     await message.answer("✅ Инструкция обновлена")
-    try:
-        await bot.delete_message(chat_id, message.message_id)
-    except:
-        pass
+    message_deleter.add(chat_id, message.message_id)
 
 
 @dp.message(Command("set_current_info"))
@@ -671,10 +734,7 @@ async def set_current_info_cmd(message: types.Message):
         return
     await set_chat_current_info_text(chat_id, parts[1].strip())
     await message.answer("✅ Текущая информация обновлена")
-    try:
-        await bot.delete_message(chat_id, message.message_id)
-    except:
-        pass
+    message_deleter.add(chat_id, message.message_id)
 
 
 @dp.message(Command("stats"))
@@ -743,10 +803,44 @@ async def announce_cmd(message: types.Message):
                     chunk = (chunk + " " + m).strip()
             if chunk:
                 await message.answer(chunk, parse_mode="HTML", disable_web_page_preview=True)
-    try:
-        await bot.delete_message(chat_id, message.message_id)
-    except:
-        pass
+    message_deleter.add(chat_id, message.message_id)
+
+
+@with_priority(PRIORITY_BACKGROUND)
+async def deliver_announcement(job: BroadcastJob, chat_id: int) -> bool:
+    """Доставка оповещения /announce_all в один чат; False — автор не админ чата"""
+    if not await is_user_admin(chat_id, job.owner_id):
+        return False
+    mentions = await build_mentions_text(chat_id)
+    text = job.text + ("\n\n" + mentions if mentions else "")
+    if len(text) > 3900:
+        text = job.text
+    await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML", disable_web_page_preview=True)
+    return True
+
+
+async def report_announcement(job: BroadcastJob, counts: dict, finished: bool):
+    if not job.progress_message_id:
+        return
+    sent = counts.get("sent", 0)
+    skipped = counts.get("skipped", 0)
+    failed = counts.get("failed", 0)
+    deferred = counts.get("deferred", 0)
+    if finished:
+        text = f"Готово. Отправлено: {sent}. Пропущено: {skipped}. Ошибок: {failed}."
+    else:
+        total = sum(counts.values())
+        text = (
+            f"⏳ Рассылка: обработано {sent + skipped + failed} из {total}\n"
+            f"Отправлено: {sent}. Пропущено: {skipped}. Ошибок: {failed}."
+        )
+        if deferred:
+            text += f"\nОжидают снятия лимита Telegram: {deferred}"
+    await bot.edit_message_text(chat_id=job.owner_chat_id, message_id=job.progress_message_id, text=text)
+
+
+# Рассылки /announce_all: состояние доставки в каждый чат хранится в БД
+broadcast_engine = BroadcastEngine(deliver_announcement, report_announcement)
 
 
 @dp.message(Command("announce_all"))
@@ -761,21 +855,11 @@ async def announce_all_cmd(message: types.Message):
         return
     body = html.escape(parts[1].strip())
     base_text = f"<b>📢 Оповещение</b>\n\n{body}" if body else "<b>📢 Оповещение</b>"
-    sent = 0
-    failed = 0
-    for chat_id in await get_all_chat_ids():
-        if not await is_user_admin(chat_id, message.from_user.id):
-            continue
-        try:
-            mentions = await build_mentions_text(chat_id)
-            text = base_text + ("\n\n" + mentions if mentions else "")
-            if len(text) > 3900:
-                text = base_text
-            await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML", disable_web_page_preview=True)
-            sent += 1
-        except Exception:
-            failed += 1
-    await message.answer(f"Готово. Отправлено: {sent}. Ошибок: {failed}.")
+    progress = await message.answer("⏳ Рассылка запускается...")
+    job_id = await create_broadcast_job(
+        message.from_user.id, message.chat.id, base_text, await get_all_chat_ids(), progress.message_id
+    )
+    broadcast_engine.start_job(job_id)
 
 
 @dp.callback_query(F.data == "info")
@@ -832,13 +916,9 @@ async def reset_cmd(message: types.Message):
                     logger.warning(f"⚠️ Не удалось удалить закреп: {e}")
             
             # Очищаем БД для этого чата
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            c.execute("DELETE FROM tasks WHERE chat_id=?", (chat_id,))
-            deleted_tasks = c.rowcount
-            c.execute("DELETE FROM chats WHERE chat_id=?", (chat_id,))
-            conn.commit()
-            conn.close()
+            deleted_tasks = await reset_chat_data(chat_id)
+            PINNED_STATE.pop(chat_id, None)
+            pin_renderer.forget(chat_id)
             
             RESET_CONFIRMATIONS.pop((chat_id, user_id), None)
             
@@ -849,10 +929,7 @@ async def reset_cmd(message: types.Message):
             logger.error(f"❌ Ошибка при сбросе: {e}")
             await message.answer(f"❌ Ошибка при сбросе: {e}")
         
-        try:
-            await bot.delete_message(chat_id, message.message_id)
-        except:
-            pass
+        message_deleter.add(chat_id, message.message_id)
     else:
         # Первый вызов — запрашиваем подтверждение
         RESET_CONFIRMATIONS[(chat_id, user_id)] = True
@@ -873,13 +950,113 @@ async def reset_cmd(message: types.Message):
         
         asyncio.create_task(_clear_confirmation())
         
-        try:
-            await bot.delete_message(chat_id, message.message_id)
-        except:
-            pass
+        message_deleter.add(chat_id, message.message_id)
 
 
 # --- ОБРАБОТКА НОВЫХ СООБЩЕНИЙ ---
+@observe_handler("process_incoming_message")
+async def process_incoming_message(message: types.Message):
+    """Превращает сообщение пользователя в задачу; вызывается из очереди чата по порядку"""
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    await track_user(chat_id, message.from_user)
+    username = message.from_user.username or message.from_user.full_name or "Аноним"
+    text = message.text or message.caption or "(медиа без текста)"
+    # Формируем подпись автора: @username если есть, иначе имя без @
+    author_label = (
+        f"@{html.escape(message.from_user.username)}" if message.from_user.username else html.escape(message.from_user.full_name or "Аноним")
+    )
+    display_username = html.escape(username)
+    display_text = html.escape(text)
+
+    # Одна транзакция: задача сразу в итоговом статусе (по режиму чата) + настройки чата
+    task_id, settings = await create_task(chat_id, user_id, username, text)
+    logger.info(f"📝 Создана задача #{task_id} от @{username} в чате {chat_id}")
+
+    is_auto = (settings.mode == 'auto')
+    topics = settings.topic_enabled
+    kb_status = 'open' if is_auto else 'new'
+    kb = build_task_kb(task_id, kb_status)
+
+    source_message_id = None
+    try:
+        has_media = (
+            getattr(message, "photo", None)
+            or getattr(message, "video", None)
+            or getattr(message, "document", None)
+            or getattr(message, "animation", None)
+            or getattr(message, "voice", None)
+            or getattr(message, "audio", None)
+            or getattr(message, "sticker", None)
+            or getattr(message, "video_note", None)
+        )
+        if has_media:
+            sent_msg = None
+            # Отправляем медиа c явным caption, чтобы гарантировать подпись автора
+            if getattr(message, "photo", None):
+                file_id = message.photo[-1].file_id
+                sent_msg = await bot.send_photo(chat_id=chat_id, photo=file_id, caption=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML", reply_markup=kb)
+            elif getattr(message, "video", None):
+                file_id = message.video.file_id
+                sent_msg = await bot.send_video(chat_id=chat_id, video=file_id, caption=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML", reply_markup=kb)
+            elif getattr(message, "document", None):
+                file_id = message.document.file_id
+                sent_msg = await bot.send_document(chat_id=chat_id, document=file_id, caption=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML", reply_markup=kb)
+            elif getattr(message, "animation", None):
+                file_id = message.animation.file_id
+                sent_msg = await bot.send_animation(chat_id=chat_id, animation=file_id, caption=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML", reply_markup=kb)
+            elif getattr(message, "audio", None):
+                file_id = message.audio.file_id
+                sent_msg = await bot.send_audio(chat_id=chat_id, audio=file_id, caption=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML", reply_markup=kb)
+            elif getattr(message, "voice", None):
+                file_id = message.voice.file_id
+                sent_msg = await bot.send_voice(chat_id=chat_id, voice=file_id, caption=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML", reply_markup=kb)
+            else:
+                # Типы без caption (sticker/video_note) — отправим как есть + отдельным сообщением подпись
+                copied = await bot.copy_message(chat_id=chat_id, from_chat_id=chat_id, message_id=message.message_id, reply_markup=kb)
+                new_message_id = getattr(copied, "message_id", None)
+                if new_message_id:
+                    await update_task_message_id(task_id, new_message_id, KEYBOARD_VERSION, kb_status)
+                    source_message_id = new_message_id
+                # Дополнительная подпись отдельным сообщением
+                await bot.send_message(chat_id=chat_id, text=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML")
+
+            if sent_msg:
+                await update_task_message_id(task_id, sent_msg.message_id, KEYBOARD_VERSION, kb_status)
+                logger.debug(f"✉️ Отправлено медиа {sent_msg.message_id} с подписью автора для задачи #{task_id}")
+                source_message_id = sent_msg.message_id
+        else:
+            sent_msg = await bot.send_message(
+                chat_id=chat_id,
+                text=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}",
+                parse_mode="HTML",
+                reply_markup=kb
+            )
+            await update_task_message_id(task_id, sent_msg.message_id, KEYBOARD_VERSION, kb_status)
+            logger.debug(f"✉️ Отправлено сообщение {sent_msg.message_id} с кнопкой для задачи #{task_id}")
+            source_message_id = sent_msg.message_id
+    except Exception as e:
+        logger.error(f"❌ Ошибка отправки сообщения для задачи #{task_id}: {e}")
+    
+    # В авто-режиме сразу обновляем закреп
+    if is_auto:
+        try:
+            await schedule_update_pinned_message(chat_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить закреп в авто-режиме: {e}")
+
+    # Если включены темы — создаём тему в авто-режиме сразу
+    if topics and is_auto and source_message_id:
+        await schedule_topic_sync(chat_id, task_id, source_message_id)
+    
+    # Удалить оригинальное сообщение (требуются права администратора) — пачкой с другими, не блокируя обработку
+    message_deleter.add(chat_id, message.message_id)
+
+
+# Сообщения чата обрабатываются по порядку, разные чаты — параллельно
+ingest_queues = ChatIngestQueues(process_incoming_message, ready_at=outbound.chat_ready_at)
+
+
 @dp.message()
 async def handle_message(message: types.Message):
     # Игнорируем сообщения от ботов
@@ -888,120 +1065,21 @@ async def handle_message(message: types.Message):
     # Игнорируем сообщения внутри тем (обсуждение задач)
     if getattr(message, "message_thread_id", None):
         return
-
-    chat_id = message.chat.id
-    user_id = message.from_user.id
-    
-    # Получаем lock для пользователя для последовательной обработки
-    user_lock = get_user_message_lock(user_id)
-    
-    async with user_lock:
-        await track_user(chat_id, message.from_user)
-        # Throttle message spam per chat+user
-        await _throttle_wait(LAST_MSG_TS, (chat_id, user_id), 0.8)
-        username = message.from_user.username or message.from_user.full_name or "Аноним"
-        text = message.text or message.caption or "(медиа без текста)"
-        # Формируем подпись автора: @username если есть, иначе имя без @
-        author_label = (
-            f"@{html.escape(message.from_user.username)}" if message.from_user.username else html.escape(message.from_user.full_name or "Аноним")
+    if not ingest_queues.submit(message.chat.id, message.from_user.id, message):
+        # Сообщение не удаляем — пользователь увидит, что бот его не принял
+        logger.warning(
+            f"⚠️ Очередь чата {message.chat.id} переполнена, сообщение {message.message_id} пропущено"
         )
-        display_username = html.escape(username)
-        display_text = html.escape(text)
-
-        # Сохранить в базу (сначала без message_id)
-        task_id = await add_task(chat_id, user_id, username, text)
-        logger.info(f"📝 Создана задача #{task_id} от @{username} в чате {chat_id}")
-
-        # Определяем режим и формируем клавиатуру
-        mode = await get_chat_mode(chat_id)
-        is_auto = (mode == 'auto')
-        topics = await get_topic_enabled(chat_id)
-        if is_auto:
-            await set_task_status(task_id, 'open')
-            kb = build_task_kb(task_id, 'open')
-        else:
-            kb = build_task_kb(task_id, 'new')
-
-        source_message_id = None
-        try:
-            has_media = (
-                getattr(message, "photo", None)
-                or getattr(message, "video", None)
-                or getattr(message, "document", None)
-                or getattr(message, "animation", None)
-                or getattr(message, "voice", None)
-                or getattr(message, "audio", None)
-                or getattr(message, "sticker", None)
-                or getattr(message, "video_note", None)
-            )
-            if has_media:
-                sent_msg = None
-                # Отправляем медиа c явным caption, чтобы гарантировать подпись автора
-                if getattr(message, "photo", None):
-                    file_id = message.photo[-1].file_id
-                    sent_msg = await bot.send_photo(chat_id=chat_id, photo=file_id, caption=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML", reply_markup=kb)
-                elif getattr(message, "video", None):
-                    file_id = message.video.file_id
-                    sent_msg = await bot.send_video(chat_id=chat_id, video=file_id, caption=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML", reply_markup=kb)
-                elif getattr(message, "document", None):
-                    file_id = message.document.file_id
-                    sent_msg = await bot.send_document(chat_id=chat_id, document=file_id, caption=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML", reply_markup=kb)
-                elif getattr(message, "animation", None):
-                    file_id = message.animation.file_id
-                    sent_msg = await bot.send_animation(chat_id=chat_id, animation=file_id, caption=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML", reply_markup=kb)
-                elif getattr(message, "audio", None):
-                    file_id = message.audio.file_id
-                    sent_msg = await bot.send_audio(chat_id=chat_id, audio=file_id, caption=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML", reply_markup=kb)
-                elif getattr(message, "voice", None):
-                    file_id = message.voice.file_id
-                    sent_msg = await bot.send_voice(chat_id=chat_id, voice=file_id, caption=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML", reply_markup=kb)
-                else:
-                    # Типы без caption (sticker/video_note) — отправим как есть + отдельным сообщением подпись
-                    copied = await bot.copy_message(chat_id=chat_id, from_chat_id=chat_id, message_id=message.message_id, reply_markup=kb)
-                    new_message_id = getattr(copied, "message_id", None)
-                    if new_message_id:
-                        await update_task_message_id(task_id, new_message_id)
-                        source_message_id = new_message_id
-                    # Дополнительная подпись отдельным сообщением
-                    await bot.send_message(chat_id=chat_id, text=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}", parse_mode="HTML")
-
-                if sent_msg:
-                    await update_task_message_id(task_id, sent_msg.message_id)
-                    logger.debug(f"✉️ Отправлено медиа {sent_msg.message_id} с подписью автора для задачи #{task_id}")
-                    source_message_id = sent_msg.message_id
-            else:
-                sent_msg = await bot.send_message(
-                    chat_id=chat_id,
-                    text=f"👤 <b>Сообщение от</b> {author_label}:\n\n{display_text}",
-                    parse_mode="HTML",
-                    reply_markup=kb
-                )
-                await update_task_message_id(task_id, sent_msg.message_id)
-                logger.debug(f"✉️ Отправлено сообщение {sent_msg.message_id} с кнопкой для задачи #{task_id}")
-                source_message_id = sent_msg.message_id
-        except Exception as e:
-            logger.error(f"❌ Ошибка отправки сообщения для задачи #{task_id}: {e}")
-        
-        # В авто-режиме сразу обновляем закреп
-        if is_auto:
-            try:
-                await schedule_update_pinned_message(chat_id)
-            except Exception as e:
-                logger.warning(f"⚠️ Не удалось обновить закреп в авто-режиме: {e}")
-
-        # Если включены темы — создаём тему в авто-режиме сразу
-        if topics and is_auto and source_message_id:
-            await create_task_topic_and_post(chat_id, task_id, source_message_id)
-        
-        # Удалить оригинальное сообщение (требуются права администратора) — не блокируем обработчик
-        asyncio.create_task(delete_message_safe(chat_id, message.message_id))
 
 
 # --- НАЖАТИЕ КНОПКИ "СОЗДАТЬ ЗАДАЧУ" ---
 @dp.callback_query(F.data.startswith("create_"))
 async def create_task_callback(callback: types.CallbackQuery):
-    # Мгновенный ответ для снятия "часиков"
-    await callback.answer("⏳")
+    # Мгновенный ответ для снятия "часиков"; при Flood control действие выполняется и без него
+    try:
+        await callback.answer("⏳")
+    except TelegramRetryAfter:
+        pass
     
     try:
         chat_id = callback.message.chat.id
@@ -1015,54 +1093,63 @@ async def create_task_callback(callback: types.CallbackQuery):
             return
         task_id = int(callback.data.split("_")[1])
         
-        # Lock для защиты от параллельных операций
-        lock = get_task_lock(task_id)
-        async with lock:
-            # Idempotency: ignore if already open/closed
-            status = await get_task_status(task_id)
+        # Атомарный переход new → open: повторный или параллельный клик ничего не меняет
+        changed, status = await transition_task(task_id, 'new', 'open')
+        if not changed:
             if status == 'open':
                 try:
                     await callback.answer("Задача уже создана", show_alert=True)
                 except:
                     pass
-                return
-            if status == 'closed':
+                await fix_stale_markup(callback, task_id, status)
+            elif status == 'closed':
                 try:
                     await callback.answer("Задача уже закрыта", show_alert=True)
                 except:
                     pass
-                return
-            await set_task_status(task_id, 'open')
-            
-            # Меняем кнопку на "Закрыть задачу"
-            kb = build_task_kb(task_id, 'open')
-            try:
-                await callback.message.edit_reply_markup(reply_markup=kb)
-            except Exception as e:
-                retry_after = _parse_retry_after_seconds(str(e))
-                if retry_after:
-                    await schedule_retry_edit_reply_markup(chat_id, callback.message.message_id, kb, retry_after)
-                logger.warning(f"⚠️ Не удалось обновить кнопку текущего сообщения: {e}")
+                await fix_stale_markup(callback, task_id, status)
+            return
+
+        # Меняем кнопку на "Закрыть задачу"
+        kb = build_task_kb(task_id, 'open')
+        try:
+            await callback.message.edit_reply_markup(reply_markup=kb)
+            await mark_markup_synced(task_id, callback.message.message_id, 'open')
+        except TelegramRetryAfter as e:
+            # Кнопки поправит outbox после паузы Flood control
+            await schedule_markup_sync(chat_id, callback.message.message_id, task_id, delay=e.retry_after + 1)
+            logger.warning(f"⚠️ Не удалось обновить кнопку текущего сообщения: {e}")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить кнопку текущего сообщения: {e}")
+        try:
             await callback.answer("Задача создана ✅", show_alert=False)
-            logger.info(f"✅ Задача #{task_id} принята в работу пользователем @{callback.from_user.username}")
-            
-            # Обновляем закрепленное сообщение
-            await schedule_update_pinned_message(callback.message.chat.id)
+        except:
+            pass
+        logger.info(f"✅ Задача #{task_id} принята в работу пользователем @{callback.from_user.username}")
+        
+        # Обновляем закрепленное сообщение
+        await schedule_update_pinned_message(callback.message.chat.id)
         
-        # Если включены темы — создаём тему и публикуем сообщение (ВНЕ lock!)
-        if await get_topic_enabled(callback.message.chat.id):
-            await create_task_topic_and_post(callback.message.chat.id, task_id, callback.message.message_id)
+        # Если включены темы — создаём тему и публикуем сообщение
+        if await get_topic_enabled(chat_id):
+            await schedule_topic_sync(chat_id, task_id, callback.message.message_id)
         
     except Exception as e:
         logger.error(f"❌ Ошибка при создании задачи: {e}")
-        await callback.answer("❌ Ошибка при создании задачи", show_alert=True)
+        try:
+            await callback.answer("❌ Ошибка при создании задачи", show_alert=True)
+        except:
+            pass
 
 
 # --- НАЖАТИЕ КНОПКИ "ЗАКРЫТЬ ЗАДАЧУ" ---
 @dp.callback_query(F.data.startswith("close_"))
 async def close_task_callback(callback: types.CallbackQuery):
-    # Мгновенный ответ для снятия "часиков"
-    await callback.answer("⏳")
+    # Мгновенный ответ для снятия "часиков"; при Flood control действие выполняется и без него
+    try:
+        await callback.answer("⏳")
+    except TelegramRetryAfter:
+        pass
     
     try:
         chat_id = callback.message.chat.id
@@ -1076,76 +1163,67 @@ async def close_task_callback(callback: types.CallbackQuery):
             return
         task_id = int(callback.data.split("_")[1])
         
-        # Lock для защиты от параллельных операций
-        lock = get_task_lock(task_id)
-        async with lock:
-            chat_id = callback.message.chat.id
-            in_topic = bool(getattr(callback.message, "message_thread_id", None))
-            # Idempotency: ignore if already closed
-            if await get_task_status(task_id) == 'closed':
+        chat_id = callback.message.chat.id
+        in_topic = bool(getattr(callback.message, "message_thread_id", None))
+        # 1) Атомарно закрываем задачу в БД (open → closed)
+        changed, status = await transition_task(task_id, 'open', 'closed')
+        if not changed:
+            if status == 'closed':
                 try:
                     await callback.answer("Уже закрыта", show_alert=True)
                 except:
                     pass
-                return
-
-            # 1) Закрываем задачу в БД
-            await close_task(task_id)
+                await fix_stale_markup(callback, task_id, 'closed')
+            elif status == 'new':
+                await fix_stale_markup(callback, task_id, 'new')
+            return
 
-            # 2) Меняем кнопку на "Переоткрыть"
-            kb_reopen = build_task_kb(task_id, 'closed')
-            
-            # Обновляем кнопку на текущем сообщении (где был клик)
+        # 2) Меняем кнопку на "Переоткрыть"
+        kb_reopen = build_task_kb(task_id, 'closed')
+        
+        # Обновляем кнопку на текущем сообщении (где был клик)
+        try:
+            await callback.message.edit_reply_markup(reply_markup=kb_reopen)
+            await mark_markup_synced(task_id, callback.message.message_id, 'closed')
+            logger.debug(f"✅ Обновлена кнопка на текущем сообщении задачи #{task_id}")
+        except TelegramRetryAfter as e:
+            # Кнопки поправит outbox после паузы Flood control
+            await schedule_markup_sync(chat_id, callback.message.message_id, task_id, delay=e.retry_after + 1)
+            logger.warning(f"⚠️ Не удалось обновить кнопку текущего сообщения: {e}")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить кнопку текущего сообщения: {e}")
+        
+        # Если клик был в теме, обновим также исходное сообщение в общем потоке
+        if in_topic:
             try:
-                await callback.message.edit_reply_markup(reply_markup=kb_reopen)
-                logger.debug(f"✅ Обновлена кнопка на текущем сообщении задачи #{task_id}")
+                orig_msg_id = await get_task_message_id(task_id)
+                if orig_msg_id:
+                    try:
+                        await bot.edit_message_reply_markup(chat_id=chat_id, message_id=orig_msg_id, reply_markup=kb_reopen)
+                        await mark_markup_synced(task_id, orig_msg_id, 'closed')
+                        logger.debug(f"✅ Обновлена кнопка на исходном сообщении задачи #{task_id}")
+                    except TelegramRetryAfter as e:
+                        await schedule_markup_sync(chat_id, orig_msg_id, task_id, delay=e.retry_after + 1)
+                        raise
             except Exception as e:
-                retry_after = _parse_retry_after_seconds(str(e))
-                if retry_after:
-                    await schedule_retry_edit_reply_markup(chat_id, callback.message.message_id, kb_reopen, retry_after)
-                logger.warning(f"⚠️ Не удалось обновить кнопку текущего сообщения: {e}")
-            
-            # Если клик был в теме, обновим также исходное сообщение в общем потоке
-            if in_topic:
-                try:
-                    orig_msg_id = await get_task_message_id(task_id)
-                    if orig_msg_id:
-                        try:
-                            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=orig_msg_id, reply_markup=kb_reopen)
-                            logger.debug(f"✅ Обновлена кнопка на исходном сообщении задачи #{task_id}")
-                        except Exception as e:
-                            retry_after = _parse_retry_after_seconds(str(e))
-                            if retry_after:
-                                await schedule_retry_edit_reply_markup(chat_id, orig_msg_id, kb_reopen, retry_after)
-                            raise
-                except Exception as e:
-                    logger.warning(f"⚠️ Не удалось обновить кнопки исходного сообщения задачи #{task_id}: {e}")
+                logger.warning(f"⚠️ Не удалось обновить кнопки исходного сообщения задачи #{task_id}: {e}")
 
-            # 4) Удаляем тему (если есть)
-            topic_id = await get_task_topic_id(task_id)
-            if topic_id:
-                try:
-                    await bot.delete_forum_topic(chat_id, message_thread_id=topic_id)
-                    await update_task_topic_id(task_id, None)
-                    logger.info(f"🧹 Удалена тема задачи #{task_id} (thread_id={topic_id})")
-                except Exception as e:
-                    logger.warning(f"⚠️ Не удалось удалить тему задачи #{task_id}: {e}")
-
-            # 5) Ответ пользователю и обновление закрепа (всегда, даже если часть шагов не удалась)
-            try:
-                await callback.answer("Задача закрыта ✅", show_alert=False)
-            except:
-                pass
-            try:
-                await schedule_update_pinned_message(chat_id)
-            except Exception as e:
-                logger.warning(f"⚠️ Не удалось обновить закреп: {e}")
+        # 4) Удаляем тему (если есть)
+        if await get_task_topic_id(task_id):
+            await schedule_topic_sync(chat_id, task_id)
 
-            logger.info(f"🔒 Задача #{task_id} закрыта пользователем @{callback.from_user.username}")
-        
-        # Удаление темы вне lock (если нужно)
-        # (уже выполнено внутри lock, оставляем как есть)
+        # 5) Ответ пользователю и обновление закрепа (всегда, даже если часть шагов не удалась)
+        try:
+            await callback.answer("Задача закрыта ✅", show_alert=False)
+        except:
+            pass
+        try:
+            await schedule_update_pinned_message(chat_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить закреп: {e}")
 
+        logger.info(f"🔒 Задача #{task_id} закрыта пользователем @{callback.from_user.username}")
+    
     except Exception as e:
         logger.error(f"❌ Ошибка при закрытии задачи: {e}")
         try:
@@ -1163,8 +1241,11 @@ async def none_callback(callback: types.CallbackQuery):
 # --- НАЖАТИЕ КНОПКИ "ПЕРЕОТКРЫТЬ" ---
 @dp.callback_query(F.data.startswith("reopen_"))
 async def reopen_task_callback(callback: types.CallbackQuery):
-    # Мгновенный ответ для снятия "часиков"
-    await callback.answer("⏳")
+    # Мгновенный ответ для снятия "часиков"; при Flood control действие выполняется и без него
+    try:
+        await callback.answer("⏳")
+    except TelegramRetryAfter:
+        pass
     
     try:
         chat_id = callback.message.chat.id
@@ -1178,65 +1259,59 @@ async def reopen_task_callback(callback: types.CallbackQuery):
             return
         task_id = int(callback.data.split("_")[1])
         
-        # Lock для защиты от параллельных операций
-        lock = get_task_lock(task_id)
-        async with lock:
-            chat_id = callback.message.chat.id
-            # Idempotency: ignore if already open
-            if await get_task_status(task_id) == 'open':
+        chat_id = callback.message.chat.id
+        # Атомарный переход closed → open
+        changed, status = await transition_task(task_id, 'closed', 'open')
+        if not changed:
+            if status == 'open':
                 try:
                     await callback.answer("Уже открыта", show_alert=True)
                 except:
                     pass
-                return
-            await reopen_task(task_id)
+                await fix_stale_markup(callback, task_id, 'open')
+            return
 
-            kb_close = build_task_kb(task_id, 'open')
+        kb_close = build_task_kb(task_id, 'open')
 
-            # Обновляем кнопки на текущем сообщении
-            try:
-                await callback.message.edit_reply_markup(reply_markup=kb_close)
-            except Exception as e:
-                retry_after = _parse_retry_after_seconds(str(e))
-                if retry_after:
-                    await schedule_retry_edit_reply_markup(chat_id, callback.message.message_id, kb_close, retry_after)
-                logger.warning(f"⚠️ Не удалось обновить кнопки текущего сообщения при переоткрытии задачи #{task_id}: {e}")
+        # Обновляем кнопки на текущем сообщении
+        try:
+            await callback.message.edit_reply_markup(reply_markup=kb_close)
+            await mark_markup_synced(task_id, callback.message.message_id, 'open')
+        except TelegramRetryAfter as e:
+            # Кнопки поправит outbox после паузы Flood control
+            await schedule_markup_sync(chat_id, callback.message.message_id, task_id, delay=e.retry_after + 1)
+            logger.warning(f"⚠️ Не удалось обновить кнопки текущего сообщения при переоткрытии задачи #{task_id}: {e}")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить кнопки текущего сообщения при переоткрытии задачи #{task_id}: {e}")
 
-            # Обновляем кнопки на исходном сообщении
-            try:
-                orig_msg_id = await get_task_message_id(task_id)
-                if orig_msg_id:
-                    try:
-                        await bot.edit_message_reply_markup(chat_id=chat_id, message_id=orig_msg_id, reply_markup=kb_close)
-                    except Exception as e:
-                        retry_after = _parse_retry_after_seconds(str(e))
-                        if retry_after:
-                            await schedule_retry_edit_reply_markup(chat_id, orig_msg_id, kb_close, retry_after)
-                        raise
-            except Exception as e:
-                logger.warning(f"⚠️ Не удалось обновить кнопки исходного сообщения при переоткрытии задачи #{task_id}: {e}")
+        # Обновляем кнопки на исходном сообщении
+        try:
+            orig_msg_id = await get_task_message_id(task_id)
+            if orig_msg_id:
+                try:
+                    await bot.edit_message_reply_markup(chat_id=chat_id, message_id=orig_msg_id, reply_markup=kb_close)
+                    await mark_markup_synced(task_id, orig_msg_id, 'open')
+                except TelegramRetryAfter as e:
+                    await schedule_markup_sync(chat_id, orig_msg_id, task_id, delay=e.retry_after + 1)
+                    raise
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить кнопки исходного сообщения при переоткрытии задачи #{task_id}: {e}")
 
-            # Ответ пользователю и обновление закрепа
-            try:
-                await callback.answer("Задача переоткрыта ✅", show_alert=False)
-            except:
-                pass
-            try:
-                await schedule_update_pinned_message(chat_id)
-            except Exception as e:
-                logger.warning(f"⚠️ Не удалось обновить закреп: {e}")
+        # Ответ пользователю и обновление закрепа
+        try:
+            await callback.answer("Задача переоткрыта ✅", show_alert=False)
+        except:
+            pass
+        try:
+            await schedule_update_pinned_message(chat_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить закреп: {e}")
 
-            logger.info(f"🔓 Задача #{task_id} переоткрыта пользователем @{callback.from_user.username}")
+        logger.info(f"🔓 Задача #{task_id} переоткрыта пользователем @{callback.from_user.username}")
         
-        # Если включены темы — создаём новую тему и публикуем копию сообщения (ВНЕ lock!)
+        # Если включены темы — создаём новую тему и публикуем копию исходного сообщения
         if await get_topic_enabled(chat_id):
-            # Используем исходное сообщение (в общем потоке) как источник
-            try:
-                source_msg_id = await get_task_message_id(task_id)
-                if source_msg_id:
-                    await create_task_topic_and_post(chat_id, task_id, source_msg_id)
-            except Exception as e:
-                logger.warning(f"⚠️ Не удалось создать тему при переоткрытии задачи #{task_id}: {e}")
+            await schedule_topic_sync(chat_id, task_id)
 
     except Exception as e:
         logger.error(f"❌ Ошибка при переоткрытии задачи: {e}")
@@ -1247,88 +1322,185 @@ async def reopen_task_callback(callback: types.CallbackQuery):
 
 
 # --- ВОССТАНОВЛЕНИЕ СОСТОЯНИЯ КНОПОК НА СООБЩЕНИЯХ ---
-async def restore_task_buttons():
-    """Восстанавливает корректные кнопки на всех сообщениях задач после перезапуска"""
+async def _restore_task_markup(task_id, chat_id, status, message_id) -> bool:
+    if status not in ('new', 'open', 'closed'):
+        return False
     try:
-        import aiosqlite
-        async with aiosqlite.connect(DB_NAME) as db:
-            # Получаем все задачи с message_id
-            async with db.execute("SELECT id, chat_id, status, message_id FROM tasks WHERE message_id IS NOT NULL") as cursor:
-                tasks = await cursor.fetchall()
-        
-        if not tasks:
-            logger.info("ℹ️ Нет задач с сообщениями для восстановления кнопок")
-            return
-        
-        logger.info(f"🔄 Восстановление кнопок для {len(tasks)} задач...")
-        restored = 0
-        failed = 0
-        
-        for task_id, chat_id, status, message_id in tasks:
+        await bot.edit_message_reply_markup(
+            chat_id=chat_id, message_id=message_id, reply_markup=build_task_kb(task_id, status)
+        )
+    except TelegramForbiddenError:
+        # Бота удалили из чата или заблокировали — кнопки не исправить, повторять незачем
+        pass
+    except TelegramBadRequest as e:
+        # Кнопки уже верные, сообщения или чата больше нет — повторять при следующем запуске незачем
+        error_msg = str(e).lower()
+        if not (
+            "message is not modified" in error_msg
+            or "message to edit not found" in error_msg
+            or "message can't be edited" in error_msg
+            or "message_id_invalid" in error_msg
+            or "chat not found" in error_msg
+        ):
+            raise
+    # Отмечаем и недоступные сообщения: get_stale_markup_tasks больше их не вернёт
+    await mark_markup_synced(task_id, message_id, status)
+    return True
+
+
+@with_priority(PRIORITY_BACKGROUND)
+async def restore_task_buttons():
+    """Досинхронизирует кнопки задач, у которых сохранённая клавиатура устарела.
+
+    Работает в фоне после старта поллинга: задачи читаются из БД страницами
+    и обрабатываются RESTORE_CONCURRENCY воркерами через общий планировщик API.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=RESTORE_CONCURRENCY * 4)
+    counters = {"restored": 0, "failed": 0}
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
             try:
-                # Определяем правильную кнопку в зависимости от статуса
-                if status == 'new':
-                    kb = InlineKeyboardMarkup(
-                        inline_keyboard=[[InlineKeyboardButton(text="📝 Создать задачу", callback_data=f"create_{task_id}")]]
-                    )
-                elif status == 'open':
-                    kb = InlineKeyboardMarkup(
-                        inline_keyboard=[[InlineKeyboardButton(text="✅ Закрыть задачу", callback_data=f"close_{task_id}")]]
-                    )
-                elif status == 'closed':
-                    kb = InlineKeyboardMarkup(
-                        inline_keyboard=[[InlineKeyboardButton(text="♻️ Переоткрыть", callback_data=f"reopen_{task_id}")]]
-                    )
-                else:
-                    continue
-                
-                # Обновляем кнопку на сообщении
-                await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=kb)
-                restored += 1
-                
+                if await _restore_task_markup(*item):
+                    counters["restored"] += 1
             except Exception as e:
-                # Игнорируем ошибки (сообщение могло быть удалено)
-                failed += 1
-                logger.debug(f"⚠️ Не удалось восстановить кнопку для задачи #{task_id}: {e}")
-        
-        logger.info(f"✅ Восстановлено кнопок: {restored}, пропущено: {failed}")
-        
+                # Задача остаётся устаревшей: повторится при следующем запуске или клике
+                counters["failed"] += 1
+                logger.debug(f"⚠️ Не удалось восстановить кнопку для задачи #{item[0]}: {e}")
+
+    workers = [asyncio.create_task(worker()) for _ in range(RESTORE_CONCURRENCY)]
+    try:
+        total = 0
+        after_id = 0
+        while True:
+            rows = await get_stale_markup_tasks(KEYBOARD_VERSION, after_id)
+            if not rows:
+                break
+            if not total:
+                logger.info("🔄 Восстановление устаревших кнопок задач...")
+            for row in rows:
+                if owns_chat(row[1]):
+                    await queue.put(row)
+                    total += 1
+            after_id = rows[-1][0]
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        if total:
+            logger.info(f"✅ Восстановлено кнопок: {counters['restored']}, ошибок: {counters['failed']}")
+        else:
+            logger.info("ℹ️ Все кнопки задач актуальны")
     except Exception as e:
         logger.error(f"❌ Ошибка при восстановлении кнопок: {e}")
+    finally:
+        for task in workers:
+            task.cancel()
 
 
 # --- ИНИЦИАЛИЗАЦИЯ ЗАКРЕПОВ ДЛЯ ВСЕХ ЧАТОВ ---
+async def pin_is_current(chat_id: int) -> bool:
+    """Закреп уже показывает актуальное состояние (проверка только по БД, без запросов к API)"""
+    settings = await get_chat_settings(chat_id)
+    if not settings.pin_message_id or not settings.pin_hash:
+        return False
+    open_tasks, closed_tasks, open_list = await get_stats(chat_id)
+    return text_hash(pin_renderer.render(chat_id, open_tasks, closed_tasks, open_list)) == settings.pin_hash
+
+
 async def init_pins_for_all_chats():
-    """Создает закрепленные сообщения для всех чатов с открытыми задачами"""
+    """Создает или актуализирует закрепы во всех чатах с открытыми задачами.
+
+    Работает в фоне после старта поллинга: PIN_INIT_CONCURRENCY воркеров,
+    случайная пауза до PIN_INIT_JITTER секунд перед каждым чатом, чтобы запросы
+    не уходили пачкой; чаты с актуальным закрепом пропускаются.
+    """
     try:
-        import aiosqlite
-        async with aiosqlite.connect(DB_NAME) as db:
-            # Получаем все уникальные chat_id с открытыми задачами
-            async with db.execute("SELECT DISTINCT chat_id FROM tasks WHERE status='open'") as cursor:
-                chats_with_tasks = [row[0] for row in await cursor.fetchall()]
-        
-        if chats_with_tasks:
-            logger.info(f"📌 Найдено {len(chats_with_tasks)} чатов с открытыми задачами")
-            for chat_id in chats_with_tasks:
-                pin_id = await get_pin_message_id(chat_id)
-                if not pin_id:
-                    logger.info(f"🔄 Создаю закрепленное сообщение для чата {chat_id}")
-                    await update_pinned_message(chat_id)
-                else:
-                    logger.info(f"✅ Закреп уже существует для чата {chat_id} (message_id: {pin_id})")
-                    # Обновляем существующий закреп для актуализации данных
-                    await update_pinned_message(chat_id)
-        else:
+        # Получаем все уникальные chat_id с открытыми задачами
+        chats_with_tasks = [chat_id for chat_id in await get_chat_ids_with_open_tasks() if owns_chat(chat_id)]
+        if not chats_with_tasks:
             logger.info("ℹ️ Нет чатов с открытыми задачами")
-            
+            return
+
+        logger.info(f"📌 Найдено {len(chats_with_tasks)} чатов с открытыми задачами")
+        pending = iter(chats_with_tasks)
+        counters = {"updated": 0, "skipped": 0, "failed": 0}
+
+        async def worker():
+            for chat_id in pending:
+                try:
+                    if await pin_is_current(chat_id):
+                        counters["skipped"] += 1
+                        continue
+                    await asyncio.sleep(random.uniform(0, PIN_INIT_JITTER))
+                    async with get_chat_lock(chat_id):
+                        await update_pinned_message(chat_id)
+                    counters["updated"] += 1
+                except Exception as e:
+                    counters["failed"] += 1
+                    logger.warning(f"⚠️ Не удалось инициализировать закреп в чате {chat_id}: {e}")
+
+        await asyncio.gather(*(worker() for _ in range(PIN_INIT_CONCURRENCY)))
+        logger.info(
+            f"✅ Закрепы: обновлено {counters['updated']}, актуальны {counters['skipped']}, "
+            f"ошибок {counters['failed']}"
+        )
     except Exception as e:
         logger.error(f"❌ Ошибка при инициализации закрепов: {e}")
 
 
+# --- ФОНОВЫЕ ЗАДАЧИ ПОСЛЕ СТАРТА ПОЛЛИНГА ---
+@dp.startup()
+async def on_startup():
+    # Не задерживаем приём апдейтов: сверка закрепов с Telegram (сразу и дальше
+    # раз в PIN_RECONCILE_INTERVAL), досинхронизация кнопок и закрепов идут в фоне
+    start_background(run_pin_reconciliation())
+    start_background(restore_task_buttons())
+    start_background(init_pins_for_all_chats())
+    await broadcast_engine.resume(owns_chat)
+
+
+# --- МЕТРИКИ: СОСТОЯНИЕ КОМПОНЕНТОВ НА МОМЕНТ ОПРОСА ---
+register_stats("pin_scheduler", pin_scheduler.stats)
+register_stats("outbound", outbound.stats)
+register_stats("ingest", ingest_queues.stats)
+register_stats("outbox", outbox.stats)
+register_stats("message_deleter", message_deleter.stats)
+register_stats("member_cache", member_cache.stats)
+register_stats("db_pool", pool_stats)
+register_stats(f"{CHAT_LOCKS.name}_locks", CHAT_LOCKS.stats)
+register_stats("registry", lambda: {
+    "callback_throttle": len(LAST_CB_TS),
+    "pinned_state": len(PINNED_STATE),
+    "reset_confirmations": len(RESET_CONFIRMATIONS),
+    "broadcast_jobs": broadcast_engine.active(),
+})
+if update_recorder is not None:
+    register_stats("recorder", update_recorder.stats)
+
+
 # --- ЗАПУСК ---
-async def main():
+async def main(webhook: bool = False, shards: int = 1):
+    if shards > 1:
+        # Front-процесс: сам апдейты не обрабатывает, а раздаёт их воркерам по chat_id
+        init_db()
+        try:
+            await run_front(bot, dp.resolve_used_update_types(), shards, os.path.abspath(__file__), webhook=webhook)
+        finally:
+            await bot.session.close()
+        return
+    metrics_server = None
     try:
         init_db()
+        # Долгоживущие соединения БД: открываем один раз на всё время работы
+        await init_pool(DB_NAME)
+        metrics_server = await start_metrics_server()
+        chat_user_buffer.start()
+        ingest_queues.start()
+        # Действия, не выполненные до остановки, продолжаются с того же места
+        outbox.start()
         logger.info("=" * 50)
         logger.info("🚀 TaskPinBot запущен!")
         logger.info("=" * 50)
@@ -1341,23 +1513,54 @@ async def main():
         # Регистрируем команды, чтобы при вводе '/' клиенты показывали список
         await setup_bot_commands()
         
-        # Восстанавливаем состояние после перезапуска
-        logger.info("🔄 Восстановление состояния бота...")
-        await restore_task_buttons()
-        await init_pins_for_all_chats()
-        logger.info("✅ Состояние восстановлено, бот готов к работе!")
+        pin_scheduler.start()
+        logger.info("✅ Бот готов к работе, закрепы и кнопки актуализируются в фоне")
         
-        await dp.start_polling(bot, skip_updates=False)
+        # chat_member не приходит по умолчанию — запрашиваем все используемые типы апдейтов
+        allowed_updates = dp.resolve_used_update_types()
+        if webhook:
+            await serve_webhook(dp, bot, allowed_updates)
+        else:
+            # getUpdates не работает, пока зарегистрирован вебхук
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot, skip_updates=False, allowed_updates=allowed_updates)
         
     except Exception as e:
         logger.critical(f"❌ Критическая ошибка при запуске бота: {e}")
         raise
     finally:
+        await stop_background()
+        await ingest_queues.stop()
+        await message_deleter.stop()
+        await broadcast_engine.stop()
+        await outbox.stop()
+        await pin_scheduler.stop()
+        stats = pin_scheduler.stats()
+        logger.info(
+            f"📌 Закрепы: событий {stats['events']}, обновлений {stats['updates']}, объединено {stats['coalesced']}"
+        )
+        stats = message_deleter.stats()
+        logger.info(
+            f"🗑️ Удаление сообщений: пачек {stats['batches']}, удалено {stats['deleted']}, по одному {stats['fallbacks']}"
+        )
+        for name, stats in lock_stats().items():
+            logger.info(
+                f"🔒 Lock'и {name}: захватов {stats['acquisitions']}, с ожиданием {stats['contended']}, "
+                f"максимум живых {stats['max_live']}"
+            )
+        await outbound.close()
+        await bot.session.close()
+        await chat_user_buffer.stop()
+        await close_pool()
+        if update_recorder is not None:
+            update_recorder.close()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
         logger.info("🛑 TaskPinBot остановлен")
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        asyncio.run(main(webhook="--webhook" in sys.argv[1:], shards=shards_from_argv(sys.argv[1:])))
     except KeyboardInterrupt:
         logger.info("⏹️ Бот остановлен пользователем (Ctrl+C)")
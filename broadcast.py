@@ -0,0 +1,247 @@
+"""Рассылки по всем чатам (/announce_all).
+
+Задание и состояние доставки в каждый чат хранятся в БД, поэтому после
+перезапуска рассылка продолжается с того места, где остановилась, а не
+отправляется заново. Доставки идут параллельно несколькими воркерами; лимиты
+Telegram соблюдает общий планировщик исходящих запросов. Flood control
+(RetryAfter) откладывает доставку в конкретный чат, а не считается ошибкой.
+Если статус доставки не удаётся записать в БД, рассылка приостанавливается и
+возобновляется через BROADCAST_RESUME_DELAY: чат не считается обработанным,
+пока это не записано.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from db_async import (
+    BroadcastJob, get_broadcast_job, get_unfinished_broadcast_jobs, get_pending_deliveries,
+    get_broadcast_counts, set_delivery_status, finish_broadcast_job,
+)
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "3"))
+# Сколько раз повторять доставку после сетевых ошибок и ошибок сервера Telegram
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "3"))
+# Через сколько секунд продолжить рассылку, приостановленную из-за ошибки записи в БД
+BROADCAST_RESUME_DELAY = float(os.getenv("BROADCAST_RESUME_DELAY", "60"))
+
+# Итоговые статусы доставки; 'pending' и 'deferred' — ещё в работе
+FINAL_STATUSES = ("sent", "skipped", "failed")
+
+# deliver(job, chat_id) -> True, если отправлено; False — чат пропущен (например, нет прав)
+Deliver = Callable[[BroadcastJob, int], Awaitable[bool]]
+# report(job, counts, finished) — показать прогресс владельцу рассылки
+Report = Callable[[BroadcastJob, Dict[str, int], bool], Awaitable[None]]
+
+
+class BroadcastEngine:
+    def __init__(
+        self,
+        deliver: Deliver,
+        report: Report,
+        concurrency: int = BROADCAST_CONCURRENCY,
+        progress_interval: float = BROADCAST_PROGRESS_INTERVAL,
+        max_attempts: int = BROADCAST_MAX_ATTEMPTS,
+        resume_delay: float = BROADCAST_RESUME_DELAY,
+    ):
+        self._deliver = deliver
+        self._report = report
+        self.concurrency = max(1, concurrency)
+        self.progress_interval = progress_interval
+        self.max_attempts = max(1, max_attempts)
+        self.resume_delay = resume_delay
+        self._jobs: Dict[int, asyncio.Task] = {}
+        # Отложенный перезапуск приостановленных рассылок
+        self._resume_timers: Dict[int, asyncio.TimerHandle] = {}
+
+    def start_job(self, job_id: int):
+        timer = self._resume_timers.pop(job_id, None)
+        if timer is not None:
+            timer.cancel()
+        task = self._jobs.get(job_id)
+        if task is not None and not task.done():
+            return
+        task = asyncio.create_task(self._run(job_id))
+        self._jobs[job_id] = task
+        task.add_done_callback(lambda t: self._jobs.pop(job_id, None) if self._jobs.get(job_id) is t else None)
+
+    async def resume(self, owns_chat: Optional[Callable[[int], bool]] = None):
+        """Продолжить незавершённые рассылки (после перезапуска).
+
+        owns_chat — при шардировании рассылку продолжает только процесс,
+        обслуживающий чат автора рассылки.
+        """
+        for job_id in await get_unfinished_broadcast_jobs():
+            if owns_chat is not None:
+                job = await get_broadcast_job(job_id)
+                if job is None or not owns_chat(job.owner_chat_id):
+                    continue
+            logger.info(f"📢 Продолжаю рассылку #{job_id}")
+            self.start_job(job_id)
+
+    async def stop(self):
+        for timer in self._resume_timers.values():
+            timer.cancel()
+        self._resume_timers.clear()
+        tasks = list(self._jobs.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def active(self) -> int:
+        return len(self._jobs)
+
+    async def _run(self, job_id: int):
+        job = await get_broadcast_job(job_id)
+        if job is None:
+            return
+        counts = await get_broadcast_counts(job_id)
+        queue: asyncio.Queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        # Текущий статус недоставленных чатов и число неудачных попыток
+        states: Dict[int, str] = {}
+        attempts: Dict[int, int] = {}
+        finished = asyncio.Event()
+        # Статус не записался в БД: новые чаты не берём, ждём начатые доставки и останавливаемся
+        halted = False
+        busy = 0
+
+        def enqueue(chat_id: int, not_before):
+            delay = (not_before or 0) - time.time()
+            if delay > 0:
+                loop.call_later(delay, queue.put_nowait, chat_id)
+            else:
+                queue.put_nowait(chat_id)
+
+        def move(chat_id: int, status: str):
+            old = states.pop(chat_id)
+            counts[old] = counts.get(old, 0) - 1
+            counts[status] = counts.get(status, 0) + 1
+            if status in FINAL_STATUSES:
+                if not states:
+                    finished.set()
+            else:
+                states[chat_id] = status
+
+        for chat_id, status, not_before in await get_pending_deliveries(job_id):
+            states[chat_id] = status
+            enqueue(chat_id, not_before)
+        if not states:
+            finished.set()
+
+        async def save(chat_id: int, status: str, error: Optional[str] = None, not_before: Optional[float] = None):
+            """Записать статус доставки; после max_attempts неудач ошибка БД пробрасывается"""
+            for attempt in range(self.max_attempts):
+                try:
+                    await set_delivery_status(job_id, chat_id, status, error, not_before)
+                    return
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if attempt + 1 >= self.max_attempts:
+                        logger.error(f"❌ Рассылка #{job_id}: не удалось сохранить статус {status} чата {chat_id}: {e}")
+                        raise
+                    await asyncio.sleep(2 ** attempt)
+
+        async def defer(chat_id: int, delay: float, reason: str):
+            not_before = time.time() + delay
+            await save(chat_id, "deferred", reason, not_before)
+            move(chat_id, "deferred")
+            enqueue(chat_id, not_before)
+
+        async def deliver(chat_id: int):
+            try:
+                status = "sent" if await self._deliver(job, chat_id) else "skipped"
+                error = None
+            except asyncio.CancelledError:
+                raise
+            except TelegramRetryAfter as e:
+                # Лимит конкретного чата — ждём и повторяем, это не ошибка доставки
+                await defer(chat_id, e.retry_after, f"retry_after={e.retry_after}")
+                return
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempts[chat_id] = attempts.get(chat_id, 0) + 1
+                if attempts[chat_id] < self.max_attempts:
+                    await defer(chat_id, 2 ** attempts[chat_id], str(e))
+                    return
+                status, error = "failed", str(e)
+            except Exception as e:
+                status, error = "failed", str(e)
+            if error:
+                logger.debug(f"📢 Рассылка #{job_id}: не доставлено в чат {chat_id}: {error}")
+            await save(chat_id, status, error)
+            move(chat_id, status)
+
+        async def worker():
+            nonlocal halted, busy
+            while True:
+                chat_id = await queue.get()
+                if halted:
+                    continue
+                busy += 1
+                try:
+                    await deliver(chat_id)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # Ошибки доставки deliver обрабатывает сам — сюда доходят ошибки записи статуса.
+                    # Чат остаётся в прежнем статусе: продвигать его, не записав в БД, нельзя
+                    logger.error(f"❌ Рассылка #{job_id}: ошибка обработки чата {chat_id}: {e}")
+                    halted = True
+                finally:
+                    busy -= 1
+                if halted and not busy:
+                    finished.set()
+
+        async def reporter():
+            last = None
+            while True:
+                await asyncio.sleep(self.progress_interval)
+                snapshot = dict(counts)
+                if snapshot != last:
+                    last = snapshot
+                    await self._safe_report(job, snapshot, False)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        alive = set(workers)
+
+        def on_worker_exit(task: asyncio.Task):
+            # Все воркеры завершились — ждать finished больше некому
+            alive.discard(task)
+            if not alive:
+                finished.set()
+
+        for task in workers:
+            task.add_done_callback(on_worker_exit)
+        progress = asyncio.create_task(reporter())
+        try:
+            await finished.wait()
+        finally:
+            for task in workers + [progress]:
+                task.cancel()
+            await asyncio.gather(*workers, progress, return_exceptions=True)
+        if states:
+            # Рассылка не завершена: задание остаётся в БД и продолжится с сохранённых статусов
+            logger.error(
+                f"❌ Рассылка #{job_id} приостановлена, не обработано чатов {len(states)}. "
+                f"Продолжу через {self.resume_delay:g}s"
+            )
+            await self._safe_report(job, dict(counts), False)
+            self._resume_timers[job_id] = loop.call_later(self.resume_delay, self.start_job, job_id)
+            return
+        await finish_broadcast_job(job_id)
+        counts = await get_broadcast_counts(job_id)
+        logger.info(f"📢 Рассылка #{job_id} завершена: {counts}")
+        await self._safe_report(job, counts, True)
+
+    async def _safe_report(self, job: BroadcastJob, counts: Dict[str, int], finished: bool):
+        try:
+            await self._report(job, counts, finished)
+        except Exception as e:
+            logger.debug(f"Не удалось показать прогресс рассылки #{job.id}: {e}")
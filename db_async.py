@@ -1,183 +1,670 @@
 """Асинхронные функции для работы с БД через aiosqlite"""
+import asyncio
 import aiosqlite
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from datetime import datetime
 import logging
-from typing import Optional, List, Tuple
+import os
+import time
+from typing import Dict, Optional, List, Tuple
+
+from metrics import observe_db_query
 
 logger = logging.getLogger(__name__)
 
 DB_NAME = "tasks.db"
+DB_READERS = int(os.getenv("DB_POOL_SIZE", "3"))
+# Group commit: пачка записей коммитится не реже раза в N мс или по достижении размера
+DB_COMMIT_INTERVAL_MS = float(os.getenv("DB_COMMIT_INTERVAL_MS", "5"))
+DB_COMMIT_BATCH = int(os.getenv("DB_COMMIT_BATCH", "100"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+
+# --- ПУЛ СОЕДИНЕНИЙ ---
+class ConnectionPool:
+    """Пул долгоживущих соединений: несколько читателей и один писатель.
+
+    Каждое соединение aiosqlite держит свой рабочий поток, поэтому открываем их
+    один раз при старте, а запросы лишь забирают готовое соединение из очереди.
+
+    Записи группируются (group commit): каждый блок `async with writer()`
+    выполняется в SAVEPOINT общей транзакции писателя, а фоновая задача
+    коммитит её раз в DB_COMMIT_INTERVAL_MS миллисекунд или сразу после
+    DB_COMMIT_BATCH блоков. Выход из блока происходит только после COMMIT,
+    так что вызывающий код по-прежнему видит свою запись уже сохранённой.
+    """
+
+    def __init__(
+        self,
+        db_name: str = DB_NAME,
+        readers: int = DB_READERS,
+        commit_interval: float = DB_COMMIT_INTERVAL_MS / 1000.0,
+        commit_batch: int = DB_COMMIT_BATCH,
+    ):
+        self.db_name = db_name
+        self.readers_count = max(1, readers)
+        self.commit_interval = commit_interval
+        self.commit_batch = max(1, commit_batch)
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._connections: List[aiosqlite.Connection] = []
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        # Открытая транзакция писателя и блоки, ждущие её COMMIT
+        self._batch_started: Optional[float] = None
+        self._batch_futures: List[asyncio.Future] = []
+        self._batch_pending: Optional[asyncio.Event] = None
+        self._committer: Optional[asyncio.Task] = None
+        self.commits = 0
+        self.units = 0
+        self.max_batch = 0
+
+    async def _connect(self, **kwargs) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_name, **kwargs)
+        # PRAGMA возвращают строку: курсор закрываем сразу, иначе он держит блокировку
+        await (await conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")).close()
+        await (await conn.execute("PRAGMA synchronous=NORMAL")).close()
+        self._connections.append(conn)
+        return conn
+
+    async def open(self):
+        # Транзакциями писателя управляем сами (BEGIN/SAVEPOINT/COMMIT)
+        self._writer = await self._connect(isolation_level=None)
+        await (await self._writer.execute("PRAGMA journal_mode=WAL")).close()
+        for _ in range(self.readers_count):
+            self._readers.put_nowait(await self._connect())
+        self._batch_pending = asyncio.Event()
+        self._committer = asyncio.create_task(self._commit_loop())
+        logger.info(
+            f"🗄️ Открыт пул соединений БД: читателей={self.readers_count}, писатель=1, "
+            f"group commit {self.commit_interval * 1000:g} мс / {self.commit_batch} записей"
+        )
 
-
-# --- ДОБАВЛЕНИЕ ЗАДАЧИ ---
-async def add_task(chat_id, user_id, username, text, message_id=None):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async def close(self):
+        # Коммитим накопленное и дожидаемся текущей записи, чтобы не оборвать транзакцию.
+        # Committer останавливаем под _write_lock: так он не может быть посреди COMMIT,
+        # и пачка, которую он уже забрал, не потеряет своих ожидающих
+        async with self._write_lock:
+            if self._committer is not None:
+                self._committer.cancel()
+                await asyncio.gather(self._committer, return_exceptions=True)
+                self._committer = None
+            await self._commit_batch()
+            for conn in self._connections:
+                try:
+                    await conn.close()
+                except Exception as e:
+                    logger.warning(f"⚠️ Ошибка при закрытии соединения БД: {e}")
+            self._connections.clear()
+            self._writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Единственный писатель: блок атомарен, выход из него — после COMMIT"""
+        async with self._write_lock:
+            if self._batch_started is None:
+                await self._writer.execute("BEGIN IMMEDIATE")
+                self._batch_started = time.monotonic()
+                self._batch_pending.set()
+            await self._writer.execute("SAVEPOINT unit")
+            try:
+                yield self._writer
+            except BaseException:
+                await self._rollback_unit()
+                raise
+            await self._writer.execute("RELEASE unit")
+            future = asyncio.get_running_loop().create_future()
+            self._batch_futures.append(future)
+            self.units += 1
+            if len(self._batch_futures) >= self.commit_batch:
+                await self._commit_batch()
+        await future
+
+    async def _rollback_unit(self):
+        try:
+            await self._writer.execute("ROLLBACK TO unit")
+            await self._writer.execute("RELEASE unit")
+        except Exception as e:
+            # SQLite мог откатить всю транзакцию сам — вместе с ней теряется вся пачка
+            logger.error(f"❌ Откат записи БД не удался, отменяю пачку: {e}")
+            await self._fail_batch(e)
+
+    async def _commit_loop(self):
+        while True:
+            await self._batch_pending.wait()
+            delay = self._batch_started + self.commit_interval - time.monotonic() if self._batch_started else 0
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self._write_lock:
+                await self._commit_batch()
+
+    async def _commit_batch(self):
+        """COMMIT открытой транзакции писателя (вызывается под _write_lock)"""
+        self._batch_pending.clear()
+        if self._batch_started is None:
+            return
+        futures, self._batch_futures = self._batch_futures, []
+        self._batch_started = None
+        try:
+            await self._writer.execute("COMMIT")
+        except Exception as e:
+            logger.error(f"❌ Ошибка COMMIT пачки из {len(futures)} записей: {e}")
+            self._batch_futures = futures
+            await self._fail_batch(e)
+            return
+        except BaseException:
+            # Отмена посреди COMMIT: итог неизвестен, но ожидающие записи не должны зависнуть
+            error = RuntimeError("COMMIT пачки прерван")
+            for future in futures:
+                if not future.done():
+                    future.set_exception(error)
+            raise
+        self.commits += 1
+        self.max_batch = max(self.max_batch, len(futures))
+        for future in futures:
+            if not future.done():
+                future.set_result(None)
+
+    async def _fail_batch(self, error: Exception):
+        futures, self._batch_futures = self._batch_futures, []
+        self._batch_started = None
+        try:
+            await self._writer.execute("ROLLBACK")
+        except Exception:
+            pass
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def stats(self) -> dict:
+        return {
+            "commits": self.commits,
+            "writes": self.units,
+            "max_batch": self.max_batch,
+            "pending": len(self._batch_futures),
+        }
+
+
+_POOL: Optional[ConnectionPool] = None
+
+
+async def init_pool(db_name: str = DB_NAME, readers: int = DB_READERS) -> ConnectionPool:
+    """Создать пул (вызывается один раз в main())"""
+    global _POOL
+    if _POOL is None:
+        pool = ConnectionPool(db_name, readers)
+        await pool.open()
+        _POOL = pool
+    return _POOL
+
+
+async def close_pool():
+    global _POOL
+    if _POOL is not None:
+        pool, _POOL = _POOL, None
+        await pool.close()
+        stats = pool.stats()
+        logger.info(f"🗄️ Пул соединений БД закрыт: записей {stats['writes']}, коммитов {stats['commits']}")
+
+
+def pool_stats() -> dict:
+    """Счётчики group commit пула (пусто, если пул не открыт)"""
+    return _POOL.stats() if _POOL is not None else {}
+
+
+def _get_pool() -> ConnectionPool:
+    if _POOL is None:
+        raise RuntimeError("Пул соединений БД не инициализирован: вызовите init_pool()")
+    return _POOL
+
+
+def _read():
+    return _get_pool().reader()
+
+
+def _write():
+    return _get_pool().writer()
+
+
+# --- СОЗДАНИЕ ЗАДАЧИ ИЗ СООБЩЕНИЯ ---
+@observe_db_query
+async def create_task(chat_id, user_id, username, text) -> Tuple[int, "ChatSettings"]:
+    """Создать задачу сразу в итоговом статусе и вернуть настройки чата.
+
+    Статус берётся из режима чата в той же транзакции ('open' в авто-режиме,
+    иначе 'new'), поэтому задача не может остаться в промежуточном состоянии.
+    """
+    generation = _SETTINGS_GENERATION
+    async with _write() as db:
         cursor = await db.execute(
-            "INSERT INTO tasks (chat_id, user_id, username, text, status, created_at, message_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (chat_id, user_id, username, text, 'new', datetime.now().isoformat(), message_id)
+            "INSERT INTO tasks (chat_id, user_id, username, text, status, created_at) "
+            "VALUES (?, ?, ?, ?, CASE WHEN (SELECT mode FROM chats WHERE chat_id=?)='auto' "
+            "THEN 'open' ELSE 'new' END, ?)",
+            (chat_id, user_id, username, text, chat_id, datetime.now().isoformat())
         )
-        await db.commit()
-        return cursor.lastrowid
+        task_id = cursor.lastrowid
+        async with db.execute(
+            "SELECT pin_message_id, mode, topic_enabled, info_text, current_info_text, pin_hash FROM chats WHERE chat_id=?",
+            (chat_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+    settings = _settings_from_row(chat_id, row)
+    if generation == _SETTINGS_GENERATION:
+        # Строка прочитана под lock'ом писателя — она свежее любой копии в кэше
+        _CHAT_SETTINGS[chat_id] = settings
+    return task_id, settings
 
 
 # --- ОБНОВЛЕНИЕ MESSAGE_ID ЗАДАЧИ ---
-async def update_task_message_id(task_id, message_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE tasks SET message_id=? WHERE id=?", (message_id, task_id))
-        await db.commit()
+@observe_db_query
+async def update_task_message_id(task_id, message_id, markup_version=None, markup_status=None):
+    """Привязать сообщение к задаче; markup_* — клавиатура, с которой оно отправлено"""
+    async with _write() as db:
+        if markup_version is None:
+            await db.execute("UPDATE tasks SET message_id=? WHERE id=?", (message_id, task_id))
+        else:
+            await db.execute(
+                "UPDATE tasks SET message_id=?, markup_version=?, markup_status=? WHERE id=?",
+                (message_id, markup_version, markup_status, task_id)
+            )
 
 
 # --- ПОЛУЧИТЬ MESSAGE_ID ЗАДАЧИ ---
+@observe_db_query
 async def get_task_message_id(task_id):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _read() as db:
         async with db.execute("SELECT message_id FROM tasks WHERE id=?", (task_id,)) as cursor:
             row = await cursor.fetchone()
     return row[0] if row else None
 
 
 # --- ОБНОВЛЕНИЕ TOPIC_ID ЗАДАЧИ ---
+@observe_db_query
 async def update_task_topic_id(task_id, topic_id):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _write() as db:
         await db.execute("UPDATE tasks SET topic_id=? WHERE id=?", (topic_id, task_id))
-        await db.commit()
 
 
+@observe_db_query
 async def get_task_topic_id(task_id):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _read() as db:
         async with db.execute("SELECT topic_id FROM tasks WHERE id=?", (task_id,)) as cursor:
             row = await cursor.fetchone()
     return row[0] if row else None
 
 
-# --- ЗАКРЫТИЕ ЗАДАЧИ ---
-async def close_task(task_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "UPDATE tasks SET status='closed', closed_at=? WHERE id=?",
-            (datetime.now().isoformat(), task_id)
-        )
-        await db.commit()
+# --- АВТОР И ТЕКСТ ЗАДАЧИ ---
+@observe_db_query
+async def get_task_author_and_text(task_id) -> Tuple[Optional[str], Optional[str]]:
+    async with _read() as db:
+        async with db.execute("SELECT username, text FROM tasks WHERE id=?", (task_id,)) as cursor:
+            row = await cursor.fetchone()
+    return (row[0], row[1]) if row else (None, None)
 
 
-async def reopen_task(task_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "UPDATE tasks SET status='open', closed_at=NULL WHERE id=?",
-            (task_id,)
-        )
-        await db.commit()
+# --- ПЕРЕХОДЫ СТАТУСА ЗАДАЧИ ---
+# Разрешённые переходы (из статуса, в статус)
+TASK_TRANSITIONS = {
+    ('new', 'open'),     # «Создать задачу»
+    ('open', 'closed'),  # «Закрыть задачу»
+    ('closed', 'open'),  # «Переоткрыть»
+}
+
 
+@observe_db_query
+async def transition_task(task_id, from_status, to_status) -> Tuple[bool, Optional[str]]:
+    """Compare-and-set статуса: меняет статус, только если он сейчас равен from_status.
 
-# --- УСТАНОВИТЬ СТАТУС ЗАДАЧИ ---
-async def set_task_status(task_id, status):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE tasks SET status=? WHERE id=?", (status, task_id))
-        await db.commit()
+    Возвращает (переход выполнен, текущий статус). Один UPDATE вместо чтения
+    и записи, поэтому повторные клики безопасны и между процессами бота.
+    """
+    if (from_status, to_status) not in TASK_TRANSITIONS:
+        raise ValueError(f"Недопустимый переход статуса задачи: {from_status} → {to_status}")
+    closed_at = datetime.now().isoformat() if to_status == 'closed' else None
+    async with _write() as db:
+        cursor = await db.execute(
+            "UPDATE tasks SET status=?, closed_at=? WHERE id=? AND status=?",
+            (to_status, closed_at, task_id, from_status)
+        )
+        if cursor.rowcount:
+            return True, to_status
+        async with db.execute("SELECT status FROM tasks WHERE id=?", (task_id,)) as cursor:
+            row = await cursor.fetchone()
+    return False, row[0] if row else None
 
 
+@observe_db_query
 async def get_task_status(task_id):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _read() as db:
         async with db.execute("SELECT status FROM tasks WHERE id=?", (task_id,)) as cursor:
             row = await cursor.fetchone()
     return row[0] if row else None
 
 
 # --- ПОЛУЧИТЬ СТАТИСТИКУ ---
+@observe_db_query
 async def get_stats(chat_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT COUNT(*) FROM tasks WHERE chat_id=? AND status='open'", (chat_id,)) as cursor:
-            open_tasks = (await cursor.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM tasks WHERE chat_id=? AND status='closed'", (chat_id,)) as cursor:
-            closed_tasks = (await cursor.fetchone())[0]
-        async with db.execute("SELECT id, username, text, message_id FROM tasks WHERE chat_id=? AND status='open' ORDER BY id ASC", (chat_id,)) as cursor:
-            open_list = await cursor.fetchall()
+    """Счётчики и список открытых задач одним запросом.
+
+    Первая строка — счётчики из chat_task_counters (id IS NULL, поэтому она
+    всегда идёт первой), остальные — открытые задачи по возрастанию id.
+    """
+    async with _read() as db:
+        async with db.execute(
+            """
+            SELECT NULL, open_cnt, closed_cnt, NULL FROM chat_task_counters WHERE chat_id=?
+            UNION ALL
+            SELECT id, username, text, message_id FROM tasks WHERE chat_id=? AND status='open'
+            ORDER BY 1 ASC
+            """,
+            (chat_id, chat_id)
+        ) as cursor:
+            rows = await cursor.fetchall()
+    if rows and rows[0][0] is None:
+        open_tasks, closed_tasks = rows[0][1], rows[0][2]
+        open_list = rows[1:]
+    else:
+        open_tasks, closed_tasks = 0, 0
+        open_list = rows
     return open_tasks, closed_tasks, open_list
 
 
+# --- ЗАДАЧИ ДЛЯ ВОССТАНОВЛЕНИЯ КНОПОК ---
+@observe_db_query
+async def get_stale_markup_tasks(markup_version: int, after_id: int = 0, limit: int = 500):
+    """Задачи, у которых клавиатура на сообщении не соответствует статусу или версии раскладки"""
+    async with _read() as db:
+        async with db.execute(
+            """
+            SELECT id, chat_id, status, message_id FROM tasks
+            WHERE message_id IS NOT NULL AND id > ?
+              AND (markup_version != ? OR markup_status IS NOT status)
+            ORDER BY id ASC
+            LIMIT ?
+            """,
+            (after_id, markup_version, limit)
+        ) as cursor:
+            return await cursor.fetchall()
+
+
+@observe_db_query
+async def mark_task_markup_synced(task_id, message_id, status, markup_version: int):
+    """Запомнить, что на сообщении задачи стоит актуальная клавиатура"""
+    async with _write() as db:
+        await db.execute(
+            "UPDATE tasks SET markup_version=?, markup_status=? WHERE id=? AND message_id=?",
+            (markup_version, status, task_id, message_id)
+        )
+
+
+# --- ЧАТЫ С ОТКРЫТЫМИ ЗАДАЧАМИ ---
+@observe_db_query
+async def get_chat_ids_with_open_tasks() -> List[int]:
+    async with _read() as db:
+        async with db.execute("SELECT DISTINCT chat_id FROM tasks WHERE status='open'") as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+# --- КЭШ НАСТРОЕК ЧАТА ---
+@dataclass
+class ChatSettings:
+    """Строка таблицы chats в памяти (значения по умолчанию — как в схеме)"""
+    chat_id: int
+    pin_message_id: Optional[int] = None
+    mode: str = 'manual'
+    topic_enabled: bool = False
+    info_text: Optional[str] = None
+    current_info_text: Optional[str] = None
+    pin_hash: Optional[str] = None
+
+
+# Настройки меняются только командами /mode_*, /topic_*, /set_info, /set_current_info
+# и через set_* ниже, поэтому горячий путь обработки сообщений читает их из памяти.
+_CHAT_SETTINGS: Dict[int, ChatSettings] = {}
+# Растёт при каждой записи настроек: загрузка, пересёкшаяся с записью, не кэшируется
+_SETTINGS_GENERATION = 0
+
+
+def _settings_from_row(chat_id, row) -> ChatSettings:
+    if row is None:
+        return ChatSettings(chat_id)
+    pin_message_id, mode, topic_enabled, info_text, current_info_text, pin_hash = row
+    return ChatSettings(
+        chat_id=chat_id,
+        pin_message_id=pin_message_id,
+        mode=mode or 'manual',
+        topic_enabled=bool(topic_enabled),
+        info_text=info_text or None,
+        current_info_text=current_info_text or None,
+        pin_hash=pin_hash,
+    )
+
+
+@observe_db_query
+async def _load_chat_settings(chat_id) -> ChatSettings:
+    async with _read() as db:
+        async with db.execute(
+            "SELECT pin_message_id, mode, topic_enabled, info_text, current_info_text, pin_hash FROM chats WHERE chat_id=?",
+            (chat_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return _settings_from_row(chat_id, row)
+
+
+async def get_chat_settings(chat_id) -> ChatSettings:
+    """Настройки чата из кэша; при промахе — одна выборка всей строки chats"""
+    settings = _CHAT_SETTINGS.get(chat_id)
+    if settings is not None:
+        return settings
+    generation = _SETTINGS_GENERATION
+    settings = await _load_chat_settings(chat_id)
+    if generation != _SETTINGS_GENERATION:
+        # Пока шла выборка, настройки менялись — строка могла устареть
+        return settings
+    return _CHAT_SETTINGS.setdefault(chat_id, settings)
+
+
+def _update_cached_settings(chat_id, **fields):
+    global _SETTINGS_GENERATION
+    _SETTINGS_GENERATION += 1
+    settings = _CHAT_SETTINGS.get(chat_id)
+    if settings is None:
+        return
+    for name, value in fields.items():
+        setattr(settings, name, value)
+
+
+def invalidate_chat_settings(chat_id=None):
+    global _SETTINGS_GENERATION
+    _SETTINGS_GENERATION += 1
+    if chat_id is None:
+        _CHAT_SETTINGS.clear()
+    else:
+        _CHAT_SETTINGS.pop(chat_id, None)
+
+
+async def _upsert_chat_fields(chat_id, **fields):
+    columns = list(fields)
+    async with _write() as db:
+        await db.execute(
+            f"INSERT INTO chats (chat_id, {', '.join(columns)}) VALUES (?{', ?' * len(columns)}) "
+            f"ON CONFLICT(chat_id) DO UPDATE SET {', '.join(f'{c}=excluded.{c}' for c in columns)}",
+            (chat_id, *fields.values())
+        )
+
+
+# --- ЧАТЫ С ЗАКРЕПОМ ---
+@observe_db_query
+async def get_chats_with_pins() -> List[Tuple[int, int]]:
+    async with _read() as db:
+        async with db.execute("SELECT chat_id, pin_message_id FROM chats WHERE pin_message_id IS NOT NULL") as cursor:
+            return await cursor.fetchall()
+
+
 # --- ПОЛУЧИТЬ PIN_MESSAGE_ID ИЗ БД ---
 async def get_pin_message_id(chat_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT pin_message_id FROM chats WHERE chat_id=?", (chat_id,)) as cursor:
-            result = await cursor.fetchone()
-    return result[0] if result else None
+    return (await get_chat_settings(chat_id)).pin_message_id
 
 
 # --- СОХРАНИТЬ PIN_MESSAGE_ID В БД ---
-async def save_pin_message_id(chat_id, message_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Сохраняем/обновляем только pin_message_id, не теряя mode
-        async with db.execute("SELECT mode FROM chats WHERE chat_id=?", (chat_id,)) as cursor:
-            row = await cursor.fetchone()
-        if row is None:
-            await db.execute(
-                "INSERT INTO chats (chat_id, pin_message_id, mode) VALUES (?, ?, ?)",
-                (chat_id, message_id, 'manual')
-            )
-        else:
-            await db.execute(
-                "UPDATE chats SET pin_message_id=? WHERE chat_id=?",
-                (message_id, chat_id)
-            )
-        await db.commit()
+@observe_db_query
+async def save_pin_message_id(chat_id, message_id, pin_hash=None):
+    # Сохраняем/обновляем только закреп, не теряя mode; хэш — текст нового закрепа (если известен)
+    await _upsert_chat_fields(chat_id, pin_message_id=message_id, pin_hash=pin_hash)
+    _update_cached_settings(chat_id, pin_message_id=message_id, pin_hash=pin_hash)
 
 
-# --- РЕЖИМЫ ЧАТА ---
-async def get_chat_mode(chat_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT mode FROM chats WHERE chat_id=?", (chat_id,)) as cursor:
-            row = await cursor.fetchone()
-    return row[0] if row and row[0] else 'manual'
+@observe_db_query
+async def save_pin_hash(chat_id, pin_hash):
+    await _upsert_chat_fields(chat_id, pin_hash=pin_hash)
+    _update_cached_settings(chat_id, pin_hash=pin_hash)
 
 
+# --- РЕЖИМЫ ЧАТА ---
+@observe_db_query
 async def set_chat_mode(chat_id, mode):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT chat_id FROM chats WHERE chat_id=?", (chat_id,)) as cursor:
-            exists = await cursor.fetchone() is not None
-        if exists:
-            await db.execute("UPDATE chats SET mode=? WHERE chat_id=?", (mode, chat_id))
-        else:
-            await db.execute("INSERT INTO chats (chat_id, pin_message_id, mode) VALUES (?, ?, ?)", (chat_id, None, mode))
-        await db.commit()
+    await _upsert_chat_fields(chat_id, mode=mode)
+    _update_cached_settings(chat_id, mode=mode or 'manual')
 
 
 # --- ТОГГЛ РЕЖИМА ТЕМ ---
 async def get_topic_enabled(chat_id) -> bool:
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT topic_enabled FROM chats WHERE chat_id=?", (chat_id,)) as cursor:
-            row = await cursor.fetchone()
-    return bool(row[0]) if row else False
+    return (await get_chat_settings(chat_id)).topic_enabled
 
 
+@observe_db_query
 async def set_topic_enabled(chat_id, enabled: bool):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT chat_id FROM chats WHERE chat_id=?", (chat_id,)) as cursor:
-            exists = await cursor.fetchone() is not None
-        val = 1 if enabled else 0
-        if exists:
-            await db.execute("UPDATE chats SET topic_enabled=? WHERE chat_id=?", (val, chat_id))
-        else:
-            await db.execute("INSERT INTO chats (chat_id, pin_message_id, mode, topic_enabled) VALUES (?, ?, ?, ?)", (chat_id, None, 'manual', val))
-        await db.commit()
-
-
-async def upsert_chat_user(chat_id: int, user_id: int, username: Optional[str], full_name: Optional[str]):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            """
-            INSERT INTO chat_users (chat_id, user_id, username, full_name, last_seen)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(chat_id, user_id) DO UPDATE SET
-                username=excluded.username,
-                full_name=excluded.full_name,
-                last_seen=excluded.last_seen
-            """,
-            (chat_id, user_id, username, full_name, datetime.now().isoformat())
-        )
-        await db.commit()
-
-
+    await _upsert_chat_fields(chat_id, topic_enabled=1 if enabled else 0)
+    _update_cached_settings(chat_id, topic_enabled=bool(enabled))
+
+
+# --- ОТЛОЖЕННАЯ ЗАПИСЬ ПОЛЬЗОВАТЕЛЕЙ ЧАТА ---
+CHAT_USERS_FLUSH_INTERVAL = float(os.getenv("CHAT_USERS_FLUSH_INTERVAL", "5"))
+# last_seen используется только для сортировки упоминаний — минутной точности хватает
+LAST_SEEN_RESOLUTION = 60.0
+
+
+class ChatUserBuffer:
+    """Write-behind буфер для chat_users.
+
+    track_user вызывается на каждое сообщение и нажатие кнопки, поэтому вместо
+    отдельного INSERT ... ON CONFLICT на каждый вызов копим изменения в памяти
+    и сбрасываем их пачкой (один executemany, одна транзакция).
+    """
+
+    def __init__(self, interval: float = CHAT_USERS_FLUSH_INTERVAL):
+        self.interval = interval
+        # (chat_id, user_id) -> (username, full_name, last_seen)
+        self._dirty = {}
+        # Что записано в БД за последние LAST_SEEN_RESOLUTION секунд: (chat_id, user_id) -> (username, full_name, last_seen)
+        self._flushed = {}
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    def mark_seen(self, chat_id: int, user_id: int, username: Optional[str], full_name: Optional[str]):
+        now = datetime.now()
+        key = (chat_id, user_id)
+        saved = self._flushed.get(key)
+        if (
+            key not in self._dirty
+            and saved is not None
+            and saved[0] == username
+            and saved[1] == full_name
+            and (now - saved[2]).total_seconds() < LAST_SEEN_RESOLUTION
+        ):
+            return
+        self._dirty[key] = (username, full_name, now)
+
+    def has_pending(self, chat_id: Optional[int] = None) -> bool:
+        if chat_id is None:
+            return bool(self._dirty)
+        return any(key[0] == chat_id for key in self._dirty)
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            rows = [
+                (chat_id, user_id, username, full_name, seen.isoformat())
+                for (chat_id, user_id), (username, full_name, seen) in batch.items()
+            ]
+            try:
+                async with _write() as db:
+                    await db.executemany(
+                        """
+                        INSERT INTO chat_users (chat_id, user_id, username, full_name, last_seen)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                            username=excluded.username,
+                            full_name=excluded.full_name,
+                            last_seen=excluded.last_seen
+                        """,
+                        rows
+                    )
+            except Exception:
+                # Возвращаем несохранённое, не затирая более свежие отметки
+                for key, value in batch.items():
+                    self._dirty.setdefault(key, value)
+                raise
+            self._flushed.update(batch)
+            # Отметки старше LAST_SEEN_RESOLUTION mark_seen всё равно не использует — удаляем,
+            # иначе словарь растёт на каждого пользователя, когда-либо писавшего в чат
+            now = datetime.now()
+            for key in [key for key, saved in self._flushed.items()
+                        if (now - saved[2]).total_seconds() >= LAST_SEEN_RESOLUTION]:
+                del self._flushed[key]
+            logger.debug(f"👥 Сохранено пользователей чатов: {len(rows)}")
+            return len(rows)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось сохранить пользователей чатов: {e}")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновый сброс и записать всё накопленное"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить пользователей чатов при остановке: {e}")
+
+
+chat_user_buffer = ChatUserBuffer()
+
+
+def queue_chat_user(chat_id: int, user_id: int, username: Optional[str], full_name: Optional[str]):
+    chat_user_buffer.mark_seen(chat_id, user_id, username, full_name)
+
+
+@observe_db_query
 async def get_chat_users(chat_id: int) -> List[Tuple[int, Optional[str], Optional[str]]]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    # Недавние участники могут быть ещё в буфере — сначала сбросим их
+    if chat_user_buffer.has_pending(chat_id):
+        await chat_user_buffer.flush()
+    async with _read() as db:
         async with db.execute(
             "SELECT user_id, username, full_name FROM chat_users WHERE chat_id=? ORDER BY last_seen DESC",
             (chat_id,)
@@ -185,8 +672,9 @@ async def get_chat_users(chat_id: int) -> List[Tuple[int, Optional[str], Optiona
             return await cursor.fetchall()
 
 
+@observe_db_query
 async def get_all_chat_ids() -> List[int]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _read() as db:
         chat_ids = set()
         async with db.execute("SELECT DISTINCT chat_id FROM chat_users") as cursor:
             for row in await cursor.fetchall():
@@ -201,49 +689,28 @@ async def get_all_chat_ids() -> List[int]:
 
 
 async def get_chat_info_text(chat_id: int) -> Optional[str]:
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT info_text FROM chats WHERE chat_id=?", (chat_id,)) as cursor:
-            row = await cursor.fetchone()
-    return row[0] if row and row[0] else None
+    return (await get_chat_settings(chat_id)).info_text
 
 
+@observe_db_query
 async def set_chat_info_text(chat_id: int, text: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT chat_id FROM chats WHERE chat_id=?", (chat_id,)) as cursor:
-            exists = await cursor.fetchone() is not None
-        if exists:
-            await db.execute("UPDATE chats SET info_text=? WHERE chat_id=?", (text, chat_id))
-        else:
-            await db.execute(
-                "INSERT INTO chats (chat_id, pin_message_id, mode, topic_enabled, info_text) VALUES (?, ?, ?, ?, ?)",
-                (chat_id, None, 'manual', 0, text)
-            )
-        await db.commit()
+    await _upsert_chat_fields(chat_id, info_text=text)
+    _update_cached_settings(chat_id, info_text=text or None)
 
 
 async def get_chat_current_info_text(chat_id: int) -> Optional[str]:
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT current_info_text FROM chats WHERE chat_id=?", (chat_id,)) as cursor:
-            row = await cursor.fetchone()
-    return row[0] if row and row[0] else None
+    return (await get_chat_settings(chat_id)).current_info_text
 
 
+@observe_db_query
 async def set_chat_current_info_text(chat_id: int, text: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT chat_id FROM chats WHERE chat_id=?", (chat_id,)) as cursor:
-            exists = await cursor.fetchone() is not None
-        if exists:
-            await db.execute("UPDATE chats SET current_info_text=? WHERE chat_id=?", (text, chat_id))
-        else:
-            await db.execute(
-                "INSERT INTO chats (chat_id, pin_message_id, mode, topic_enabled, current_info_text) VALUES (?, ?, ?, ?, ?)",
-                (chat_id, None, 'manual', 0, text)
-            )
-        await db.commit()
+    await _upsert_chat_fields(chat_id, current_info_text=text)
+    _update_cached_settings(chat_id, current_info_text=text or None)
 
 
+@observe_db_query
 async def get_period_stats(chat_id: int, start_iso: str, end_iso: str):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _read() as db:
         async with db.execute(
             "SELECT COUNT(*) FROM tasks WHERE chat_id=? AND created_at>=? AND created_at<=?",
             (chat_id, start_iso, end_iso)
@@ -260,3 +727,164 @@ async def get_period_stats(chat_id: int, start_iso: str, end_iso: str):
         ) as cursor:
             open_now = (await cursor.fetchone())[0]
     return created_cnt, closed_cnt, open_now
+
+
+# --- СБРОС ДАННЫХ ЧАТА ---
+@observe_db_query
+async def reset_chat_data(chat_id: int) -> int:
+    """Удаляет задачи и настройки чата, возвращает число удалённых задач"""
+    async with _write() as db:
+        cursor = await db.execute("DELETE FROM tasks WHERE chat_id=?", (chat_id,))
+        deleted_tasks = cursor.rowcount
+        await db.execute("DELETE FROM chats WHERE chat_id=?", (chat_id,))
+    invalidate_chat_settings(chat_id)
+    return deleted_tasks
+
+
+# --- РАССЫЛКИ ---
+@dataclass
+class BroadcastJob:
+    id: int
+    owner_id: int
+    owner_chat_id: int
+    progress_message_id: Optional[int]
+    text: str
+
+
+@observe_db_query
+async def create_broadcast_job(owner_id: int, owner_chat_id: int, text: str, chat_ids: List[int],
+                               progress_message_id: Optional[int] = None) -> int:
+    """Создать рассылку и строку доставки для каждого чата в одной транзакции"""
+    async with _write() as db:
+        cursor = await db.execute(
+            "INSERT INTO broadcast_jobs (owner_id, owner_chat_id, progress_message_id, text, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (owner_id, owner_chat_id, progress_message_id, text, datetime.now().isoformat())
+        )
+        job_id = cursor.lastrowid
+        await db.executemany(
+            "INSERT OR IGNORE INTO broadcast_deliveries (job_id, chat_id) VALUES (?, ?)",
+            [(job_id, chat_id) for chat_id in chat_ids]
+        )
+    return job_id
+
+
+@observe_db_query
+async def get_broadcast_job(job_id: int) -> Optional[BroadcastJob]:
+    async with _read() as db:
+        async with db.execute(
+            "SELECT id, owner_id, owner_chat_id, progress_message_id, text FROM broadcast_jobs WHERE id=?",
+            (job_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return BroadcastJob(*row) if row else None
+
+
+@observe_db_query
+async def get_unfinished_broadcast_jobs() -> List[int]:
+    async with _read() as db:
+        async with db.execute("SELECT id FROM broadcast_jobs WHERE status='running' ORDER BY id") as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+@observe_db_query
+async def get_pending_deliveries(job_id: int) -> List[Tuple[int, str, Optional[float]]]:
+    """Чаты рассылки, в которые ещё не доставлено: (chat_id, status, not_before)"""
+    async with _read() as db:
+        async with db.execute(
+            "SELECT chat_id, status, not_before FROM broadcast_deliveries "
+            "WHERE job_id=? AND status IN ('pending', 'deferred') ORDER BY chat_id",
+            (job_id,)
+        ) as cursor:
+            return await cursor.fetchall()
+
+
+@observe_db_query
+async def get_broadcast_counts(job_id: int) -> Dict[str, int]:
+    async with _read() as db:
+        async with db.execute(
+            "SELECT status, COUNT(*) FROM broadcast_deliveries WHERE job_id=? GROUP BY status",
+            (job_id,)
+        ) as cursor:
+            return {status: count for status, count in await cursor.fetchall()}
+
+
+@observe_db_query
+async def set_delivery_status(job_id: int, chat_id: int, status: str,
+                              error: Optional[str] = None, not_before: Optional[float] = None):
+    async with _write() as db:
+        await db.execute(
+            "UPDATE broadcast_deliveries SET status=?, error=?, not_before=?, attempts=attempts+1 "
+            "WHERE job_id=? AND chat_id=?",
+            (status, error, not_before, job_id, chat_id)
+        )
+
+
+@observe_db_query
+async def finish_broadcast_job(job_id: int):
+    async with _write() as db:
+        await db.execute(
+            "UPDATE broadcast_jobs SET status='done', finished_at=? WHERE id=?",
+            (datetime.now().isoformat(), job_id)
+        )
+
+
+# --- OUTBOX (ОТЛОЖЕННЫЕ ДЕЙСТВИЯ В TELEGRAM) ---
+@observe_db_query
+async def outbox_put(key: str, kind: str, chat_id: int, payload: str, not_before: float):
+    """Добавить действие; действие с тем же ключом заменяется последним (coalesce)"""
+    async with _write() as db:
+        await db.execute(
+            "INSERT INTO outbox (key, kind, chat_id, payload, not_before, created_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET kind=excluded.kind, chat_id=excluded.chat_id, "
+            "payload=excluded.payload, not_before=excluded.not_before, version=version+1, attempts=0, last_error=NULL",
+            (key, kind, chat_id, payload, not_before, datetime.now().isoformat())
+        )
+
+
+# shard=(номер, число шардов): процесс-шард видит только действия своих чатов
+@observe_db_query
+async def outbox_due(now: float, limit: int = 50, shard: Tuple[int, int] = (0, 1)) -> List[Tuple[int, str, str, int, str, int, int]]:
+    """Действия, время которых пришло: (id, key, kind, chat_id, payload, version, attempts)"""
+    async with _read() as db:
+        async with db.execute(
+            "SELECT id, key, kind, chat_id, payload, version, attempts FROM outbox "
+            "WHERE not_before <= ? AND abs(chat_id) % ? = ? ORDER BY not_before, id LIMIT ?",
+            (now, shard[1], shard[0], limit)
+        ) as cursor:
+            return await cursor.fetchall()
+
+
+@observe_db_query
+async def outbox_next_at(shard: Tuple[int, int] = (0, 1)) -> Optional[float]:
+    async with _read() as db:
+        async with db.execute(
+            "SELECT MIN(not_before) FROM outbox WHERE abs(chat_id) % ? = ?", (shard[1], shard[0])
+        ) as cursor:
+            return (await cursor.fetchone())[0]
+
+
+@observe_db_query
+async def outbox_done(entry_id: int, version: int):
+    """Удалить выполненное действие, если его не успели заменить новым"""
+    async with _write() as db:
+        await db.execute("DELETE FROM outbox WHERE id=? AND version=?", (entry_id, version))
+
+
+@observe_db_query
+async def outbox_retry(entry_id: int, version: int, not_before: float, attempts: int, error: str):
+    async with _write() as db:
+        await db.execute(
+            "UPDATE outbox SET not_before=?, attempts=?, last_error=? WHERE id=? AND version=?",
+            (not_before, attempts, error, entry_id, version)
+        )
+
+
+@observe_db_query
+async def outbox_size(shard: Tuple[int, int] = (0, 1)) -> int:
+    async with _read() as db:
+        async with db.execute(
+            "SELECT COUNT(*) FROM outbox WHERE abs(chat_id) % ? = ?", (shard[1], shard[0])
+        ) as cursor:
+            return (await cursor.fetchone())[0]
+
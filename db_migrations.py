@@ -0,0 +1,247 @@
+"""Версионированные миграции схемы БД.
+
+Текущая версия схемы хранится в таблице schema_version. Каждая миграция
+применяется ровно один раз, по порядку, в отдельной транзакции.
+"""
+import logging
+import sqlite3
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def _columns(c, table):
+    c.execute(f"PRAGMA table_info({table})")
+    return {col[1] for col in c.fetchall()}
+
+
+def _migration_1_base_schema(c):
+    """Базовые таблицы + колонки, которые раньше добавлялись через ALTER TABLE"""
+    c.execute('''CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        user_id INTEGER,
+        username TEXT,
+        text TEXT,
+        status TEXT DEFAULT 'open',
+        created_at TEXT,
+        message_id INTEGER,
+        topic_id INTEGER,
+        closed_at TEXT
+    )''')
+
+    # Таблица для хранения pin_message_id для каждого чата
+    c.execute('''CREATE TABLE IF NOT EXISTS chats (
+        chat_id INTEGER PRIMARY KEY,
+        pin_message_id INTEGER,
+        mode TEXT DEFAULT 'manual',
+        topic_enabled INTEGER DEFAULT 0,
+        info_text TEXT,
+        current_info_text TEXT
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_users (
+        chat_id INTEGER,
+        user_id INTEGER,
+        username TEXT,
+        full_name TEXT,
+        last_seen TEXT,
+        PRIMARY KEY (chat_id, user_id)
+    )''')
+
+    # Базы, созданные старыми версиями бота, могут не иметь части колонок
+    task_columns = _columns(c, "tasks")
+    if 'message_id' not in task_columns:
+        c.execute("ALTER TABLE tasks ADD COLUMN message_id INTEGER")
+    if 'topic_id' not in task_columns:
+        c.execute("ALTER TABLE tasks ADD COLUMN topic_id INTEGER")
+    if 'closed_at' not in task_columns:
+        c.execute("ALTER TABLE tasks ADD COLUMN closed_at TEXT")
+
+    chat_columns = _columns(c, "chats")
+    if 'mode' not in chat_columns:
+        c.execute("ALTER TABLE chats ADD COLUMN mode TEXT DEFAULT 'manual'")
+    if 'topic_enabled' not in chat_columns:
+        c.execute("ALTER TABLE chats ADD COLUMN topic_enabled INTEGER DEFAULT 0")
+    if 'info_text' not in chat_columns:
+        c.execute("ALTER TABLE chats ADD COLUMN info_text TEXT")
+    if 'current_info_text' not in chat_columns:
+        c.execute("ALTER TABLE chats ADD COLUMN current_info_text TEXT")
+
+
+def _migration_2_indexes(c):
+    """Индексы под запросы закрепа, /stats и выборки чатов"""
+    # Счётчики и список открытых задач: WHERE chat_id=? AND status=? ORDER BY id
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tasks_chat_status_id ON tasks (chat_id, status, id)")
+    # /stats: диапазоны по created_at и closed_at внутри чата
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tasks_chat_created ON tasks (chat_id, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tasks_chat_closed ON tasks (chat_id, closed_at)")
+    # Упоминания: WHERE chat_id=? ORDER BY last_seen DESC
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_users_chat_last_seen ON chat_users (chat_id, last_seen)")
+
+
+def _migration_3_task_counters(c):
+    """Счётчики задач по чатам, поддерживаемые триггерами на каждом переходе статуса"""
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_task_counters (
+        chat_id INTEGER PRIMARY KEY,
+        open_cnt INTEGER NOT NULL DEFAULT 0,
+        closed_cnt INTEGER NOT NULL DEFAULT 0,
+        new_cnt INTEGER NOT NULL DEFAULT 0
+    )''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_tasks_counters_insert
+        AFTER INSERT ON tasks
+    BEGIN
+        INSERT OR IGNORE INTO chat_task_counters (chat_id) VALUES (NEW.chat_id);
+        UPDATE chat_task_counters SET
+            open_cnt = open_cnt + (NEW.status = 'open'),
+            closed_cnt = closed_cnt + (NEW.status = 'closed'),
+            new_cnt = new_cnt + (NEW.status = 'new')
+        WHERE chat_id = NEW.chat_id;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_tasks_counters_update
+        AFTER UPDATE OF status, chat_id ON tasks
+        WHEN OLD.status IS NOT NEW.status OR OLD.chat_id IS NOT NEW.chat_id
+    BEGIN
+        UPDATE chat_task_counters SET
+            open_cnt = open_cnt - (OLD.status = 'open'),
+            closed_cnt = closed_cnt - (OLD.status = 'closed'),
+            new_cnt = new_cnt - (OLD.status = 'new')
+        WHERE chat_id = OLD.chat_id;
+        INSERT OR IGNORE INTO chat_task_counters (chat_id) VALUES (NEW.chat_id);
+        UPDATE chat_task_counters SET
+            open_cnt = open_cnt + (NEW.status = 'open'),
+            closed_cnt = closed_cnt + (NEW.status = 'closed'),
+            new_cnt = new_cnt + (NEW.status = 'new')
+        WHERE chat_id = NEW.chat_id;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_tasks_counters_delete
+        AFTER DELETE ON tasks
+    BEGIN
+        UPDATE chat_task_counters SET
+            open_cnt = open_cnt - (OLD.status = 'open'),
+            closed_cnt = closed_cnt - (OLD.status = 'closed'),
+            new_cnt = new_cnt - (OLD.status = 'new')
+        WHERE chat_id = OLD.chat_id;
+    END''')
+    # Заполняем счётчики по уже существующим задачам
+    c.execute("DELETE FROM chat_task_counters")
+    c.execute('''INSERT INTO chat_task_counters (chat_id, open_cnt, closed_cnt, new_cnt)
+        SELECT chat_id,
+               SUM(status = 'open'),
+               SUM(status = 'closed'),
+               SUM(status = 'new')
+        FROM tasks
+        GROUP BY chat_id''')
+
+
+def _migration_4_pin_hash(c):
+    """Хэш последнего отправленного текста закрепа — чтобы не редактировать без изменений"""
+    if 'pin_hash' not in _columns(c, "chats"):
+        c.execute("ALTER TABLE chats ADD COLUMN pin_hash TEXT")
+
+
+def _migration_5_markup_state(c):
+    """Какая клавиатура сейчас стоит на сообщении задачи (версия раскладки и статус)"""
+    task_columns = _columns(c, "tasks")
+    if 'markup_version' not in task_columns:
+        c.execute("ALTER TABLE tasks ADD COLUMN markup_version INTEGER NOT NULL DEFAULT 0")
+    if 'markup_status' not in task_columns:
+        c.execute("ALTER TABLE tasks ADD COLUMN markup_status TEXT")
+
+
+def _migration_6_broadcasts(c):
+    """Рассылки /announce_all: задание и состояние доставки в каждый чат"""
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner_id INTEGER NOT NULL,
+        owner_chat_id INTEGER NOT NULL,
+        progress_message_id INTEGER,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_at TEXT,
+        finished_at TEXT
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+        job_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        not_before REAL,
+        error TEXT,
+        PRIMARY KEY (job_id, chat_id)
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status)")
+
+
+def _migration_7_outbox(c):
+    """Очередь побочных эффектов в Telegram (правки кнопок, удаления, темы, закреп)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT NOT NULL UNIQUE,
+        kind TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 1,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        not_before REAL NOT NULL DEFAULT 0,
+        last_error TEXT,
+        created_at TEXT
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_not_before ON outbox (not_before)")
+
+
+# Порядок важен: номера версий строго возрастают, уже применённые шаги не меняем
+MIGRATIONS = [
+    (1, "базовая схема tasks/chats/chat_users", _migration_1_base_schema),
+    (2, "индексы tasks и chat_users", _migration_2_indexes),
+    (3, "счётчики задач chat_task_counters", _migration_3_task_counters),
+    (4, "хэш текста закрепа chats.pin_hash", _migration_4_pin_hash),
+    (5, "состояние клавиатуры задач tasks.markup_version/markup_status", _migration_5_markup_state),
+    (6, "рассылки broadcast_jobs/broadcast_deliveries", _migration_6_broadcasts),
+    (7, "очередь побочных эффектов outbox", _migration_7_outbox),
+]
+
+
+def get_schema_version(conn) -> int:
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def run_migrations(db_name: str) -> int:
+    """Применить недостающие миграции, вернуть итоговую версию схемы"""
+    conn = sqlite3.connect(db_name)
+    # Управляем транзакциями вручную, чтобы DDL миграции откатывался целиком
+    conn.isolation_level = None
+    try:
+        conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TEXT
+        )''')
+        current = get_schema_version(conn)
+        for version, description, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            # Другой процесс мог успеть применить шаг, пока мы ждали блокировку
+            if get_schema_version(conn) >= version:
+                c.execute("COMMIT")
+                current = version
+                continue
+            try:
+                migrate(c)
+                c.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                    (version, description, datetime.now().isoformat())
+                )
+                c.execute("COMMIT")
+            except Exception:
+                c.execute("ROLLBACK")
+                logger.error(f"❌ Миграция {version} ({description}) не применена")
+                raise
+            current = version
+            logger.info(f"🧱 Применена миграция {version}: {description}")
+        return current
+    finally:
+        conn.close()
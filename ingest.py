@@ -0,0 +1,184 @@
+"""Очереди входящих сообщений по чатам.
+
+У каждого чата своя упорядоченная очередь: сообщения одного чата
+обрабатываются строго по порядку, разные чаты — параллельно общим пулом
+воркеров. Антиспам работает как контроль допуска: сообщению при постановке
+в очередь назначается момент «не раньше» (не чаще одного сообщения
+пользователя в чате за interval секунд), и чат ждёт этого момента в таймере,
+не занимая воркер. Так же чат ждёт, пока у него не появится лимит исходящих
+запросов (ready_at): воркер не простаивает в очереди планировщика запросов.
+Переполненная очередь чата новые сообщения не принимает.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "8"))
+INGEST_QUEUE_LIMIT = int(os.getenv("INGEST_QUEUE_LIMIT", "200"))
+INGEST_USER_INTERVAL = float(os.getenv("INGEST_USER_INTERVAL", "0.8"))
+
+
+class ChatIngestQueues:
+    def __init__(
+        self,
+        process: Callable[[Any], Awaitable[None]],
+        workers: int = INGEST_WORKERS,
+        capacity: int = INGEST_QUEUE_LIMIT,
+        user_interval: float = INGEST_USER_INTERVAL,
+        ready_at: Optional[Callable[[int], float]] = None,
+    ):
+        self._process = process
+        # chat_id -> момент (time.monotonic), когда чату можно отправлять запросы к API
+        self._ready_at = ready_at
+        self.workers_count = max(1, workers)
+        self.capacity = max(1, capacity)
+        self.user_interval = user_interval
+        # chat_id -> очередь (not_before, item); пустые очереди удаляются
+        self._queues: Dict[int, Deque[Tuple[float, Any]]] = {}
+        # (chat_id, user_id) -> момент, раньше которого следующее сообщение не обрабатывается
+        self._not_before: Dict[Tuple[int, int], float] = {}
+        # Чаты, чьё сообщение сейчас обрабатывает воркер
+        self._busy: Set[int] = set()
+        # Чаты, ждущие момента not_before первого сообщения: (due, seq, chat_id)
+        self._delayed: List[Tuple[float, int, int]] = []
+        self._seq = itertools.count()
+        self._ready: Optional[asyncio.Queue] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._last_cleanup = time.monotonic()
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.deferred = 0
+        self.max_depth = 0
+
+    def _ensure_started(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks.append(asyncio.create_task(self._timer()))
+        for _ in range(self.workers_count):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    def start(self):
+        self._ensure_started()
+
+    async def stop(self, drain_timeout: float = 5.0):
+        """Дождаться обработки очередей (не дольше drain_timeout) и остановить воркеры"""
+        if self._tasks and self._queues:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=drain_timeout)
+            except asyncio.TimeoutError:
+                pass
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        left = self.depth()
+        if left:
+            logger.info(f"📥 Остановка: не обработано сообщений {left} в {len(self._queues)} чатах")
+
+    def submit(self, chat_id: int, user_id: int, item: Any) -> bool:
+        """Поставить сообщение в очередь чата; False — очередь переполнена"""
+        self._ensure_started()
+        queue = self._queues.get(chat_id)
+        if queue is not None and len(queue) >= self.capacity:
+            self.rejected += 1
+            return False
+        now = time.monotonic()
+        key = (chat_id, user_id)
+        not_before = max(now, self._not_before.get(key, 0.0) + self.user_interval)
+        self._not_before[key] = not_before
+        self.accepted += 1
+        self._idle.clear()
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            queue.append((not_before, item))
+            self._schedule(chat_id)
+        else:
+            queue.append((not_before, item))
+        self.max_depth = max(self.max_depth, len(queue))
+        return True
+
+    def _schedule(self, chat_id: int):
+        """Чат с непустой очередью: к воркерам сразу или в таймер до not_before"""
+        due = self._queues[chat_id][0][0]
+        if self._ready_at is not None:
+            due = max(due, self._ready_at(chat_id))
+        if due <= time.monotonic():
+            self._ready.put_nowait(chat_id)
+        else:
+            heapq.heappush(self._delayed, (due, next(self._seq), chat_id))
+            self._wakeup.set()
+
+    async def _timer(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._delayed)
+                self._ready.put_nowait(chat_id)
+            if now - self._last_cleanup > 60:
+                self._last_cleanup = now
+                for key in [key for key, at in self._not_before.items() if at < now]:
+                    self._not_before.pop(key, None)
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            queue = self._queues.get(chat_id)
+            if not queue or chat_id in self._busy:
+                continue
+            if self._ready_at is not None and self._ready_at(chat_id) > time.monotonic():
+                # Лимит чата израсходован или чат на паузе Flood control — ждём в таймере, а не в воркере
+                self.deferred += 1
+                self._schedule(chat_id)
+                continue
+            self._busy.add(chat_id)
+            _, item = queue.popleft()
+            try:
+                await self._process(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки сообщения в чате {chat_id}: {e}")
+            finally:
+                self._busy.discard(chat_id)
+                self.processed += 1
+                if queue:
+                    self._schedule(chat_id)
+                else:
+                    self._queues.pop(chat_id, None)
+                    if not self._queues:
+                        self._idle.set()
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self._queues),
+            "queued": self.depth(),
+            "busy": len(self._busy),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "deferred": self.deferred,
+            "max_depth": self.max_depth,
+        }
@@ -0,0 +1,98 @@
+"""Блокировки по ключу (задача, чат, пользователь) без утечки памяти.
+
+Lock для ключа создаётся при первом обращении и удаляется, как только его
+никто не держит и не ждёт, поэтому число живых lock'ов ограничено числом
+одновременно обрабатываемых ключей, а не всеми ключами за время работы бота.
+"""
+import asyncio
+import time
+from typing import Dict, Hashable
+
+
+class _Entry:
+    __slots__ = ("lock", "refs")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.refs = 0
+
+
+class _KeyedLockContext:
+    """Результат KeyedLock(key): используется как `async with`"""
+
+    __slots__ = ("_owner", "_key")
+
+    def __init__(self, owner: "KeyedLock", key: Hashable):
+        self._owner = owner
+        self._key = key
+
+    async def __aenter__(self):
+        await self._owner.acquire(self._key)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._owner.release(self._key)
+
+    def locked(self) -> bool:
+        return self._owner.locked(self._key)
+
+
+class KeyedLock:
+    def __init__(self, name: str = ""):
+        self.name = name
+        self._entries: Dict[Hashable, _Entry] = {}
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+        self.max_live = 0
+
+    def __call__(self, key: Hashable) -> _KeyedLockContext:
+        return _KeyedLockContext(self, key)
+
+    async def acquire(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry()
+            self.max_live = max(self.max_live, len(self._entries))
+        # Ссылку берём до ожидания: ждущий тоже удерживает запись от удаления
+        entry.refs += 1
+        self.acquisitions += 1
+        contended = entry.lock.locked()
+        if contended:
+            self.contended += 1
+        started = time.monotonic()
+        try:
+            # Отмена возможна и без конкуренции (lock.acquire уступает цикл) — ссылку тогда возвращаем
+            await entry.lock.acquire()
+        except BaseException:
+            self._unref(key, entry)
+            raise
+        finally:
+            if contended:
+                self.wait_time += time.monotonic() - started
+
+    def release(self, key: Hashable):
+        entry = self._entries[key]
+        entry.lock.release()
+        self._unref(key, entry)
+
+    def _unref(self, key: Hashable, entry: _Entry):
+        entry.refs -= 1
+        if entry.refs <= 0 and self._entries.get(key) is entry:
+            del self._entries[key]
+
+    def locked(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry.lock.locked()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "live": len(self._entries),
+            "max_live": self.max_live,
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "wait_time": round(self.wait_time, 3),
+        }
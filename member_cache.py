@@ -0,0 +1,123 @@
+"""Кэш прав участников чатов с TTL.
+
+Список администраторов чата загружается одним вызовом get_chat_administrators
+и отвечает и на is_user_admin, и на проверку прав самого бота. Кэш чата
+сбрасывается сразу, как только приходит апдейт my_chat_member / chat_member;
+загрузка, начатая до сброса, в кэш уже не попадает.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.types import ChatMember
+
+logger = logging.getLogger(__name__)
+
+MEMBER_CACHE_TTL = float(os.getenv("MEMBER_CACHE_TTL", "300"))
+ADMIN_STATUSES = ("administrator", "creator")
+
+
+class ChatMemberCache:
+    def __init__(self, bot: Bot, ttl: float = MEMBER_CACHE_TTL):
+        self.bot = bot
+        self.ttl = ttl
+        # chat_id -> (expires_at, {user_id: ChatMember}) или None, если список недоступен
+        self._admins: Dict[int, Tuple[float, Optional[Dict[int, ChatMember]]]] = {}
+        # Запасной путь (личные чаты, ошибки): (chat_id, user_id) -> (expires_at, ChatMember)
+        self._members: Dict[Tuple[int, int], Tuple[float, Optional[ChatMember]]] = {}
+        self._loading: Dict[int, asyncio.Future] = {}
+        # chat_id -> поколение кэша чата (только пока идёт загрузка): invalidate выдаёт новое,
+        # и загрузка, начатая в старом поколении, результат не кэширует
+        self._generations: Dict[int, int] = {}
+        self._generation = itertools.count(1)
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, chat_id: Optional[int] = None):
+        if chat_id is None:
+            self._admins.clear()
+            self._members.clear()
+            self._loading.clear()
+            for key in self._generations:
+                self._generations[key] = next(self._generation)
+            return
+        self._admins.pop(chat_id, None)
+        # Новые запросы не присоединяются к загрузке, начатой до сброса
+        self._loading.pop(chat_id, None)
+        if chat_id in self._generations:
+            self._generations[chat_id] = next(self._generation)
+        for key in [key for key in self._members if key[0] == chat_id]:
+            self._members.pop(key, None)
+
+    async def _load_admins(self, chat_id: int) -> Optional[Dict[int, ChatMember]]:
+        try:
+            admins = await self.bot.get_chat_administrators(chat_id)
+            return {member.user.id: member for member in admins}
+        except Exception as e:
+            # Например, личный чат — там администраторов нет
+            logger.debug(f"Не удалось получить администраторов чата {chat_id}: {e}")
+            return None
+
+    async def get_admins(self, chat_id: int) -> Optional[Dict[int, ChatMember]]:
+        now = time.monotonic()
+        entry = self._admins.get(chat_id)
+        if entry and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        # Параллельные запросы по одному чату ждут одну загрузку
+        pending = self._loading.get(chat_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        generation = self._generations.setdefault(chat_id, next(self._generation))
+        future = asyncio.get_running_loop().create_future()
+        self._loading[chat_id] = future
+        try:
+            admins = await self._load_admins(chat_id)
+            if self._generations.get(chat_id) == generation:
+                self._admins[chat_id] = (time.monotonic() + self.ttl, admins)
+            future.set_result(admins)
+            return admins
+        finally:
+            if self._loading.get(chat_id) is future:
+                del self._loading[chat_id]
+            if chat_id not in self._loading:
+                self._generations.pop(chat_id, None)
+            if not future.done():
+                # Загрузку отменили — ожидающие повторят запрос сами
+                future.cancel()
+
+    async def get_member(self, chat_id: int, user_id: int) -> Optional[ChatMember]:
+        """ChatMember пользователя; None — пользователь не администратор (или неизвестен)"""
+        admins = await self.get_admins(chat_id)
+        if admins is not None:
+            return admins.get(user_id)
+        now = time.monotonic()
+        key = (chat_id, user_id)
+        entry = self._members.get(key)
+        if entry and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+        try:
+            member = await self.bot.get_chat_member(chat_id, user_id)
+        except Exception as e:
+            logger.debug(f"Не удалось получить участника {user_id} чата {chat_id}: {e}")
+            member = None
+        self._members[key] = (time.monotonic() + self.ttl, member)
+        return member
+
+    async def is_admin(self, chat_id: int, user_id: int) -> bool:
+        member = await self.get_member(chat_id, user_id)
+        return getattr(member, "status", "") in ADMIN_STATUSES
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self._admins),
+            "members": len(self._members),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
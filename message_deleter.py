@@ -0,0 +1,108 @@
+"""Пакетное удаление сообщений.
+
+Исходные сообщения пользователей и команды бот удаляет не по одному: id
+копятся по чатам короткое окно (или до 100 штук) и удаляются одним вызовом
+deleteMessages. Если пакет не удалился целиком, каждое сообщение удаляется
+отдельно через fallback (outbox с повторами), и одно «плохое» сообщение
+не мешает удалению остальных.
+
+Накопленные id хранятся только в памяти — это принятое окно потери: при
+аварийном завершении процесса сообщения последних DELETE_WINDOW секунд
+останутся неудалёнными (stop() при обычной остановке удаляет всё сразу).
+Запись каждого id в outbox вернула бы по записи в БД на сообщение, ради
+экономии которой и сделаны пачки.
+"""
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Set
+
+logger = logging.getLogger(__name__)
+
+# Окно (с), за которое копятся сообщения чата перед удалением
+DELETE_WINDOW = float(os.getenv("DELETE_WINDOW", "1.0"))
+# Лимит Telegram на число сообщений в одном deleteMessages
+DELETE_BATCH_LIMIT = 100
+
+# delete_batch(chat_id, message_ids) — удалить пачку одним запросом
+DeleteBatch = Callable[[int, List[int]], Awaitable[None]]
+# fallback(chat_id, message_id) — удалить одно сообщение (с повторами)
+DeleteOne = Callable[[int, int], Awaitable[None]]
+
+
+class MessageDeleter:
+    def __init__(
+        self,
+        delete_batch: DeleteBatch,
+        fallback: DeleteOne,
+        window: float = DELETE_WINDOW,
+        batch_size: int = DELETE_BATCH_LIMIT,
+    ):
+        self._delete_batch = delete_batch
+        self._fallback = fallback
+        self.window = window
+        self.batch_size = max(1, min(batch_size, DELETE_BATCH_LIMIT))
+        # chat_id -> id сообщений, ждущих удаления
+        self._pending: Dict[int, List[int]] = {}
+        self._timers: Dict[int, asyncio.TimerHandle] = {}
+        self._flushing: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.deleted = 0
+        self.fallbacks = 0
+        self.max_batch = 0
+
+    def add(self, chat_id: int, message_id: int):
+        """Поставить сообщение на удаление (без ожидания)"""
+        ids = self._pending.setdefault(chat_id, [])
+        if message_id in ids:
+            return
+        ids.append(message_id)
+        if len(ids) >= self.batch_size:
+            self._flush(chat_id)
+        elif chat_id not in self._timers:
+            loop = asyncio.get_running_loop()
+            self._timers[chat_id] = loop.call_later(self.window, self._flush, chat_id)
+
+    def _flush(self, chat_id: int):
+        timer = self._timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+        ids = self._pending.pop(chat_id, None)
+        if not ids:
+            return
+        task = asyncio.create_task(self._delete(chat_id, sorted(ids)))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _delete(self, chat_id: int, ids: List[int]):
+        try:
+            await self._delete_batch(chat_id, ids)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось удалить пачку из {len(ids)} сообщений в чате {chat_id}: {e}. Удаляю по одному")
+            self.fallbacks += len(ids)
+            for message_id in ids:
+                try:
+                    await self._fallback(chat_id, message_id)
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось поставить на удаление сообщение {message_id}: {e}")
+            return
+        self.batches += 1
+        self.deleted += len(ids)
+        self.max_batch = max(self.max_batch, len(ids))
+        logger.debug(f"🗑️ Удалено сообщений в чате {chat_id}: {len(ids)}")
+
+    async def stop(self):
+        """Удалить всё накопленное, не дожидаясь окна"""
+        for chat_id in list(self._pending):
+            self._flush(chat_id)
+        if self._flushing:
+            await asyncio.wait(self._flushing, timeout=5)
+
+    def stats(self) -> dict:
+        return {
+            "pending": sum(len(ids) for ids in self._pending.values()),
+            "batches": self.batches,
+            "deleted": self.deleted,
+            "fallbacks": self.fallbacks,
+            "max_batch": self.max_batch,
+        }
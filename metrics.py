@@ -0,0 +1,184 @@
+"""Метрики Prometheus на локальном эндпоинте /metrics.
+
+- время обработчиков апдейтов (по имени функции-обработчика);
+- запросы к Telegram по методу и результату, значения retry_after при Flood control;
+- время запросов к БД (по функции db_async);
+- обновления закрепов: запланировано и фактически отправлено;
+- размеры структур в памяти и счётчики компонентов — из их stats() на момент опроса.
+
+Сервер работает в том же event loop, что и бот, поэтому stats() читаются без гонок.
+"""
+import functools
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError,
+)
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 — эндпоинт выключен; при шардировании воркер i слушает METRICS_PORT+1+i
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+HANDLER_SECONDS = Histogram(
+    "taskpin_handler_seconds", "Время обработки апдейта обработчиком", ["handler"]
+)
+TELEGRAM_CALLS = Counter(
+    "taskpin_telegram_calls_total", "Запросы к Bot API по методу и результату", ["method", "outcome"]
+)
+TELEGRAM_SECONDS = Histogram(
+    "taskpin_telegram_call_seconds", "Время запроса к Bot API", ["method"]
+)
+TELEGRAM_RETRY_AFTER = Histogram(
+    "taskpin_telegram_retry_after_seconds", "retry_after из ответов Flood control", ["method"],
+    buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+DB_SECONDS = Histogram(
+    "taskpin_db_query_seconds", "Время запроса к БД", ["query"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+PIN_UPDATES = Counter(
+    "taskpin_pin_updates_total",
+    "Результат обновления закрепа: edited/created — отправлено, unchanged/not_modified — запрос не нужен, "
+    "deferred — Flood control, failed — ошибка",
+    ["result"],
+)
+
+
+def observe_handler(name: str):
+    """Декоратор: время корутины в taskpin_handler_seconds{handler=name}"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def observe_db_query(func):
+    """Обёртка функции db_async: время в taskpin_db_query_seconds{query=<имя функции>}"""
+    histogram = DB_SECONDS.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+    return wrapper
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware aiogram: время каждого обработчика по имени его функции"""
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any, data: Dict[str, Any]):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+
+class TelegramCallMetrics:
+    """Middleware сессии бота: каждый HTTP-запрос к Bot API, включая повторы после Flood control.
+
+    Регистрируется после планировщика исходящих запросов, чтобы видеть
+    фактические запросы, а не вызовы из кода.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        outcome = "ok"
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            outcome = "flood"
+            TELEGRAM_RETRY_AFTER.labels(name).observe(e.retry_after)
+            raise
+        except TelegramBadRequest:
+            outcome = "bad_request"
+            raise
+        except TelegramForbiddenError:
+            outcome = "forbidden"
+            raise
+        except TelegramNetworkError:
+            outcome = "network"
+            raise
+        except TelegramServerError:
+            outcome = "server"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            TELEGRAM_CALLS.labels(name, outcome).inc()
+            TELEGRAM_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+
+class _StatsCollector:
+    """Экспорт stats() компонентов как gauge taskpin_<компонент>_<поле> на момент опроса"""
+
+    def __init__(self):
+        self._sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def add(self, name: str, stats: Callable[[], Dict[str, Any]]):
+        self._sources[name] = stats
+
+    def collect(self):
+        for name, stats in self._sources.items():
+            try:
+                values = stats()
+            except Exception as e:
+                logger.debug(f"Метрики: не удалось получить stats() {name}: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                yield GaugeMetricFamily(f"taskpin_{name}_{key}", f"{name}: {key}", value=value)
+
+
+_stats = _StatsCollector()
+REGISTRY.register(_stats)
+
+
+def register_stats(name: str, stats: Callable[[], Dict[str, Any]]):
+    """Публиковать числовые поля stats() компонента (stats вызывается при каждом опросе)"""
+    _stats.add(name, stats)
+
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Optional[web.AppRunner]:
+    """Запустить /metrics; None — выключено или порт занят (бот работает и без метрик)"""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.warning(f"⚠️ Не удалось запустить эндпоинт метрик на {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"📈 Метрики: http://{host}:{port}/metrics")
+    return runner
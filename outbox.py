@@ -0,0 +1,174 @@
+"""Надёжная очередь побочных эффектов в Telegram (outbox).
+
+Действия, которые не обязаны выполняться прямо в обработчике (удаление
+сообщения, правка кнопок после Flood control, темы задач),
+записываются в таблицу outbox и выполняются одним диспетчером. Действия с
+одинаковым ключом схлопываются до последнего, ошибки повторяются с
+backoff, а после перезапуска диспетчер продолжает с того места, где
+остановился.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from db_async import outbox_put, outbox_due, outbox_next_at, outbox_done, outbox_retry, outbox_size
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# Потолок паузы между повторами (с)
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "300"))
+# Пауза (с) перед повтором действия, итог которого не удалось записать в БД
+OUTBOX_STORE_ERROR_PAUSE = 5.0
+
+# handler(chat_id, payload) — выполнить действие; исключение означает «повторить позже»
+Handler = Callable[[int, dict], Awaitable[None]]
+
+
+class Outbox:
+    def __init__(
+        self,
+        concurrency: int = OUTBOX_CONCURRENCY,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        max_backoff: float = OUTBOX_MAX_BACKOFF,
+        shard: Tuple[int, int] = (0, 1),
+    ):
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.max_backoff = max_backoff
+        # (номер, число шардов): при шардировании каждый процесс выполняет действия только своих чатов
+        self.shard = shard
+        self._handlers: Dict[str, Handler] = {}
+        # Ключи, которые сейчас выполняются: одно действие не запускается дважды
+        self._in_flight: Set[str] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+        self.done = 0
+        self.retried = 0
+        self.dropped = 0
+        self.store_errors = 0
+
+    def handler(self, kind: str):
+        """Декоратор: зарегистрировать исполнителя действий вида kind"""
+        def decorator(func: Handler) -> Handler:
+            self._handlers[kind] = func
+            return func
+        return decorator
+
+    def _ensure_started(self):
+        if self._dispatcher is not None and not self._dispatcher.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    def start(self):
+        self._ensure_started()
+
+    async def stop(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        # Начатые действия доводим до конца: иначе они повторятся после перезапуска
+        if self._running:
+            await asyncio.wait(self._running, timeout=5)
+        left = await outbox_size(self.shard)
+        if left:
+            logger.info(f"📤 Остановка: в outbox осталось действий {left}, выполню после запуска")
+
+    async def enqueue(self, kind: str, key: str, chat_id: int, payload: Optional[dict] = None, delay: float = 0):
+        """Записать действие; более раннее действие с тем же key заменяется этим"""
+        if kind not in self._handlers:
+            raise ValueError(f"Неизвестный вид действия outbox: {kind}")
+        await outbox_put(key, kind, chat_id, json.dumps(payload or {}), time.time() + max(0.0, delay))
+        self._ensure_started()
+        self._wakeup.set()
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            due = [row for row in await outbox_due(time.time(), shard=self.shard) if row[1] not in self._in_flight]
+            for row in due:
+                await self._slots.acquire()
+                self._in_flight.add(row[1])
+                task = asyncio.create_task(self._execute(*row))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+            if due:
+                continue
+            # Всё готовое уже выполняется — ждём завершения или срока следующего действия
+            next_at = await outbox_next_at(self.shard)
+            now = time.time()
+            timeout = next_at - now if next_at is not None and next_at > now else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, entry_id: int, key: str, kind: str, chat_id: int, payload: str, version: int, attempts: int):
+        try:
+            handler = self._handlers.get(kind)
+            if handler is None:
+                # Вид действия больше не поддерживается (запись от прежней версии бота)
+                self.dropped += 1
+                logger.warning(f"⚠️ Outbox {kind} ({key}) отменено: неизвестный вид действия")
+                await self._store(kind, key, outbox_done(entry_id, version))
+                return
+            await handler(chat_id, json.loads(payload))
+        except TelegramRetryAfter as e:
+            # Flood control — не ошибка действия: ждём и повторяем без учёта попытки
+            self.retried += 1
+            await self._store(kind, key, outbox_retry(entry_id, version, time.time() + e.retry_after, attempts, str(e)))
+        except (TelegramBadRequest, TelegramForbiddenError) as e:
+            # Повтор не поможет (сообщения нет, нет прав и т.п.)
+            self.dropped += 1
+            logger.warning(f"⚠️ Outbox {kind} ({key}) отменено: {e}")
+            await self._store(kind, key, outbox_done(entry_id, version))
+        except Exception as e:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                self.dropped += 1
+                logger.error(f"❌ Outbox {kind} ({key}) не выполнено за {attempts} попыток: {e}")
+                await self._store(kind, key, outbox_done(entry_id, version))
+            else:
+                self.retried += 1
+                backoff = min(self.max_backoff, 2 ** attempts)
+                logger.warning(f"⚠️ Outbox {kind} ({key}): {e}. Повтор через {backoff:g}s")
+                await self._store(kind, key, outbox_retry(entry_id, version, time.time() + backoff, attempts, str(e)))
+        else:
+            self.done += 1
+            await self._store(kind, key, outbox_done(entry_id, version))
+        finally:
+            self._in_flight.discard(key)
+            self._slots.release()
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    async def _store(self, kind: str, key: str, write: Awaitable[None]):
+        """Записать итог действия; ошибка БД не должна теряться вместе с задачей исполнителя"""
+        try:
+            await write
+        except Exception as e:
+            self.store_errors += 1
+            logger.error(f"❌ Outbox {kind} ({key}): не удалось записать итог действия в БД: {e}")
+            # Строка осталась прежней и уже «пора» — без паузы диспетчер сразу взял бы её снова.
+            # Пока ждём, ключ числится выполняемым и не запускается повторно
+            await asyncio.sleep(min(self.max_backoff, OUTBOX_STORE_ERROR_PAUSE))
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "done": self.done,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "store_errors": self.store_errors,
+        }
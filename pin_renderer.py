@@ -0,0 +1,94 @@
+"""Сборка текста закреплённого сообщения.
+
+Строки задач кэшируются (экранирование и ссылка считаются один раз на задачу),
+а итоговый текст укладывается в лимит Telegram: лишние задачи отбрасываются
+детерминированно с хвостом «…и ещё N».
+"""
+import hashlib
+import html
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Лимит текста сообщения Telegram (считается после разбора HTML, в UTF-16)
+PIN_TEXT_LIMIT = 4096
+
+
+def visible_length(text: str) -> int:
+    """Длина видимого текста так, как её считает Telegram (UTF-16 code units)"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class PinRenderer:
+    def __init__(self, link_builder: Callable[[int, int], str], limit: int = PIN_TEXT_LIMIT):
+        self._link = link_builder
+        self.limit = limit
+        # chat_id -> {task_id: ((username, text, message_id), html_tail, visible_tail)}
+        self._lines: Dict[int, Dict[int, Tuple[tuple, str, int]]] = {}
+
+    def _task_tail(self, chat_id: int, cache: dict, new_cache: dict, task) -> Tuple[str, int]:
+        task_id, username, text, message_id = task
+        key = (username, text, message_id)
+        cached = cache.get(task_id)
+        if cached is None or cached[0] != key:
+            name = username if username else "Аноним"
+            preview = (text or "(пусто)")[:60]
+            name_html = html.escape(name)
+            preview_html = html.escape(preview)
+            if message_id:
+                link = self._link(chat_id, message_id)
+                tail = f"<a href=\"{link}\"><i>{preview_html}</i></a> — @{name_html}"
+            else:
+                tail = f"<i>{preview_html}</i> — @{name_html}"
+            cached = (key, tail, visible_length(f"{preview} — @{name}"))
+        new_cache[task_id] = cached
+        return cached[1], cached[2]
+
+    def render(self, chat_id: int, open_tasks: int, closed_tasks: int, open_list: List[tuple]) -> str:
+        header = [
+            "<b>📋 Статистика задач</b>",
+            "",
+            f"🔴 Открыто: {open_tasks} | ✅ Закрыто: {closed_tasks}",
+            "",
+        ]
+        header_visible = [
+            "📋 Статистика задач",
+            "",
+            f"🔴 Открыто: {open_tasks} | ✅ Закрыто: {closed_tasks}",
+            "",
+        ]
+        if not open_tasks:
+            self._lines.pop(chat_id, None)
+            return "\n".join(header)
+
+        header.append("<b>🧾 Открытые задачи:</b>")
+        header.append("")
+        header_visible.append("🧾 Открытые задачи:")
+        header_visible.append("")
+        used = visible_length("\n".join(header_visible))
+
+        cache = self._lines.get(chat_id, {})
+        new_cache = {}
+        lines = []
+        total = len(open_list)
+        for idx, task in enumerate(open_list, 1):
+            tail_html, tail_visible = self._task_tail(chat_id, cache, new_cache, task)
+            prefix = f"• {idx}. "
+            line_visible = 1 + visible_length(prefix) + tail_visible  # +1 за перевод строки
+            # Оставляем место под хвост «…и ещё N», если это не последняя задача
+            reserve = 0 if idx == total else visible_length(f"\n…и ещё {total - idx + 1}")
+            if used + line_visible + reserve > self.limit:
+                lines.append(f"…и ещё {total - idx + 1}")
+                break
+            lines.append(prefix + tail_html)
+            used += line_visible
+        self._lines[chat_id] = new_cache
+        return "\n".join(header + lines)
+
+    def forget(self, chat_id: Optional[int] = None):
+        if chat_id is None:
+            self._lines.clear()
+        else:
+            self._lines.pop(chat_id, None)
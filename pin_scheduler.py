@@ -0,0 +1,137 @@
+"""Отложенное обновление закрепов с ограничением задержки.
+
+Каждое событие лишь помечает чат «грязным». Закреп обновляется, когда в чате
+наступила пауза (quiet) или когда с первого необработанного события прошло
+max_wait секунд — при непрерывном потоке событий закреп не зависает.
+Чат без лимита исходящих запросов (ready_at) тоже ждёт в таймере, а не в воркере.
+Обслуживают все чаты один таймер и небольшой пул воркеров.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PIN_QUIET_PERIOD = float(os.getenv("PIN_QUIET_PERIOD", "3"))
+PIN_MAX_STALENESS = float(os.getenv("PIN_MAX_STALENESS", "10"))
+PIN_WORKERS = int(os.getenv("PIN_WORKERS", "4"))
+
+
+class _DirtyChat:
+    __slots__ = ("first_at", "last_at", "not_before", "events")
+
+    def __init__(self, now: float):
+        self.first_at = now
+        self.last_at = now
+        self.not_before = 0.0
+        self.events = 0
+
+    def due_at(self, quiet: float, max_wait: float) -> float:
+        return max(min(self.last_at + quiet, self.first_at + max_wait), self.not_before)
+
+
+class PinUpdateScheduler:
+    def __init__(
+        self,
+        update: Callable[[int], Awaitable[None]],
+        quiet: float = PIN_QUIET_PERIOD,
+        max_wait: float = PIN_MAX_STALENESS,
+        workers: int = PIN_WORKERS,
+        ready_at: Optional[Callable[[int], float]] = None,
+    ):
+        self._update = update
+        # chat_id -> момент (time.monotonic), когда чату можно отправлять запросы к API
+        self._ready_at = ready_at
+        self.quiet = quiet
+        self.max_wait = max(max_wait, quiet)
+        self.workers_count = max(1, workers)
+        self._dirty: Dict[int, _DirtyChat] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.events = 0
+        self.updates = 0
+        self.coalesced = 0
+
+    def _ensure_started(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._tasks.append(asyncio.create_task(self._timer()))
+        for _ in range(self.workers_count):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    def start(self):
+        self._ensure_started()
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._dirty:
+            logger.info(f"📌 Остановка: не обновлены закрепы в {len(self._dirty)} чатах")
+
+    def mark_dirty(self, chat_id: int, delay: Optional[float] = None):
+        """Отметить, что закреп чата устарел; delay — не раньше чем через N секунд"""
+        self._ensure_started()
+        now = time.monotonic()
+        entry = self._dirty.get(chat_id)
+        if entry is None:
+            entry = self._dirty[chat_id] = _DirtyChat(now)
+        entry.last_at = now
+        entry.events += 1
+        if delay:
+            entry.not_before = max(entry.not_before, now + delay)
+        self.events += 1
+        self._wakeup.set()
+
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    async def _timer(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            next_at = float("inf")
+            for chat_id, entry in list(self._dirty.items()):
+                at = entry.due_at(self.quiet, self.max_wait)
+                if at <= now and self._ready_at is not None:
+                    at = self._ready_at(chat_id)
+                if at <= now:
+                    del self._dirty[chat_id]
+                    self._ready.put_nowait((chat_id, entry.events))
+                else:
+                    next_at = min(next_at, at)
+            if next_at == float("inf"):
+                await self._wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, next_at - now))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            chat_id, events = await self._ready.get()
+            self.updates += 1
+            self.coalesced += events - 1
+            if events > 1:
+                logger.debug(f"📌 Закреп чата {chat_id}: объединено событий {events}")
+            try:
+                await self._update(chat_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка отложенного обновления закрепа для чата {chat_id}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "events": self.events,
+            "updates": self.updates,
+            "coalesced": self.coalesced,
+            "pending": len(self._dirty),
+        }
@@ -0,0 +1,113 @@
+"""Запись входящих апдейтов в журнал для воспроизведения (benchmarks/replay.py).
+
+Включается переменной RECORD_UPDATES=путь: каждый апдейт до обработки
+дописывается в JSONL-журнал строкой {"t": время получения, "update": {...}}.
+Путь с окончанием .gz — журнал сжимается gzip. Запись не мешает обработке:
+ошибка записи только пишется в лог, апдейт обрабатывается как обычно.
+
+В журнал попадают тексты сообщений и данные пользователей — храните его
+так же, как базу бота.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from sharding import SHARD_COUNT, SHARD_INDEX
+
+logger = logging.getLogger(__name__)
+
+# Путь журнала; пусто — запись выключена
+RECORD_UPDATES = os.getenv("RECORD_UPDATES", "")
+# Как часто (с) буфер журнала сбрасывается на диск
+RECORD_FLUSH_INTERVAL = float(os.getenv("RECORD_FLUSH_INTERVAL", "1.0"))
+
+
+def journal_path(path: str, shard_index: int = SHARD_INDEX, shard_count: int = SHARD_COUNT) -> str:
+    """При шардировании каждый воркер пишет свой файл: updates.jsonl -> updates.shard1.jsonl"""
+    if shard_count <= 1:
+        return path
+    gz = ".gz" if path.endswith(".gz") else ""
+    base, ext = os.path.splitext(path[: len(path) - len(gz)])
+    return f"{base}.shard{shard_index}{ext}{gz}"
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def read_journal(path: str) -> Iterator[Dict[str, Any]]:
+    """Записи журнала по порядку; оборванная последняя строка (бот остановлен аварийно) пропускается"""
+    with _open(path, "r") as journal:
+        try:
+            for line in journal:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"⚠️ Пропущена повреждённая строка журнала {path}")
+        except EOFError:
+            # Недописанный блок gzip в конце файла
+            logger.warning(f"⚠️ Журнал {path} оборван, прочитано до места обрыва")
+
+
+class UpdateRecorder(BaseMiddleware):
+    """Outer-middleware dp.update: дописывает каждый апдейт в журнал перед обработкой"""
+
+    def __init__(self, path: str, flush_interval: float = RECORD_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._journal = None
+        self._flush_timer: Optional[asyncio.TimerHandle] = None
+        self.recorded = 0
+        self.failed = 0
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Update, data: Dict[str, Any]):
+        self.record(event)
+        return await handler(event, data)
+
+    def record(self, update: Update):
+        try:
+            if self._journal is None:
+                # Файл открывается при первом апдейте: front-процесс при шардировании пустой журнал не создаёт
+                self._journal = _open(self.path, "a")
+                logger.info(f"📼 Запись апдейтов в {self.path}")
+            raw = update.model_dump(mode="json", exclude_unset=True, by_alias=True)
+            self._journal.write(json.dumps({"t": round(time.time(), 3), "update": raw},
+                                           ensure_ascii=False, separators=(",", ":")) + "\n")
+            self.recorded += 1
+        except Exception as e:
+            self.failed += 1
+            if self.failed == 1:
+                logger.warning(f"⚠️ Не удалось записать апдейт в журнал {self.path}: {e}")
+            return
+        if self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(self.flush_interval, self._flush)
+
+    def _flush(self):
+        self._flush_timer = None
+        if self._journal is None:
+            return
+        try:
+            self._journal.flush()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сбросить журнал апдейтов {self.path}: {e}")
+
+    def close(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+            logger.info(f"📼 Записано апдейтов: {self.recorded}, ошибок записи {self.failed}")
+
+    def stats(self) -> dict:
+        return {"recorded": self.recorded, "failed": self.failed}
@@ -11,9 +11,12 @@ print("=" * 50)
 # Импортируем и запускаем основной бот
 import asyncio
 from bot import main
+from sharding import shards_from_argv
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        # --webhook — приём апдейтов через вебхук вместо long polling,
+        # --shards N — раздавать чаты N процессам-воркерам
+        asyncio.run(main(webhook="--webhook" in sys.argv[1:], shards=shards_from_argv(sys.argv[1:])))
     except KeyboardInterrupt:
         print("⏹️ Бот остановлен пользователем (Ctrl+C)")
@@ -0,0 +1,275 @@
+"""Шардирование чатов между несколькими процессами бота (--shards N).
+
+Front-процесс принимает апдейты (long polling или webhook) и по chat_id
+пересылает каждый одному из N воркеров по локальному HTTP. Чат всегда
+обслуживает один и тот же воркер, поэтому блокировки, очереди и кэши чата
+живут в памяти одного процесса, а порядок апдейтов чата сохраняется: каждому
+воркеру апдейты отправляются строго по очереди.
+
+Воркер — обычный бот в режиме --webhook на 127.0.0.1 с переменными
+SHARD_INDEX/SHARD_COUNT. Общую базу SQLite воркеры используют одновременно
+(WAL + busy_timeout), а фоновые задачи (сверка закрепов, восстановление
+кнопок, outbox, продолжение рассылок) каждый выполняет только для своих чатов.
+"""
+import asyncio
+import logging
+import os
+import secrets
+import signal
+import sys
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from aiogram import Bot
+from aiohttp import web
+
+from metrics import METRICS_PORT, register_stats, start_metrics_server
+from tg_scheduler import TG_GLOBAL_RATE
+from webhook import WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, register_webhook
+
+logger = logging.getLogger(__name__)
+
+# Номер и число шардов текущего процесса (задаёт front-процесс при запуске воркера)
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+# Воркер i слушает 127.0.0.1:SHARD_BASE_PORT+i
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "8100"))
+# Сколько апдейтов может ждать отправки одному воркеру
+SHARD_QUEUE_LIMIT = int(os.getenv("SHARD_QUEUE_LIMIT", "1000"))
+# Сколько ждать завершения воркера после сигнала остановки (с)
+SHARD_STOP_TIMEOUT = float(os.getenv("SHARD_STOP_TIMEOUT", "30"))
+
+SHARD_WORKER_PATH = "/update"
+
+
+def shard_of(chat_id: int, count: int = SHARD_COUNT) -> int:
+    # Совпадает с выражением abs(chat_id) % count в SQL-запросах воркера
+    return abs(chat_id) % count if count > 1 else 0
+
+
+def owns_chat(chat_id: int) -> bool:
+    """Обслуживает ли текущий процесс этот чат"""
+    return shard_of(chat_id) == SHARD_INDEX
+
+
+def current_shard() -> tuple:
+    """(номер, число шардов) текущего процесса — для фильтров в запросах к БД"""
+    return SHARD_INDEX, max(1, SHARD_COUNT)
+
+
+def update_chat_id(update: Dict[str, Any]) -> Optional[int]:
+    """Чат апдейта (или пользователь, если чата нет — например, inline-запрос)"""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat.get("id")
+        user = value.get("from") or value.get("user")
+        if user:
+            return user.get("id")
+    return None
+
+
+def shards_from_argv(argv: List[str]) -> int:
+    """Число шардов из аргументов `--shards N` / `--shards=N`; 1 — без шардирования"""
+    for i, arg in enumerate(argv):
+        if arg == "--shards" and i + 1 < len(argv):
+            return max(1, int(argv[i + 1]))
+        if arg.startswith("--shards="):
+            return max(1, int(arg.split("=", 1)[1]))
+    return 1
+
+
+class ShardRouter:
+    """Пересылка апдейтов воркерам: своя упорядоченная очередь на каждый шард"""
+
+    def __init__(self, count: int, base_port: int = SHARD_BASE_PORT, secret: str = "",
+                 capacity: int = SHARD_QUEUE_LIMIT):
+        self.count = count
+        self.base_port = base_port
+        self.secret = secret
+        self.capacity = capacity
+        self._queues: List[asyncio.Queue] = []
+        self._senders: List[asyncio.Task] = []
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.forwarded = [0] * count
+        self.dropped = 0
+
+    def start(self):
+        self._session = aiohttp.ClientSession()
+        self._queues = [asyncio.Queue(self.capacity) for _ in range(self.count)]
+        self._senders = [asyncio.create_task(self._sender(i)) for i in range(self.count)]
+
+    async def route(self, update: Dict[str, Any]):
+        """Поставить апдейт в очередь его шарда; полная очередь задерживает приём"""
+        chat_id = update_chat_id(update)
+        await self._queues[shard_of(chat_id or 0, self.count)].put(update)
+
+    async def _sender(self, index: int):
+        url = f"http://127.0.0.1:{self.base_port + index}{SHARD_WORKER_PATH}"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret}
+        queue = self._queues[index]
+        while True:
+            update = await queue.get()
+            delay = 0.5
+            while True:
+                try:
+                    async with self._session.post(url, json=update, headers=headers) as response:
+                        if response.status == 200:
+                            self.forwarded[index] += 1
+                            break
+                        if response.status < 500:
+                            # Повтор не поможет (например, не совпал секрет)
+                            self.dropped += 1
+                            logger.error(f"❌ Воркер {index} отклонил апдейт {update.get('update_id')}: HTTP {response.status}")
+                            break
+                except aiohttp.ClientError as e:
+                    # Воркер ещё запускается или перезапускается
+                    logger.debug(f"Воркер {index} недоступен: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+            queue.task_done()
+
+    async def stop(self, drain_timeout: float = 10):
+        """Дослать очереди (не дольше drain_timeout) и закрыть соединения"""
+        if self._queues and any(queue.qsize() for queue in self._queues):
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(queue.join() for queue in self._queues)), timeout=drain_timeout
+                )
+            except asyncio.TimeoutError:
+                pass
+        for task in self._senders:
+            task.cancel()
+        await asyncio.gather(*self._senders, return_exceptions=True)
+        self._senders = []
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stats(self) -> dict:
+        return {
+            "forwarded": list(self.forwarded),
+            "queued": [queue.qsize() for queue in self._queues],
+            "dropped": self.dropped,
+        }
+
+
+async def _run_worker(index: int, count: int, secret: str, script: str):
+    """Запустить воркер шарда и перезапускать его при падении"""
+    env = dict(
+        os.environ,
+        SHARD_INDEX=str(index),
+        SHARD_COUNT=str(count),
+        WEBHOOK_HOST="127.0.0.1",
+        WEBHOOK_PORT=str(SHARD_BASE_PORT + index),
+        WEBHOOK_PATH=SHARD_WORKER_PATH,
+        WEBHOOK_URL="",
+        WEBHOOK_SECRET=secret,
+        # Глобальный лимит API делится между воркерами
+        TG_GLOBAL_RATE=str(TG_GLOBAL_RATE / count),
+        # METRICS_PORT — у front-процесса, воркеры следом за ним
+        METRICS_PORT=str(METRICS_PORT + 1 + index) if METRICS_PORT else "0",
+    )
+    while True:
+        # Свою группу процессов воркеру даём, чтобы Ctrl+C получал только front,
+        # а воркеры останавливались по его сигналу и успевали всё дописать
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, script, "--webhook", env=env, start_new_session=os.name != "nt"
+        )
+        logger.info(f"🧩 Запущен воркер {index + 1}/{count} (pid={process.pid})")
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            await _stop_worker(process)
+            raise
+        logger.error(f"❌ Воркер {index + 1}/{count} завершился с кодом {code}, перезапуск через 5 с")
+        await asyncio.sleep(5)
+
+
+async def _stop_worker(process: asyncio.subprocess.Process):
+    if process.returncode is not None:
+        return
+    if os.name == "nt":
+        process.terminate()
+    else:
+        process.send_signal(signal.SIGINT)
+    try:
+        await asyncio.wait_for(process.wait(), timeout=SHARD_STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ Воркер pid={process.pid} не остановился за {SHARD_STOP_TIMEOUT:g} с, завершаю принудительно")
+        process.kill()
+        await process.wait()
+
+
+async def _poll(bot: Bot, router: ShardRouter, allowed_updates: List[str]):
+    # getUpdates не работает, пока зарегистрирован вебхук
+    await bot.delete_webhook(drop_pending_updates=False)
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset, timeout=30, allowed_updates=allowed_updates, request_timeout=40
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка получения апдейтов: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            await router.route(update.model_dump(mode="json", exclude_unset=True, by_alias=True))
+            offset = update.update_id + 1
+
+
+async def _serve_webhook(bot: Bot, router: ShardRouter, allowed_updates: List[str]):
+    async def handle(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and not secrets.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET
+        ):
+            return web.Response(body="Unauthorized", status=401)
+        await router.route(await request.json())
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+        await site.start()
+        logger.info(f"🌐 Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await register_webhook(bot, allowed_updates)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_front(bot: Bot, allowed_updates: List[str], count: int, script: str, webhook: bool = False):
+    """Front-процесс: запускает count воркеров и раздаёт им апдейты по chat_id"""
+    # Секрет локального канала: апдейты воркерам может слать только front
+    secret = secrets.token_urlsafe(16)
+    router = ShardRouter(count, secret=secret)
+    router.start()
+    register_stats("shard_router", lambda: {
+        "queued": sum(router.stats()["queued"]),
+        "forwarded": sum(router.forwarded),
+        "dropped": router.dropped,
+    })
+    metrics_server = await start_metrics_server()
+    workers = [asyncio.create_task(_run_worker(i, count, secret, script)) for i in range(count)]
+    logger.info(f"🧩 Шардирование: воркеров {count}, порты {SHARD_BASE_PORT}–{SHARD_BASE_PORT + count - 1}")
+    try:
+        if webhook:
+            await _serve_webhook(bot, router, allowed_updates)
+        else:
+            await _poll(bot, router, allowed_updates)
+    finally:
+        # Сначала досылаем принятое, затем останавливаем воркеры
+        await router.stop()
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        stats = router.stats()
+        logger.info(f"🧩 Шардирование: переслано апдейтов {stats['forwarded']}, отклонено {stats['dropped']}")
+        if metrics_server is not None:
+            await metrics_server.cleanup()
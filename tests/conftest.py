@@ -0,0 +1,28 @@
+import os
+import sys
+from contextlib import asynccontextmanager
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_async  # noqa: E402
+from db_migrations import run_migrations  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """Пустая база с актуальной схемой"""
+    path = str(tmp_path / "tasks.db")
+    run_migrations(path)
+    return path
+
+
+@asynccontextmanager
+async def opened_pool(path: str):
+    """Общий пул db_async на время теста (функции db_async работают через него)"""
+    pool = await db_async.init_pool(path, readers=1)
+    try:
+        yield pool
+    finally:
+        await db_async.close_pool()
@@ -0,0 +1,92 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from conftest import opened_pool
+from db_async import ConnectionPool, create_task, get_task_status, transition_task
+
+
+def saved_values(path: str) -> list:
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute("SELECT x FROM t ORDER BY x")]
+    finally:
+        conn.close()
+
+
+async def open_pool(path: str, **kwargs) -> ConnectionPool:
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (x INTEGER)")
+    conn.close()
+    pool = ConnectionPool(path, readers=1, **kwargs)
+    await pool.open()
+    return pool
+
+
+def test_failed_unit_rolls_back_alone(tmp_path):
+    path = str(tmp_path / "pool.db")
+
+    async def scenario():
+        # Интервал длинный, пачка коммитится по размеру: три успешных блока — одна транзакция
+        pool = await open_pool(path, commit_interval=10, commit_batch=3)
+        commits = pool.commits
+
+        async def insert(x, fail=False):
+            async with pool.writer() as db:
+                await db.execute("INSERT INTO t (x) VALUES (?)", (x,))
+                if fail:
+                    raise ValueError("boom")
+
+        results = await asyncio.wait_for(
+            asyncio.gather(insert(1), insert(2, fail=True), insert(3), insert(4), return_exceptions=True), 5
+        )
+        await pool.close()
+        return results, pool.commits - commits
+
+    results, commits = asyncio.run(scenario())
+    assert results[0] is None and results[2] is None and results[3] is None
+    assert isinstance(results[1], ValueError)
+    assert commits == 1
+    assert saved_values(path) == [1, 3, 4]
+
+
+def test_close_commits_batch_in_flight(tmp_path):
+    path = str(tmp_path / "pool.db")
+
+    async def scenario():
+        # Пачку не коммитит ни таймер, ни размер — только close()
+        pool = await open_pool(path, commit_interval=60, commit_batch=1000)
+
+        async def insert(x):
+            async with pool.writer() as db:
+                await db.execute("INSERT INTO t (x) VALUES (?)", (x,))
+
+        writes = [asyncio.create_task(insert(x)) for x in range(20)]
+        await asyncio.sleep(0.1)
+        assert not any(task.done() for task in writes)
+        await asyncio.wait_for(pool.close(), 5)
+        return await asyncio.wait_for(asyncio.gather(*writes, return_exceptions=True), 5)
+
+    results = asyncio.run(scenario())
+    assert results == [None] * 20
+    assert saved_values(path) == list(range(20))
+
+
+def test_transition_task_compare_and_set(db_path):
+    async def scenario():
+        async with opened_pool(db_path):
+            task_id, _ = await create_task(-100, 1, "user", "текст")
+            assert await get_task_status(task_id) == 'new'
+            assert await transition_task(task_id, 'new', 'open') == (True, 'open')
+            # Повторный клик по «Создать»: статус уже другой, перехода нет
+            assert await transition_task(task_id, 'new', 'open') == (False, 'open')
+            assert await transition_task(task_id, 'open', 'closed') == (True, 'closed')
+            # Одновременные «Переоткрыть»: выигрывает ровно один
+            results = await asyncio.gather(*(transition_task(task_id, 'closed', 'open') for _ in range(10)))
+            assert sorted(results) == [(False, 'open')] * 9 + [(True, 'open')]
+            assert await transition_task(10**9, 'open', 'closed') == (False, None)
+            with pytest.raises(ValueError):
+                await transition_task(task_id, 'new', 'closed')
+
+    asyncio.run(scenario())
@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import DeleteMessage
+
+from conftest import opened_pool
+from db_async import outbox_size
+import outbox as outbox_module
+from outbox import Outbox
+
+METHOD = DeleteMessage(chat_id=-100, message_id=1)
+
+
+async def drained(outbox: Outbox, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while await outbox_size(outbox.shard):
+        assert time.monotonic() < deadline, "outbox не опустел"
+        await asyncio.sleep(0.02)
+
+
+def test_retry_then_done_and_drop(db_path):
+    calls = {}
+
+    async def scenario():
+        outbox = Outbox(max_attempts=3, max_backoff=0.05)
+
+        def counted(kind):
+            calls[kind] = calls.get(kind, 0) + 1
+            return calls[kind]
+
+        @outbox.handler("flaky")
+        async def flaky(chat_id, payload):
+            if counted("flaky") == 1:
+                raise RuntimeError("временная ошибка")
+
+        @outbox.handler("flood")
+        async def flood(chat_id, payload):
+            if counted("flood") == 1:
+                raise TelegramRetryAfter(METHOD, "Too Many Requests", 0)
+
+        @outbox.handler("broken")
+        async def broken(chat_id, payload):
+            counted("broken")
+            raise RuntimeError("постоянная ошибка")
+
+        @outbox.handler("gone")
+        async def gone(chat_id, payload):
+            counted("gone")
+            raise TelegramBadRequest(METHOD, "Bad Request: message to delete not found")
+
+        async with opened_pool(db_path):
+            for kind in ("flaky", "flood", "broken", "gone"):
+                await outbox.enqueue(kind, f"{kind}:1", -100, {"n": 1})
+            await drained(outbox)
+            await outbox.stop()
+        return outbox.stats()
+
+    stats = asyncio.run(scenario())
+    assert calls == {"flaky": 2, "flood": 2, "broken": 3, "gone": 1}
+    assert stats["done"] == 2
+    assert stats["dropped"] == 2
+    # flaky — 1 повтор, flood — 1 (без учёта попытки), broken — 2 до отмены
+    assert stats["retried"] == 4
+
+
+def test_same_key_is_coalesced(db_path):
+    seen = []
+
+    async def scenario():
+        outbox = Outbox()
+
+        @outbox.handler("markup")
+        async def markup(chat_id, payload):
+            seen.append(payload["status"])
+
+        async with opened_pool(db_path):
+            # Оба действия отложены: к моменту выполнения остаётся только последнее
+            await outbox.enqueue("markup", "markup:1", -100, {"status": "open"}, delay=0.2)
+            await outbox.enqueue("markup", "markup:1", -100, {"status": "closed"}, delay=0.2)
+            await drained(outbox)
+            await outbox.stop()
+
+    asyncio.run(scenario())
+    assert seen == ["closed"]
+
+
+def test_store_error_is_logged_and_action_repeated(db_path, monkeypatch):
+    calls = []
+    real_done = outbox_module.outbox_done
+    failures = [RuntimeError("database is locked")]
+
+    async def flaky_done(entry_id, version):
+        if failures:
+            raise failures.pop()
+        await real_done(entry_id, version)
+
+    monkeypatch.setattr(outbox_module, "outbox_done", flaky_done)
+
+    async def scenario():
+        outbox = Outbox(max_backoff=0.05)
+
+        @outbox.handler("delete")
+        async def delete(chat_id, payload):
+            calls.append(payload["message_id"])
+
+        async with opened_pool(db_path):
+            await outbox.enqueue("delete", "delete:-100:7", -100, {"message_id": 7})
+            await drained(outbox)
+            await outbox.stop()
+        return outbox.stats()
+
+    stats = asyncio.run(scenario())
+    # Итог первого выполнения не записан — действие выполняется ещё раз (at-least-once)
+    assert calls == [7, 7]
+    assert stats["store_errors"] == 1
+    assert stats["done"] == 2
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, GetMe, SendMessage
+
+from tg_scheduler import (
+    OutboundScheduler, PRIORITY_BACKGROUND, PRIORITY_PIN, PRIORITY_REPLY, request_priority,
+)
+
+CHAT = -100
+
+
+def call(scheduler, make_request, method, priority=None):
+    async def run():
+        if priority is None:
+            return await scheduler(make_request, None, method)
+        with request_priority(priority):
+            return await scheduler(make_request, None, method)
+    return asyncio.create_task(run())
+
+
+def test_priority_order_when_tokens_are_scarce():
+    labels = {}
+    order = []
+
+    async def make_request(bot, method):
+        order.append(labels[id(method)])
+
+    async def scenario():
+        scheduler = OutboundScheduler(global_rate=50)
+        scheduler.global_bucket.tokens = 0
+        calls = []
+        for label, priority in (("background", PRIORITY_BACKGROUND), ("pin", PRIORITY_PIN), ("reply", PRIORITY_REPLY)):
+            method = GetMe()
+            labels[id(method)] = label
+            calls.append(call(scheduler, make_request, method, priority))
+        answer = AnswerCallbackQuery(callback_query_id="1")
+        labels[id(answer)] = "callback"
+        calls.append(call(scheduler, make_request, answer))
+        await asyncio.wait_for(asyncio.gather(*calls), 5)
+        await scheduler.close()
+
+    asyncio.run(scenario())
+    assert order == ["callback", "reply", "pin", "background"]
+
+
+def test_retry_after_pauses_only_the_chat():
+    calls = []
+
+    async def make_request(bot, method):
+        calls.append((method.chat_id, time.monotonic()))
+        if method.chat_id == CHAT and len([c for c in calls if c[0] == CHAT]) == 1:
+            raise TelegramRetryAfter(method, "Too Many Requests", 1)
+        return True
+
+    async def scenario():
+        scheduler = OutboundScheduler()
+        started = time.monotonic()
+        flooded = call(scheduler, make_request, SendMessage(chat_id=CHAT, text="pin"), PRIORITY_PIN)
+        await asyncio.sleep(0.1)
+        # Другой чат не ждёт паузу первого
+        other = await asyncio.wait_for(call(scheduler, make_request, SendMessage(chat_id=-200, text="x")), 0.5)
+        assert other is True
+        assert await asyncio.wait_for(flooded, 5) is True
+        await scheduler.close()
+        return started, scheduler.stats()
+
+    started, stats = asyncio.run(scenario())
+    chat_calls = [at for chat_id, at in calls if chat_id == CHAT]
+    assert len(chat_calls) == 2
+    assert chat_calls[1] - started >= 1.0
+    assert stats["flood_hits"] == 1
+
+
+def test_interactive_requests_fail_fast_on_long_pause():
+    calls = []
+
+    async def make_request(bot, method):
+        calls.append(method)
+        raise TelegramRetryAfter(method, "Too Many Requests", 5)
+
+    async def scenario():
+        scheduler = OutboundScheduler(interactive_max_wait=0.5)
+        started = time.monotonic()
+        with pytest.raises(TelegramRetryAfter):
+            await call(scheduler, make_request, SendMessage(chat_id=CHAT, text="reply"), PRIORITY_REPLY)
+        # Чат уже на паузе: следующий ответ сразу получает ошибку, не дойдя до API
+        with pytest.raises(TelegramRetryAfter) as error:
+            await call(scheduler, make_request, SendMessage(chat_id=CHAT, text="reply"), PRIORITY_REPLY)
+        elapsed = time.monotonic() - started
+        await scheduler.close()
+        return elapsed, error.value.retry_after, scheduler.stats()
+
+    elapsed, retry_after, stats = asyncio.run(scenario())
+    assert elapsed < 1.0
+    assert len(calls) == 1
+    assert 4 <= retry_after <= 5
+    assert stats["fail_fast"] == 1
+
+
+def test_background_leaves_global_reserve():
+    granted = []
+
+    async def make_request(bot, method):
+        granted.append((labels[id(method)], time.monotonic()))
+
+    labels = {}
+
+    async def scenario():
+        # Ёмкость 4, резерв 25% = 1 токен: фоновому запросу нужно 2, ответу — 1
+        scheduler = OutboundScheduler(global_rate=4)
+        scheduler.global_bucket.tokens = 1.5
+        started = time.monotonic()
+        background, reply = GetMe(), GetMe()
+        labels[id(background)], labels[id(reply)] = "background", "reply"
+        calls = [call(scheduler, make_request, background, PRIORITY_BACKGROUND)]
+        await asyncio.sleep(0.01)
+        calls.append(call(scheduler, make_request, reply, PRIORITY_REPLY))
+        await asyncio.wait_for(asyncio.gather(*calls), 5)
+        await scheduler.close()
+        return started
+
+    started = asyncio.run(scenario())
+    assert [label for label, _ in granted] == ["reply", "background"]
+    assert granted[0][1] - started < 0.1
@@ -0,0 +1,300 @@
+"""Планировщик исходящих запросов к Telegram Bot API.
+
+Все вызовы bot.* проходят через middleware сессии, поэтому ограничения
+применяются централизованно, а не после ошибки Flood control:
+
+* глобальный token bucket (~30 запросов/с на бота);
+* token bucket на каждый чат (группы ~20 сообщений/мин, личные ~1/с);
+* классы приоритета: ответы на кнопки и видимые пользователю ответы раньше
+  обновлений закрепа, а те — раньше фоновой работы;
+* TelegramRetryAfter ставит на паузу bucket чата запроса (глобальный — только
+  для запросов без чата) и повторяет запрос; ответы пользователю ждут не
+  дольше TG_INTERACTIVE_MAX_WAIT, длинную паузу пережидает только фоновая работа.
+"""
+import asyncio
+import functools
+import math
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, GetUpdates, TelegramMethod
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_CALLBACK = 0    # answerCallbackQuery — снимает «часики» у пользователя
+PRIORITY_REPLY = 1       # сообщения и правки, которые пользователь ждёт прямо сейчас
+PRIORITY_PIN = 2         # обновление закрепа
+PRIORITY_BACKGROUND = 3  # восстановление кнопок, сверки, рассылки
+
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_GROUP_PER_MINUTE = float(os.getenv("TG_GROUP_PER_MINUTE", "20"))
+TG_PRIVATE_RATE = float(os.getenv("TG_PRIVATE_RATE", "1"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "2"))
+# Дольше этого не ждём внутри запроса — ошибка уходит вызывающему коду
+TG_MAX_RETRY_AFTER = float(os.getenv("TG_MAX_RETRY_AFTER", "60"))
+# Ответы на кнопки и ответы пользователю ждут паузу не дольше этого (с), дальше — ошибка сразу
+TG_INTERACTIVE_MAX_WAIT = float(os.getenv("TG_INTERACTIVE_MAX_WAIT", "3"))
+
+# Фоновая работа не забирает последние токены (чата и глобальные): они остаются для ответов пользователям
+BACKGROUND_RESERVE = 0.25
+
+# Методы, не расходующие лимит чата (учитываются только в глобальном bucket)
+CHAT_EXEMPT_PREFIXES = ("Get", "Delete")
+
+# Запросы, которые не ограничиваем (long polling)
+UNLIMITED_METHODS = (GetUpdates,)
+
+_priority: ContextVar[Optional[int]] = ContextVar("tg_request_priority", default=None)
+
+
+@contextmanager
+def request_priority(priority: int):
+    """Задать класс приоритета для всех запросов к API внутри блока"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def with_priority(priority: int):
+    """Декоратор: все запросы к API внутри корутины идут с заданным приоритетом"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with request_priority(priority):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def available_at(self, now: float, need: float = 1.0) -> float:
+        """Момент, когда в bucket будет need токенов (с учётом паузы)"""
+        self._refill(now)
+        at = now if self.tokens >= need else now + (need - self.tokens) / self.rate
+        return max(at, self.paused_until)
+
+    def need(self, reserve: float) -> float:
+        """Сколько токенов должно быть, чтобы взять один и оставить долю reserve ёмкости"""
+        return max(1.0, min(self.capacity, 1.0 + self.capacity * reserve))
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    def __init__(
+        self,
+        global_rate: float = TG_GLOBAL_RATE,
+        group_per_minute: float = TG_GROUP_PER_MINUTE,
+        private_rate: float = TG_PRIVATE_RATE,
+        max_retries: int = TG_MAX_RETRIES,
+        max_retry_after: float = TG_MAX_RETRY_AFTER,
+        interactive_max_wait: float = TG_INTERACTIVE_MAX_WAIT,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.group_per_minute = group_per_minute
+        self.private_rate = private_rate
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.interactive_max_wait = interactive_max_wait
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        # (priority, seq, chat_id, spends_chat_tokens, future)
+        self._waiters = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._last_cleanup = time.monotonic()
+        self.flood_hits = 0
+        self.fail_fast = 0
+
+    # --- классификация запроса ---
+    @staticmethod
+    def _priority_for(method: TelegramMethod) -> int:
+        if isinstance(method, AnswerCallbackQuery):
+            return PRIORITY_CALLBACK
+        priority = _priority.get()
+        return PRIORITY_REPLY if priority is None else priority
+
+    @staticmethod
+    def _chat_key(method: TelegramMethod) -> Optional[int]:
+        chat_id = getattr(method, "chat_id", None)
+        return chat_id if isinstance(chat_id, int) else None
+
+    @staticmethod
+    def _spends_chat_tokens(method: TelegramMethod) -> bool:
+        # Чтение (getChat, getChatMember, ...) и удаление не расходуют лимит сообщений чата,
+        # но Flood control на них ставит на паузу только этот чат
+        return not type(method).__name__.startswith(CHAT_EXEMPT_PREFIXES)
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_per_minute / 60.0, self.group_per_minute)
+            else:
+                bucket = TokenBucket(self.private_rate, max(1.0, self.private_rate * 3))
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _max_wait(self, priority: int) -> float:
+        # Пользователь не ждёт ответа десятки секунд: пусть вызывающий код отложит действие сам
+        return self.interactive_max_wait if priority <= PRIORITY_REPLY else self.max_retry_after
+
+    def chat_ready_at(self, chat_id: int) -> float:
+        """Момент (time.monotonic), когда запрос в чат пройдёт без ожидания лимита чата и паузы; 0 — уже сейчас"""
+        now = time.monotonic()
+        at = self.global_bucket.paused_until
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is not None:
+            at = max(at, bucket.available_at(now))
+        return at if at > now else 0.0
+
+    # --- выдача разрешений ---
+    async def _acquire(self, chat_id: Optional[int], priority: int, spend: bool = True) -> float:
+        """Дождаться разрешения; вернуть 0 или оставшуюся паузу, если ждать её дольше max_wait"""
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), chat_id, spend, future))
+        self._wakeup.set()
+        return await future
+
+    def _grant_ready(self) -> float:
+        """Выдать всё, что можно выдать сейчас; вернуть время следующей проверки"""
+        now = time.monotonic()
+        next_at = float("inf")
+        pending = []
+        for item in sorted(self._waiters):
+            priority, _, chat_id, spend, future = item
+            if future.done():
+                continue
+            reserve = BACKGROUND_RESERVE if priority >= PRIORITY_BACKGROUND else 0.0
+            at = self.global_bucket.available_at(now, self.global_bucket.need(reserve))
+            bucket = self._bucket(chat_id) if chat_id is not None else None
+            if bucket is not None:
+                if spend:
+                    at = max(at, bucket.available_at(now, bucket.need(reserve)))
+                else:
+                    at = max(at, bucket.paused_until)
+            paused_until = max(self.global_bucket.paused_until, bucket.paused_until if bucket is not None else 0.0)
+            if paused_until - now > self._max_wait(priority):
+                # Пауза Flood control длиннее, чем этот запрос готов ждать — не держим его в очереди
+                future.set_result(paused_until - now)
+            elif at <= now:
+                self.global_bucket.take(now)
+                if bucket is not None and spend:
+                    bucket.take(now)
+                future.set_result(0.0)
+            else:
+                pending.append(item)
+                next_at = min(next_at, at)
+        heapq.heapify(pending)
+        self._waiters = pending
+        if now - self._last_cleanup > 60:
+            self._last_cleanup = now
+            for chat_id in [cid for cid, b in self.chat_buckets.items() if b.idle(now)]:
+                self.chat_buckets.pop(chat_id, None)
+        return next_at
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            next_at = self._grant_ready()
+            if not self._waiters:
+                await self._wakeup.wait()
+                continue
+            timeout = max(0.0, next_at - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for *_, future in self._waiters:
+            if not future.done():
+                future.cancel()
+        self._waiters = []
+
+    # --- middleware ---
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, UNLIMITED_METHODS):
+            return await make_request(bot, method)
+        priority = self._priority_for(method)
+        chat_id = self._chat_key(method)
+        spend = self._spends_chat_tokens(method)
+        max_wait = self._max_wait(priority)
+        attempt = 0
+        while True:
+            paused_for = await self._acquire(chat_id, priority, spend)
+            if paused_for:
+                # Чат на паузе Flood control дольше, чем запрос готов ждать — сразу отдаём ошибку
+                self.fail_fast += 1
+                raise TelegramRetryAfter(method, "paused by outbound scheduler", math.ceil(paused_for))
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.flood_hits += 1
+                # Пауза — только у чата запроса; ответ на кнопку ждёт сам, не задерживая
+                # остальных; глобальная пауза — для запросов, у которых чата действительно нет
+                own_pause = chat_id is None and isinstance(method, AnswerCallbackQuery)
+                if chat_id is not None:
+                    self._bucket(chat_id).pause(e.retry_after)
+                elif not own_pause:
+                    self.global_bucket.pause(e.retry_after)
+                if self._wakeup is not None:
+                    self._wakeup.set()
+                attempt += 1
+                if attempt > self.max_retries or e.retry_after > max_wait:
+                    raise
+                logger.warning(
+                    f"⚠️ Flood control на {type(method).__name__} (chat={chat_id}). "
+                    f"Пауза {e.retry_after}s, повтор {attempt}/{self.max_retries}"
+                )
+                if own_pause:
+                    await asyncio.sleep(e.retry_after)
+
+    def stats(self) -> dict:
+        return {
+            "waiting": len(self._waiters),
+            "chat_buckets": len(self.chat_buckets),
+            "flood_hits": self.flood_hits,
+            "fail_fast": self.fail_fast,
+        }
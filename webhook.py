@@ -0,0 +1,128 @@
+"""Приём апдейтов через webhook (встроенный aiohttp-сервер).
+
+Альтернатива long polling: Telegram сам присылает апдейты POST-запросами.
+Апдейт подтверждается ответом 200 сразу после разбора, обработка идёт в
+фоне. Число апдейтов в обработке ограничено: когда все слоты заняты,
+подтверждение ждёт свободного слота, и Telegram не присылает новые апдейты
+сверх max_connections.
+
+Для локальной проверки WEBHOOK_URL можно не задавать: вебхук в Telegram не
+регистрируется, а апдейты (например, записанные) отправляются POST-запросом
+на http://WEBHOOK_HOST:WEBHOOK_PORT/WEBHOOK_PATH.
+"""
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Публичный адрес, который регистрируется в Telegram (без WEBHOOK_PATH); пусто — не регистрировать
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", "100"))
+# Сколько одновременных соединений Telegram открывает к вебхуку (1–100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Сколько ждать обработки принятых апдейтов при остановке (с)
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """SimpleRequestHandler с быстрым ответом и ограничением апдейтов в обработке"""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_in_flight: int = WEBHOOK_MAX_IN_FLIGHT,
+                 secret_token: Optional[str] = None, **data: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self.max_in_flight = max(1, max_in_flight)
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self.received = 0
+        self.waited = 0
+        self.failed = 0
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if self._slots.locked():
+            self.waited += 1
+        await self._slots.acquire()
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except Exception:
+            self._slots.release()
+            raise
+        self.received += 1
+        task = asyncio.create_task(self._feed(bot, update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _feed(self, bot: Bot, update: Dict[str, Any]):
+        try:
+            result = await self.dispatcher.feed_raw_update(bot=bot, update=update, **self.data)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot=bot, result=result)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"❌ Ошибка обработки апдейта {update.get('update_id')}: {e}")
+        finally:
+            self._slots.release()
+
+    async def close(self):
+        # Сессию бота не закрываем: после остановки сервера она ещё нужна
+        # фоновым компонентам (outbox, удаление сообщений) — её закрывает main()
+        tasks = self._background_feed_update_tasks
+        if tasks:
+            await asyncio.wait(tasks, timeout=WEBHOOK_DRAIN_TIMEOUT)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._background_feed_update_tasks),
+            "received": self.received,
+            "waited": self.waited,
+            "failed": self.failed,
+        }
+
+
+async def register_webhook(bot: Bot, allowed_updates: List[str]):
+    """Зарегистрировать вебхук в Telegram, если задан WEBHOOK_URL"""
+    if not WEBHOOK_URL:
+        logger.info("ℹ️ WEBHOOK_URL не задан — вебхук в Telegram не регистрируется")
+        return
+    url = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+    await bot.set_webhook(
+        url=url,
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=allowed_updates,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    logger.info(f"✅ Webhook зарегистрирован: {url}")
+
+
+async def serve_webhook(dispatcher: Dispatcher, bot: Bot, allowed_updates: List[str]):
+    """Запустить сервер вебхука и работать до отмены задачи"""
+    handler = BoundedRequestHandler(dispatcher, bot, secret_token=WEBHOOK_SECRET or None)
+    app = web.Application()
+    handler.register(app, path=WEBHOOK_PATH)
+    # startup/shutdown диспетчера вызываются вместе с запуском и остановкой приложения
+    setup_application(app, dispatcher, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+        await site.start()
+        logger.info(f"🌐 Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await register_webhook(bot, allowed_updates)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        stats = handler.stats()
+        logger.info(
+            f"🌐 Webhook: принято апдейтов {stats['received']}, ждали слота {stats['waited']}, "
+            f"ошибок {stats['failed']}"
+        )